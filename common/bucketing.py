@@ -0,0 +1,78 @@
+import numpy as np
+
+# used by recurrent/models/heiner and recurrent/models/shared_LDNN -> need to have the common folder in PYTHONPATH
+
+
+class LengthBucketSampler:
+    '''
+    Groups scene instances of similar length into batches for the (non stateful) padded validation and test batches.
+
+    The scene instances are sorted by length (descending) and cut into consecutive batches, i.e. every batch is padded
+    to its first (longest) scene instance. For a fixed batch size this is the grouping with the least padding.
+    If the batch size may vary (e.g. tf.data pipelines), max_padding_ratio is the padding budget per batch: a batch is
+    closed before it reaches batchsize if the next scene instance would exceed it (the first one is always taken).
+    '''
+
+    def __init__(self, lengths, batchsize, max_padding_ratio=None):
+        if batchsize < 1:
+            raise ValueError('batchsize has to be at least 1. Got: {}'.format(batchsize))
+        if max_padding_ratio is not None and not 0. <= max_padding_ratio < 1.:
+            raise ValueError('max_padding_ratio has to be in [0, 1). Got: {}'.format(max_padding_ratio))
+
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batchsize = batchsize
+        self.max_padding_ratio = max_padding_ratio
+        # stable -> equally long scene instances keep their order
+        self.order = np.argsort(-self.lengths, kind='stable')
+        self._batches = None
+
+    def batches(self):
+        # list of index arrays (into lengths), longest batches first
+        if self._batches is None:
+            if self.max_padding_ratio is None:
+                self._batches = [self.order[i:i + self.batchsize] for i in range(0, len(self.order), self.batchsize)]
+            else:
+                self._batches = self._batches_with_padding_budget()
+        return self._batches
+
+    def _batches_with_padding_budget(self):
+        batches = []
+        sorted_lengths = self.lengths[self.order]
+        start = 0
+        while start < len(self.order):
+            max_length = sorted_lengths[start]
+            end = start + 1
+            used = max_length
+            while end < len(self.order) and end - start < self.batchsize:
+                n = end - start + 1
+                if 1. - (used + sorted_lengths[end]) / (n * max_length) > self.max_padding_ratio:
+                    break
+                used += sorted_lengths[end]
+                end += 1
+            batches.append(self.order[start:end])
+            start = end
+        return batches
+
+    def __len__(self):
+        return len(self.batches())
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def batch_lengths(self):
+        return np.array([self.lengths[batch[0]] for batch in self.batches()], dtype=np.int64)
+
+    def padding_ratio(self, fixed_batchsize=False):
+        '''
+        Padded frames / all frames of the batches. With fixed_batchsize the rows of the batches with less than
+        batchsize scene instances count as padding (the keras models have a fixed batch dimension).
+        '''
+        batches = self.batches()
+        if len(batches) == 0:
+            return 0.
+        rows = np.array([self.batchsize if fixed_batchsize else len(batch) for batch in batches])
+        total = np.sum(rows * self.batch_lengths())
+        return 1. - np.sum(self.lengths) / total
+
+    def efficiency(self, fixed_batchsize=False):
+        return 1. - self.padding_ratio(fixed_batchsize)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from bucketing import LengthBucketSampler
+
+# run from this directory: python -m pytest test_bucketing.py
+
+LENGTHS = [10, 4, 9, 8, 2]
+
+
+def _batches(sampler):
+    return [batch.tolist() for batch in sampler]
+
+
+def test_fixed_batchsize_batches_longest_first():
+    sampler = LengthBucketSampler(LENGTHS, 2)
+    assert _batches(sampler) == [[0, 2], [3, 1], [4]]
+    np.testing.assert_array_equal(sampler.batch_lengths(), [10, 8, 2])
+
+
+def test_padding_ratio():
+    sampler = LengthBucketSampler(LENGTHS, 2)
+    # frames 33, batches 2 x 10, 2 x 8, 1 x 2 (2 x 2 with the row of the fixed batch dimension)
+    assert sampler.padding_ratio() == pytest.approx(1. - 33. / 38.)
+    assert sampler.padding_ratio(fixed_batchsize=True) == pytest.approx(1. - 33. / 40.)
+    assert sampler.efficiency() == pytest.approx(33. / 38.)
+    assert LengthBucketSampler([], 2).padding_ratio() == 0.
+
+
+def test_padding_budget_closes_batches_early():
+    sampler = LengthBucketSampler(LENGTHS, 3, max_padding_ratio=0.1)
+    # 10, 9, 8: padding 3 / 30 is within the budget, 4 next to 2 would be 2 / 8
+    assert _batches(sampler._batches_with_padding_budget()) == [[0, 2, 3], [1], [4]]
+    assert _batches(sampler) == [[0, 2, 3], [1], [4]]
+    assert sampler.padding_ratio() == pytest.approx(1. - 33. / 36.)
+    assert sampler.padding_ratio() <= 0.1
+
+
+def test_padding_budget_zero_groups_equal_lengths():
+    sampler = LengthBucketSampler([5, 3, 5, 5], 4, max_padding_ratio=0.)
+    assert _batches(sampler) == [[0, 2, 3], [1]]
+    assert sampler.padding_ratio() == 0.
+
+
+def test_padding_budget_keeps_batchsize():
+    sampler = LengthBucketSampler([7] * 5, 2, max_padding_ratio=0.5)
+    assert [len(batch) for batch in sampler] == [2, 2, 1]
+
+
+@pytest.mark.parametrize('batchsize,max_padding_ratio', [(0, None), (2, 1.), (2, -0.1)])
+def test_invalid_arguments(batchsize, max_padding_ratio):
+    with pytest.raises(ValueError):
+        LengthBucketSampler(LENGTHS, batchsize, max_padding_ratio)
@@ -1,13 +1,9 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import multiprocessing as mp
-import os
 from time import time
 import random
 import math
-import glob
-from tqdm import tqdm
-import pickle
 import gc
 from heiner.dataloader import DataLoader as HeinerDataloader
 from myutils import printerror
@@ -59,7 +55,7 @@ from constants import *
 # buffer of a single scene instance (is instantiated e.g. 2000 times in a BatchLoader object in train mode)
 class SceneInstanceBuffer:
 
-    def __init__(self, filename, batchloader, mode, params):
+    def __init__(self, filename, batchloader, mode, params, first_blockid=0):
         # #self.filename_and_or_sceneinstance_id = filename_and_or_sceneinstance_id
         self.mode = mode
         self.params = params
@@ -73,27 +69,24 @@ class SceneInstanceBuffer:
         # positions and overlaps
         self.positions, self.overlaps = self.batchloader.block_positions_and_overlaps_dict[self.filename]
 
-        # load data
-        with np.load(filename) as data:
-            # features
-            self.x = data['x']
-            # remark: input standardization will be done in buffer for the final batch (to be compatible with Heiner's code)
+        # load data (features and labels; from the memory-mapped packed store if available, cf. Heiner's dataloader)
+        # remark: input standardization will be done in buffer for the final batch (to be compatible with Heiner's code)
+        # (decoded by the worker processes of the batchloader's decode pool if params['decodeworkers'] > 0)
+        self.x, self.y = self.batchloader._load_scene_instance_read_ahead(filename)
 
-            # labels
-            self.y = data['y'] if params['instantlabels'] else data['y_block']
-
-        # saving iterator as attribute
-        self.iter = self.block_iterator()
+        # saving iterator as attribute (first_blockid > 0: continue a partially used scene instance, cf. load_state_dict)
+        self.blocks_yielded = first_blockid
+        self.iter = self.block_iterator(first_blockid)
 
 
     def __len__(self):
         return len(self.positions)
 
 
-    def block_iterator(self):
+    def block_iterator(self, first_blockid=0):
 
-        empty = False
-        blockid = 0
+        blockid = first_blockid
+        empty = blockid >= len(self)
         while (not empty):
 
             # get current position and overlap
@@ -118,6 +111,7 @@ class SceneInstanceBuffer:
             if overlap > 0: # except first overlap (would though be respected by following slicing as well)
                 y_concat_sid_block[:overlap, :, :] = self.params['mask_value']
 
+            self.blocks_yielded = blockid + 1
             yield x_block, y_concat_sid_block
 
             # last blockid processed:
@@ -128,6 +122,41 @@ class SceneInstanceBuffer:
                 blockid += 1
 
 
+# calculate positions (startind frame indices) and overlaps (number of frames) of consecutive blocks
+# of a scene instance that is represented here only by its length
+# remark: the overlap with the previous block can vary though:
+#         first block (no overlap at all), intermediate blocks (overlap historysize-1) and
+#         the last block (overlap s.t. the end of the scene instance is exactly approached => quite large overlap possible)
+def calculate_block_positions_and_overlaps(scene_instance_length, batch_length, history_length):
+
+    # assume that at least one full block (with batchlength) exists in the the scene instance
+    assert batch_length <= scene_instance_length
+
+    # first block is the only block:
+    if batch_length == scene_instance_length:
+        return [0], [0]
+
+    # intermediate blocks: the first history_length-1 elements are shared with the previous block
+    # and the history_length's element is the first new frame (the overlapping part will be masked)
+    stride = batch_length - history_length + 1
+    assert stride > 0
+
+    # the last block is the first one whose (intermediate) candidate would reach the end of the scene instance
+    n_intermediate = int(math.ceil((scene_instance_length - batch_length) / stride))
+    positions = [block_idx * stride for block_idx in range(n_intermediate)]
+    overlaps = [0] + [history_length - 1] * (n_intermediate - 1)
+
+    # last block: overlap s.t. the end of the scene instance is exactly approached
+    overlap = positions[-1] + 2 * batch_length - scene_instance_length + 1
+    # ensure overlap is nonnegative and smaller than batch_length
+    assert overlap >= 0 and overlap < batch_length
+    positions.append(scene_instance_length - batch_length - 1)
+    overlaps.append(overlap)
+
+    # the length of both returned lists is the number of (batchlength long) blocks
+    return positions, overlaps
+
+
 # batchloader that internally uses a set of many (e.g. 2000) scene instance buffers to fetch blocks from
 # one scene instance has between 3,000 and 20,000 frames, avg < 4,000 frames
 # => avg host mem required per buffered scene instance: (160+13) * 4,000 * 4 Byte < 2.8 MB
@@ -141,7 +170,8 @@ class BatchLoader(HeinerDataloader):
                        buffer=10, features=DIM_FEATURES, classes=DIM_LABELS, path_pattern=DATA_ROOT+'/',
                        seed=seed, seed_by_epoch=True, priority_queue=True, use_every_timestep=False, mask_val=params['mask_value'],
                        val_stateful=False, k_scenes_to_subsample=-1,
-                       input_standardization=not params['noinputstandardization'])
+                       input_standardization=not params['noinputstandardization'],
+                       n_io_workers=params.get('decodeworkers', 0), io_backend='processes')
 
         self.params = params
 
@@ -182,117 +212,15 @@ class BatchLoader(HeinerDataloader):
 
     def _block_positions_and_overlaps_dict(self):
         if self.block_positions_and_overlaps_dict is None:
-            pickle_path = os.path.join(self.pickle_path, 'block_positions_and_overlaps_dict.pickle')
-
-            # update stored dict if current parametrization is not yet contained:
-            if not os.path.exists(pickle_path):
-                self._create_block_positions_and_overlaps_dict(pickle_path=pickle_path)
-
-            # read stored dict(batchlength,historylength) of dicts(filename)
-            with open(pickle_path, 'rb') as handle:
-                all_block_positions_and_overlaps_dict = pickle.load(handle)
-
-            dict_key = (self.params['batchlength'], self.params['historylength'])
-
-            # update stored dict if current parametrization is not yet contained:
-            if dict_key not in all_block_positions_and_overlaps_dict:
-                self._create_block_positions_and_overlaps_dict(pickle_path=pickle_path)
-                with open(pickle_path, 'rb') as handle:
-                    all_block_positions_and_overlaps_dict = pickle.load(handle)
-
-            # now we have ensured that the current parametrization exists in all_* dict
-            self.block_positions_and_overlaps_dict = all_block_positions_and_overlaps_dict[dict_key]
+            # closed form per scene instance => no need to store the dict(batchlength,historylength) of dicts(filename)
+            self.block_positions_and_overlaps_dict = {
+                filename: calculate_block_positions_and_overlaps(self.length_dict[filename],
+                                                                 self.params['batchlength'],
+                                                                 self.params['historylength'])
+                for filename in self.filenames_all}
 
         return self.block_positions_and_overlaps_dict
 
-    def _create_block_positions_and_overlaps_dict(self, pickle_path):
-
-        # calculate positions (startind frame indices) and overlaps (number of frames) of consecutive blocks
-        # of a scene instance that is represented here only by its length
-        # remark: the overlap with the previous block can vary though:
-        #         first block (no overlap at all), intermediate blocks (overlap historysize-1) and
-        #         the last block (overlap s.t. the end of the scene instance is exactly approached => quite large overlap possible)
-        def calculate_block_positions_and_overlaps(scene_instance_length, batch_length, history_length):
-
-            # assume that at least one full block (with batchlength) exists in the the scene instance
-            assert batch_length <= scene_instance_length
-
-            # first block
-            block_idx = 0
-            positions = [0]
-            overlaps = [0]
-
-            # there are more blocks, at least a second block:
-            if batch_length < scene_instance_length:
-                last_block = False
-            # first block is the only block:
-            else:
-                last_block = True
-
-            # until we have collected all blocks
-            while (not last_block):
-                # next block
-                block_idx += 1
-
-                # position candidate
-                position = positions[block_idx - 1] + batch_length
-
-                # for intermediate block overlapsuch that the first history_length-1 elements are shared with previous block
-                # and the history_length's element is the first new frame (the overlapping part will be masked)
-                overlap = history_length - 1
-
-                # last block only:
-                if position - overlap + batch_length >= scene_instance_length:
-                    last_block = True
-                    overlap = position + batch_length - scene_instance_length + 1
-                    # ensure overlap is nonnegative and smaller than batch_length
-                    assert overlap >= 0 and overlap < batch_length
-
-                # update position to include overlap
-                position -= overlap
-
-                # ensure that beginning and end of block are within 0...scene_instance_length-1
-                assert position >= 0 and position <= scene_instance_length - 1
-
-                if last_block:
-                    # ensure that last block really is last block
-                    assert position == scene_instance_length - batch_length - 1
-
-                positions.append(position)
-                overlaps.append(overlap)
-
-            # the length of both returned lists is the number of (batchlength long) blocks
-            return positions, overlaps
-
-        print('creating block positions and overlaps dict ')
-
-        # initialize the dicitionary for filename->positions,overlap
-        new_dict = {}
-
-        # we need the scene instance lengths for each filename
-        self.length_dict_()
-
-        all_existing_files = glob.glob(self.pickle_path_pattern)
-        all_existing_files = sorted(all_existing_files)
-        for filename in tqdm(all_existing_files):
-            positions, overlaps = calculate_block_positions_and_overlaps(self.length_dict[filename],
-                                                                         self.params['batchlength'],
-                                                                         self.params['historylength'])
-            new_dict[filename] = (positions, overlaps)
-
-        # load overall dictionary from file or, if file not existing, initialize it
-        try:
-            with open(pickle_path, 'rb') as handle:
-                all_block_positions_and_overlaps_dict = pickle.load(handle)
-        except IOError: #
-            all_block_positions_and_overlaps_dict = {}
-
-        # the to be pickled overall dictionary: dict(batchlength,historylength)->dict(filename->positions,overlaps)
-        all_block_positions_and_overlaps_dict[(self.params['batchlength'], self.params['historylength'])] = new_dict
-
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(all_block_positions_and_overlaps_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
 
     def fill_scene_instance_buffers(self):
 
@@ -310,6 +238,12 @@ class BatchLoader(HeinerDataloader):
         runtime_instantiation = 0.
         runtime_appending = 0.
         runtime_lengthcalc = 0.
+        # let the decode pool (if any) decompress all scene instances needed to fill the buffer in parallel
+        if self.io_pool is not None:
+            n_missing = self.params['sceneinstancebufsize'] - len(self.scene_instance_buffers)
+            if n_missing > 0:
+                self._schedule_read_ahead(self.filenames[-n_missing:])
+
         # add more scene instance buffers until buffer full or all files consumed (e.g. in test mode for a single scene)
         while (len(self.scene_instance_buffers) < self.params['sceneinstancebufsize'] and len(self.filenames) > 0):
 
@@ -380,6 +314,40 @@ class BatchLoader(HeinerDataloader):
 
         # print('batchloader (mode {}) is prepared for epoch {}'.format(self.mode, self.epoch+1))
 
+    # snapshot of the position within the epoch (random states, remaining filenames, used blocks of the scene
+    # instances in the buffer) to resume in the middle of an epoch, cf. Heiner's DataLoader.state_dict
+    def state_dict(self):
+        state = {'mode': self.mode,
+                 'random_state': random.getstate(),
+                 'np_random_state': np.random.get_state(),
+                 'epoch': self.epoch,
+                 'batchid': self.batchid,
+                 'blocks_allbuffers': self.blocks_allbuffers,
+                 'filenames': list(self.filenames),
+                 'scene_instance_buffers': [(buf.filename, buf.blocks_yielded) for buf in self.scene_instance_buffers]}
+        if self.mode == 'train':
+            state['scene_instance_buffers_last'] = self.scene_instance_buffers_last.copy()
+            state['scene_instance_buffers_remaining'] = list(self.scene_instance_buffers_remaining)
+        return state
+
+    def load_state_dict(self, state):
+        if state['mode'] != self.mode:
+            raise ValueError('state of a {} batchloader can not be loaded into a {} batchloader'.format(state['mode'],
+                                                                                                       self.mode))
+        random.setstate(state['random_state'])
+        np.random.set_state(state['np_random_state'])
+        self.epoch = state['epoch']
+        self.batchid = state['batchid']
+        self.blocks_allbuffers = state['blocks_allbuffers']
+        self.filenames = list(state['filenames'])
+        self.read_ahead.clear()
+        # scene instances are loaded again and continue at their next block
+        self.scene_instance_buffers = [SceneInstanceBuffer(filename, self, self.mode, self.params, first_blockid)
+                                       for filename, first_blockid in state['scene_instance_buffers']]
+        if self.mode == 'train':
+            self.scene_instance_buffers_last = state['scene_instance_buffers_last'].copy()
+            self.scene_instance_buffers_remaining = list(state['scene_instance_buffers_remaining'])
+
     def __iter__(self):
         return self
 
@@ -505,7 +473,9 @@ class BatchLoader(HeinerDataloader):
         #       .format(runtime_nextbatch_total, runtime_start, runtime_sample_index, runtime_next_block, runtime_postproc_block, runtime_postproc_block_assignment, runtime_postproc_block_listops, runtime_remove_block, runtime_finish))
 
         # we need to return a copied version of the batch in order not to overwrite it when creating the next batch
-        return np.copy(self._input_standardization_if_wanted(effective_batch_x)), np.copy(effective_batch_y)
+        # (standardization and copy in one pass)
+        return self._input_standardization_if_wanted(effective_batch_x, out=np.empty_like(effective_batch_x)), \
+               np.copy(effective_batch_y)
 
     # calculate probabilities that weight each scene instance buffer with its sequence lengt and also decrease weights of
     # scene instances that were sampled in the previous batch, i.e., decrease ensure that the last batches do not consist
@@ -29,6 +29,7 @@ from heiner.model_extension import train_and_predict_on_batch as heiner_train_an
 from heiner.model_extension import test_and_predict_on_batch as heiner_test_and_predict_on_batch
 from heiner.accuracy_utils import calculate_class_accuracies_metrics_per_scene_instance_in_batch as heiner_calculate_class_accuracies_metrics_per_scene_instance_in_batch
 from heiner.train_utils import calculate_sample_weights_batch as heiner_calculate_sample_weights_batch
+from heiner.train_utils import create_sample_weights_lookup as heiner_create_sample_weights_lookup
 from myutils import metrics_per_batch_thread_handler
 
 def fit_and_predict_generator_with_sceneinst_metrics(model,
@@ -179,6 +180,13 @@ def fit_and_predict_generator_with_sceneinst_metrics(model,
             else:
                 output_generator = generator
 
+        # scene instance id -> sample weight lookup (built once instead of in each batch)
+        sample_weights_lookup = None
+        if not params['nosceneinstweights']:
+            sample_weights_lookup = heiner_create_sample_weights_lookup(generator.length_dict,
+                                                                        generator.scene_instance_ids_dict,
+                                                                        'train')
+
         callback_model.stop_training = False
         # Construct epoch logs.
         epoch_logs = {}
@@ -262,9 +270,7 @@ def fit_and_predict_generator_with_sceneinst_metrics(model,
                 else:
                     sample_weight = heiner_calculate_sample_weights_batch(
                         y[:, :, 0, 1],
-                        generator.length_dict,
-                        generator.scene_instance_ids_dict,
-                        'train')
+                        sample_weights_lookup)
 
                 # run forward and backward pass and do the gradient descent step
                 batch_loss, y_pred_logits, gradient_norm = heiner_train_and_predict_on_batch(model, x, y[:, :, :, 0], sample_weight=sample_weight, calc_global_gradient_norm=not params['nocalcgradientnorm'])
@@ -43,8 +43,10 @@ def run_hyperparam_combinations(gpuid, batchsize, simulate=False):
 
     outfile = os.path.join(experimentfolder, 'hcomps_logfile')
     errfile = os.path.join(experimentfolder, 'hcomps_errors')
-    sys.stdout = heiner_utils.UnbufferedLogAndPrint(outfile, sys.stdout)
-    sys.stderr = heiner_utils.UnbufferedLogAndPrint(errfile, sys.stderr)
+    log_stdout = heiner_utils.BufferedLogAndPrint(outfile, sys.stdout)
+    log_stderr = heiner_utils.BufferedLogAndPrint(errfile, sys.stderr)
+    sys.stdout = log_stdout
+    sys.stderr = log_stderr
 
     # run hyperparameter combinations until nothing to be run anymore
     while (len(open(hcombfilename_remaining).readlines()) > 0):
@@ -118,6 +120,10 @@ def run_hyperparam_combinations(gpuid, batchsize, simulate=False):
         print('finished on {} combination {} (removed from {} and added to {})'.
               format(socket.gethostname(), nexthcomp, hcombfilename_inprogress, hcombfilename_done))
 
+    # flushes and closes the log files (buffered)
+    log_stdout.close()
+    log_stderr.close()
+
 
 
 def sample_hyperparams(path, number):
@@ -104,6 +104,8 @@ parser.add_argument('--sceneinstancebufsize', type=int, default=1500, #3000
                         help='number of buffered scene instances from which to draw the time series of a batch')
 parser.add_argument('--batchbufsize', type=int, default=5, #10,
                         help='number of buffered batches (only relevant in batch buffer\'s multiprocessing mode)')
+parser.add_argument('--decodeworkers', type=int, default=0,
+                        help='number of processes decompressing scene instances into shared memory (0: no decode pool)')
 
 args = parser.parse_args()
 
@@ -213,8 +215,10 @@ else:
 # redirecting stdout and stderr
 outfile = os.path.join(params['path'], params['name'], 'logfile')
 errfile = os.path.join(params['path'], params['name'], 'errors')
-sys.stdout = heiner_utils.UnbufferedLogAndPrint(outfile, sys.stdout)
-sys.stderr = heiner_utils.UnbufferedLogAndPrint(errfile, sys.stderr)
+log_stdout = heiner_utils.BufferedLogAndPrint(outfile, sys.stdout)
+log_stderr = heiner_utils.BufferedLogAndPrint(errfile, sys.stderr)
+sys.stdout = log_stdout
+sys.stderr = log_stderr
 print()
 print('PREPARING')
 
@@ -438,6 +442,10 @@ fit_and_predict_generator_with_sceneinst_metrics(model,
                                                  validation_steps=params['valid_batches_per_epoch'],
                                                  initial_epoch=init_epoch)
 
+# stops the decode workers of the batchloaders
+batchloader_training.close()
+batchloader_validation.close()
+
 # collecting and saving results
 results = metricscallback.results
 
@@ -465,3 +473,7 @@ params['finished'] = True
 save_h5(params, os.path.join(params['path'], params['name'], 'params.h5'))
 
 plot_train_experiment_from_dicts(results, params)
+
+# flushes and closes the log files (buffered)
+log_stdout.close()
+log_stderr.close()
@@ -6,14 +6,6 @@ def get_scene_number_from_scene_instance_id(scene_instance_id):
     return int(scene_instance_id // 1e4)
 
 
-@numba.jit
-def mask_from(y_true, mask_val):
-    # mask has to be calculated per class -> same mask for every class
-    mask = (y_true != mask_val).astype(np.float32)
-    count_unmasked_per_class = np.sum(mask, axis=(0, 1))
-    return mask, count_unmasked_per_class
-
-
 def train_accuracy(scene_instance_id_metrics_dict, metric='BAC'):
     mode = 'train'
     scene_number_class_accuracies, sens_class_scene, spec_class_scene = \
@@ -60,39 +52,164 @@ def val_accuracy(scene_instance_id_metrics_dict, metric=('BAC', 'BAC2'), ret=('f
     return r_v[0] if len(r_v) == 1 else tuple(r_v)
 
 
-@numba.jit
-def calc_batch_metrics(y_pred, y_true, mask_val):
-    all_scene_instance_ids = np.unique(y_true[:, :, 0, 1])
-    all_scene_instance_ids = all_scene_instance_ids[all_scene_instance_ids != mask_val]
-    batch_metrics = np.zeros((len(all_scene_instance_ids), 13, 4))
-
-    i = 0
-    for scene_instance_id in all_scene_instance_ids:
-
-        extracted_indices = y_true[:, :, 0, 1] == scene_instance_id
-
-        y_pred_extracted = y_pred[extracted_indices, :]
-        y_pred_extracted = y_pred_extracted[np.newaxis, :, :]
-        y_true_extracted = y_true[extracted_indices, :, 0]
-        y_true_extracted = y_true_extracted[np.newaxis, :, :]
-
-        mask, count_unmasked_per_class = mask_from(y_true_extracted, mask_val)
+@numba.njit
+def _confusion_counts_kernel(dense_ids, y_pred, labels, mask_val, n_ids):
+    # per time step and class: TP = p*t, FN = (1-p)*t, TN = (1-p)*(1-t), FP = p*(1-t)
+    # (identical to the former sums with TN = (p-1)*(t-1) and FN, FP as differences to positives and negatives)
+    batchsize, timesteps, n_classes = labels.shape
+    counts = np.zeros((n_ids, n_classes, 4))
+    for b in range(batchsize):
+        for t in range(timesteps):
+            d = dense_ids[b, t]
+            for c in range(n_classes):
+                label = labels[b, t, c]
+                if label == mask_val:
+                    continue
+                pred = y_pred[b, t, c]
+                counts[d, c, 0] += pred * label
+                counts[d, c, 1] += (1 - pred) * label
+                counts[d, c, 2] += (1 - pred) * (1 - label)
+                counts[d, c, 3] += pred * (1 - label)
+    return counts
+
+
+def _dense_scene_instance_ids(y_true):
+    # maps the scene instance ids of each time step to 0...n_ids-1 (once for all classes)
+    ids = y_true[:, :, 0, 1]
+    all_scene_instance_ids, dense_ids = np.unique(ids, return_inverse=True)
+    return all_scene_instance_ids, dense_ids.reshape(ids.shape)
 
-        true_positives = np.sum(y_pred_extracted * y_true_extracted * mask, axis=(0, 1))    # sum per class
-        true_negatives = np.sum((y_pred_extracted-1) * (y_true_extracted-1) * mask, axis=(0, 1))
-        positives = np.sum(y_true_extracted * mask, axis=(0, 1))
-        negatives = count_unmasked_per_class - positives
-        false_negatives = positives - true_positives
-        false_positives = negatives - true_negatives
 
-        batch_metrics[i, :, :] = np.stack((true_positives, false_negatives, true_negatives, false_positives), axis=1)
-        i += 1
-
-    return all_scene_instance_ids, batch_metrics
+def calc_batch_metrics(y_pred, y_true, mask_val):
+    all_scene_instance_ids, dense_ids = _dense_scene_instance_ids(y_true)
+    batch_metrics = _confusion_counts_kernel(dense_ids, y_pred, y_true[:, :, :, 0], mask_val,
+                                             len(all_scene_instance_ids))
+
+    valid = all_scene_instance_ids != mask_val
+    return all_scene_instance_ids[valid], batch_metrics[valid]
+
+
+def calc_batch_metrics_bincount(y_pred, y_true, mask_val):
+    # numpy only alternative to calc_batch_metrics: one bincount over (id, class, metric)
+    all_scene_instance_ids, dense_ids = _dense_scene_instance_ids(y_true)
+    labels = y_true[:, :, :, 0]
+    n_ids = len(all_scene_instance_ids)
+    n_classes = labels.shape[2]
+
+    unmasked = (labels != mask_val).astype(np.float64)
+    labels = labels * unmasked
+    y_pred = y_pred * unmasked
+    weights = np.stack((y_pred * labels, (unmasked - y_pred) * labels,
+                        (unmasked - y_pred) * (unmasked - labels), y_pred * (unmasked - labels)), axis=3)
+
+    bins = (dense_ids[:, :, np.newaxis] * n_classes + np.arange(n_classes))[:, :, :, np.newaxis] * 4 + np.arange(4)
+    batch_metrics = np.bincount(bins.ravel(), weights=weights.ravel(), minlength=n_ids * n_classes * 4)
+    batch_metrics = batch_metrics.reshape((n_ids, n_classes, 4))
+
+    valid = all_scene_instance_ids != mask_val
+    return all_scene_instance_ids[valid], batch_metrics[valid]
+
+
+class SceneInstanceMetricsAccumulator:
+    '''
+    Confusion counts (TP, FN, TN, FP) per scene instance and class in one (n_instances, n_classes, 4) array.
+    Replaces the dict scene instance id -> (n_classes, 4) array; the rows are the sorted scene instance ids
+    of the dataloader (cf. metadata_index.py).
+    '''
+
+    def __init__(self, scene_instance_ids, n_classes=13):
+        self.ids = np.unique(np.asarray(scene_instance_ids, dtype=np.float64))
+        self.counts = np.zeros((len(self.ids), n_classes, 4))
+        self.seen = np.zeros(len(self.ids), dtype=bool)
+
+    @staticmethod
+    def from_dataloader(dloader, n_classes=13):
+        return SceneInstanceMetricsAccumulator(dloader.metadata_index_().ids(dloader.filenames_all), n_classes)
+
+    @staticmethod
+    def from_dict(scene_instance_id_metrics_dict):
+        ids = sorted(scene_instance_id_metrics_dict.keys())
+        n_classes = scene_instance_id_metrics_dict[ids[0]].shape[0]
+        accumulator = SceneInstanceMetricsAccumulator(ids, n_classes)
+        accumulator.counts[:] = [scene_instance_id_metrics_dict[id_] for id_ in ids]
+        accumulator.seen[:] = True
+        return accumulator
+
+    def to_dict(self):
+        return {id_: metrics for id_, metrics in zip(self.ids[self.seen].tolist(), self.counts[self.seen])}
+
+    def __len__(self):
+        return int(np.sum(self.seen))
+
+    def rows(self, scene_instance_ids):
+        rows = np.searchsorted(self.ids, scene_instance_ids)
+        rows[rows == len(self.ids)] = 0
+        if not np.all(self.ids[rows] == scene_instance_ids):
+            raise ValueError('unknown scene instance ids: {}'.format(
+                np.asarray(scene_instance_ids)[self.ids[rows] != scene_instance_ids]))
+        return rows
+
+    def add(self, scene_instance_ids, batch_metrics):
+        rows = self.rows(scene_instance_ids)
+        # ids are unique per batch -> no repeated rows
+        self.counts[rows] += batch_metrics
+        self.seen[rows] = True
+
+    def add_batch(self, y_pred, y_true, mask_val):
+        self.add(*calc_batch_metrics(y_pred, y_true, mask_val))
+
+    def merge(self, other):
+        if other.counts.shape[1] != self.counts.shape[1]:
+            raise ValueError('number of classes differ: {} vs. {}'.format(self.counts.shape[1], other.counts.shape[1]))
+        if len(other.ids) != len(self.ids) or not np.all(other.ids == self.ids):
+            ids = np.union1d(self.ids, other.ids)
+            counts = np.zeros((len(ids), self.counts.shape[1], 4))
+            seen = np.zeros(len(ids), dtype=bool)
+            rows = np.searchsorted(ids, self.ids)
+            counts[rows] = self.counts
+            seen[rows] = self.seen
+            self.ids, self.counts, self.seen = ids, counts, seen
+        rows = self.rows(other.ids)
+        self.counts[rows] += other.counts
+        self.seen[rows] |= other.seen
+        return self
+
+    def copy(self):
+        accumulator = SceneInstanceMetricsAccumulator(self.ids, self.counts.shape[1])
+        accumulator.counts[:] = self.counts
+        accumulator.seen[:] = self.seen
+        return accumulator
+
+    def save(self, file):
+        # only the seen scene instances are stored
+        np.savez(file, ids=self.ids[self.seen], counts=self.counts[self.seen])
+
+    @staticmethod
+    def load(file):
+        with np.load(file) as data:
+            accumulator = SceneInstanceMetricsAccumulator(data['ids'], data['counts'].shape[1])
+            accumulator.counts[:] = data['counts']
+        accumulator.seen[:] = True
+        return accumulator
+
+    def scene_metrics(self, n_scenes):
+        # class-wise normalized metrics, summed per scene number -> (n_scenes, n_classes, 4), counts per scene
+        ids = self.ids[self.seen]
+        metrics = self.counts[self.seen]
+        metrics = metrics / np.sum(metrics, axis=2, keepdims=True)
+        scene_numbers = (ids // 1e4).astype(np.int64) - 1
+
+        scene_number_class_accuracies_metrics = np.zeros((n_scenes,) + metrics.shape[1:])
+        np.add.at(scene_number_class_accuracies_metrics, scene_numbers, metrics)
+        scene_number_count = np.bincount(scene_numbers, minlength=n_scenes).astype(np.float64)
+        return scene_number_class_accuracies_metrics, scene_number_count
 
 
 def calculate_class_accuracies_metrics_per_scene_instance_in_batch(scene_instance_id_metrics_dict,
                                                                    y_pred, y_true, mask_val):
+    if isinstance(scene_instance_id_metrics_dict, SceneInstanceMetricsAccumulator):
+        scene_instance_id_metrics_dict.add_batch(y_pred, y_true, mask_val)
+        return
 
     all_scene_instance_ids, batch_metrics = calc_batch_metrics(y_pred, y_true, mask_val)
     for i, scene_instance_id in enumerate(all_scene_instance_ids):
@@ -116,26 +233,19 @@ def calculate_class_accuracies_per_scene_number(scene_instance_ids_metrics_dict,
     else:   # mode == 'test'
         n_scenes = 168
 
-    n_classes, n_metrics = scene_instance_ids_metrics_dict[list(scene_instance_ids_metrics_dict.keys())[0]].shape
+    accumulator = scene_instance_ids_metrics_dict
+    if not isinstance(accumulator, SceneInstanceMetricsAccumulator):
+        accumulator = SceneInstanceMetricsAccumulator.from_dict(scene_instance_ids_metrics_dict)
+
+    # the metrics are not modified (the dict version used to normalize them in place)
+    scene_number_class_accuracies_metrics, scene_number_count = accumulator.scene_metrics(n_scenes)
+    n_classes = scene_number_class_accuracies_metrics.shape[1]
 
-    scene_number_class_accuracies_metrics = np.zeros((n_scenes, n_classes, n_metrics))
     scene_number_class_accuracies = np.zeros((n_scenes, n_classes))
-    scene_number_count = np.zeros(n_scenes)
 
     sensitivity = np.zeros((n_scenes, n_classes))
     specificity = np.zeros((n_scenes, n_classes))
 
-    for scene_instance_id in sorted(list(scene_instance_ids_metrics_dict.keys())):
-        metrics = scene_instance_ids_metrics_dict[scene_instance_id]
-
-        scene_number = get_scene_number_from_scene_instance_id(scene_instance_id)
-        scene_number -= 1
-
-        metrics /= np.sum(metrics, axis=1, keepdims=True)
-        scene_number_class_accuracies_metrics[scene_number] += metrics
-
-        scene_number_count[scene_number] += 1
-
     assert np.all(scene_number_class_accuracies_metrics[scene_number_count == 0] == 0), 'error in scene_number_count'
 
     vs = scene_number_count != 0    # valid scenes
@@ -247,6 +357,65 @@ def calculate_accuracy_final(class_accuracies):
         return tuple(final_accuracies)
 
 
+def test_calc_batch_metrics():
+    np.random.seed(1)
+    shape = (20, 100, 13)
+    mask_val = -1
+
+    y_true = np.random.choice([0, 1], shape).astype(np.float32)
+    pad = np.tile(np.random.choice([True, False], (shape[0], shape[1], 1)), shape[2])
+    y_pred = np.abs(y_true - np.random.choice([0, 1, 1], shape)).astype(np.float32)
+    y_true[pad] = mask_val
+    y_true_ids = np.tile(np.random.choice([10001, 10002, 20001, 790005], (shape[0], shape[1], 1)), shape[2])
+    y_true_ids = y_true_ids.astype(np.float32)
+    y_true_ids[pad] = mask_val
+    y_true = np.stack([y_true, y_true_ids], axis=3)
+
+    ids, batch_metrics = calc_batch_metrics(y_pred, y_true, mask_val)
+    ids_bincount, batch_metrics_bincount = calc_batch_metrics_bincount(y_pred, y_true, mask_val)
+    assert np.all(ids == ids_bincount) and np.allclose(batch_metrics, batch_metrics_bincount)
+
+    for i, scene_instance_id in enumerate(ids):
+        extracted = y_true[:, :, 0, 1] == scene_instance_id
+        t = y_true[extracted, :, 0]
+        p = y_pred[extracted, :]
+        unmasked = t != mask_val
+        expected = np.stack((np.sum((p == 1) & (t == 1), axis=0), np.sum((p == 0) & (t == 1), axis=0),
+                             np.sum((p == 0) & (t == 0) & unmasked, axis=0), np.sum((p == 1) & (t == 0), axis=0)),
+                            axis=1)
+        assert np.all(batch_metrics[i] == expected)
+
+
+def test_scene_instance_metrics_accumulator():
+    np.random.seed(1)
+    shape = (20, 100, 13)
+    mask_val = -1
+    all_ids = np.array([s * 1e4 + i for s in range(1, 81) for i in range(1, 10)])
+
+    scene_instance_id_metrics_dict = dict()
+    accumulator = SceneInstanceMetricsAccumulator(all_ids)
+    for _ in range(10):
+        y_true = np.random.choice([0, 1], shape).astype(np.float32)
+        pad = np.tile(np.random.choice([True, False], (shape[0], shape[1], 1)), shape[2])
+        y_pred = np.abs(y_true - np.random.choice([0, 1, 1], shape)).astype(np.float32)
+        y_true[pad] = mask_val
+        y_true_ids = np.tile(np.random.choice(all_ids, (shape[0], shape[1], 1)), shape[2]).astype(np.float32)
+        y_true_ids[pad] = mask_val
+        y_true = np.stack([y_true, y_true_ids], axis=3)
+        calculate_class_accuracies_metrics_per_scene_instance_in_batch(scene_instance_id_metrics_dict,
+                                                                       y_pred, y_true, mask_val)
+        calculate_class_accuracies_metrics_per_scene_instance_in_batch(accumulator, y_pred, y_true, mask_val)
+
+    merged = SceneInstanceMetricsAccumulator(all_ids[:10]).merge(accumulator)
+    assert merged.to_dict().keys() == scene_instance_id_metrics_dict.keys()
+
+    r_dict = val_accuracy(scene_instance_id_metrics_dict, ret=('final', 'per_class', 'per_scene'))
+    r_accumulator = val_accuracy(merged, ret=('final', 'per_class', 'per_scene'))
+    for v_dict, v_accumulator in zip(r_dict, r_accumulator):
+        assert np.allclose(v_dict, v_accumulator, equal_nan=True)
+    return r_accumulator[:2]
+
+
 def test_val_accuracy(with_wrong_predictions=False):
     np.random.seed(1)
     n_scenes = 80
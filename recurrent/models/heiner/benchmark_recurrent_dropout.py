@@ -0,0 +1,65 @@
+import argparse
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from keras import backend as K
+from keras.layers import Dense, Input
+from keras.models import Model
+from keras.optimizers import Adam
+
+import model_extension as m_ext
+from train_utils import Phase
+
+
+def build_model(batch_size, time_steps, units_per_layer, recurrent_dropout, recurrent_dropout_mode, features=160,
+                classes=13):
+    x = Input(batch_shape=(batch_size, time_steps, features), name='Input', dtype='float32')
+    y = x
+    for units in units_per_layer:
+        y = m_ext.recurrent_layer(units, recurrent_dropout, recurrent_dropout_mode,
+                                  return_sequences=True, stateful=True)(y)
+    y = Dense(classes, activation='linear')(y)
+    model = Model(x, y)
+    model.compile(optimizer=Adam(lr=0.001, clipnorm=1.), loss='binary_crossentropy', sample_weight_mode='temporal')
+    return model
+
+
+def random_batch(batch_size, time_steps, features=160, classes=13):
+    b_x = np.random.normal(0, 1, (batch_size, time_steps, features)).astype(np.float32)
+    b_y = np.random.binomial(1, 0.3, (batch_size, time_steps, classes)).astype(np.float32)
+    return b_x, b_y
+
+
+def time_train_steps(model, recurrent_dropout, recurrent_dropout_mode, batches):
+    # numpy: the same calls as Phase.run (drop before, load the updated original weights after each batch)
+    phase = SimpleNamespace(model=model, recurrent_dropout=recurrent_dropout)
+    start = time.time()
+    for b_x, b_y in batches:
+        if recurrent_dropout_mode == 'numpy':
+            original_weights_and_masks = Phase._recurrent_dropout(phase)
+        m_ext.train_and_predict_on_batch(model, b_x, b_y, calc_global_gradient_norm=False)
+        if recurrent_dropout_mode == 'numpy':
+            Phase._load_original_weights_updated(phase, original_weights_and_masks)
+    return (time.time() - start) / len(batches)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batchsize', type=int, default=64)
+    parser.add_argument('-t', '--timesteps', type=int, default=1000)
+    parser.add_argument('-u', '--units', type=int, nargs='+', default=[581, 581, 581])
+    parser.add_argument('-rd', '--recurrent_dropout', type=float, default=0.25)
+    parser.add_argument('-n', '--batches', type=int, default=20)
+    args = parser.parse_args()
+
+    np.random.seed(1)
+    batches = [random_batch(args.batchsize, args.timesteps) for _ in range(args.batches)]
+    for mode in m_ext.RECURRENT_DROPOUT_MODES:
+        K.clear_session()
+        model = build_model(args.batchsize, args.timesteps, args.units, args.recurrent_dropout, mode)
+        # first batch builds the train function
+        time_train_steps(model, args.recurrent_dropout, mode, batches[:1])
+        seconds = time_train_steps(model, args.recurrent_dropout, mode, batches[1:])
+        print('recurrent dropout {}: {:.3f} s per batch ({})'.format(mode, seconds,
+                                                                 'gpu' if m_ext.gpu_available() else 'cpu'))
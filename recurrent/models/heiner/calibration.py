@@ -0,0 +1,234 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import time
+from copy import deepcopy
+from os import path
+
+import numpy as np
+import portalocker
+
+import utils
+
+# keras, tensorflow and the dataloader are imported by the measurements only, which run in a spawned child process
+
+CANDIDATE_BATCH_SIZES = (16, 32, 64, 128, 256)
+
+# buffers of the hosts in utils are given for 1000 time steps
+REF_TIME_STEPS = 1000
+MAX_BUFFER = 200
+
+# share of the available memory for the buffers of the train and validation dataloader
+MEMORY_FRACTION = 0.5
+N_LOADERS = 2
+
+CACHE_PATH = path.join(path.expanduser('~'), '.cache', 'binaural_audition', 'calibration.json')
+# seconds to wait for the calibration of another process (the gpus of a machine start together)
+LOCK_TIMEOUT = 3600
+
+
+def available_memory_bytes():
+    try:
+        with open('/proc/meminfo') as handle:
+            for line in handle:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def buffer_memory_bytes(batch_size, buffer, time_steps, features=160, classes=13):
+    # DataLoader.buffer_x (float32 features) and buffer_y (float32 labels and scene instance ids)
+    return batch_size * buffer * time_steps * (features + 2 * classes) * 4
+
+
+def feasible_buffer(batch_size, time_steps, memory_bytes, features=160, classes=13):
+    # largest buffer (in units of time_steps) of both dataloaders within the memory budget, 0 -> not feasible
+    budget = MEMORY_FRACTION * memory_bytes / N_LOADERS
+    buffer = int(budget // buffer_memory_bytes(batch_size, 1, time_steps, features, classes))
+    return min(buffer, MAX_BUFFER * REF_TIME_STEPS // time_steps)
+
+
+def cache_key(h):
+    # per machine (and gpu, set by run_gpu) and everything the measurements depend on
+    return '|'.join(str(part) for part in (platform.node(), os.environ.get('CUDA_VISIBLE_DEVICES', ''), h.TIME_STEPS,
+                                           utils.model_time_steps(h), h.N_FEATURES, list(h.UNITS_PER_LAYER_LSTM),
+                                           list(h.UNITS_PER_LAYER_MLP), h.RECURRENT_DROPOUT_MODE))
+
+
+def load_cache(cache_path=CACHE_PATH):
+    if not path.exists(cache_path):
+        return dict()
+    with open(cache_path) as handle:
+        return json.load(handle)
+
+
+def _save_to_cache(key, calibration, cache_path):
+    # with the lock of the cache held (calibration_for) -> no concurrent update is lost
+    cache = load_cache(cache_path)
+    cache[key] = calibration
+    with open(cache_path + '.tmp', 'w') as handle:
+        json.dump(cache, handle, indent=1, sort_keys=True)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def train_step_throughput(h, batch_size, time_steps, n_steps=5):
+    '''
+    Frames per second of train_and_predict_on_batch (forward and backward) of the model of h with batch_size.
+    None if it does not fit into the (gpu) memory.
+    '''
+    from keras import backend as K
+
+    import model_cache
+    import model_extension as m_ext
+
+    h = deepcopy(h)
+    h.BATCH_SIZE = batch_size
+    b_x = np.random.normal(0, 1, (batch_size, time_steps, h.N_FEATURES)).astype(np.float32)
+    b_y = np.random.binomial(1, 0.3, (batch_size, time_steps, h.N_CLASSES)).astype(np.float32)
+    sample_weight = np.ones((batch_size, time_steps), dtype=np.float32)
+    try:
+        model = model_cache.CachedModel(h, time_steps, np.ones(h.N_CLASSES)).model
+        # first step builds the train function
+        m_ext.train_and_predict_on_batch(model, b_x, b_y, sample_weight=sample_weight, calc_global_gradient_norm=False)
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            m_ext.train_and_predict_on_batch(model, b_x, b_y, sample_weight=sample_weight,
+                                             calc_global_gradient_norm=False)
+        return n_steps * batch_size * time_steps / (time.perf_counter() - start)
+    except (K.tf.errors.ResourceExhaustedError, MemoryError):
+        return None
+    finally:
+        K.clear_session()
+
+
+def loader_throughput(h, batch_size, buffer, time_steps, n_batches=20, path_pattern='/mnt/binaural/data/scenes2018/'):
+    # frames per second of DataLoader.next_batch (train folds of stage 1), None if the data is not there
+    if not path.exists(path_pattern):
+        return None
+    from dataloader import DataLoader
+
+    train_folds = [fold for fold in range(1, 7) if fold not in h.VAL_FOLDS]
+    loader = DataLoader('train', h.LABEL_MODE, train_folds, h.TRAIN_SCENES, batchsize=batch_size,
+                        timesteps=time_steps, epochs=1, buffer=buffer, features=h.N_FEATURES, classes=h.N_CLASSES,
+                        path_pattern=path_pattern)
+    start = time.perf_counter()
+    n = 0
+    try:
+        for _ in range(n_batches):
+            if loader.next_batch()[0] is None:
+                break
+            n += 1
+    finally:
+        loader.close()
+    if n == 0:
+        return None
+    return n * batch_size * time_steps / (time.perf_counter() - start)
+
+
+def calibrate(h, candidate_batch_sizes=CANDIDATE_BATCH_SIZES, measure_loader=True, n_steps=5):
+    '''
+    Measures the candidate batch sizes (ascending, stops at the first which does not fit into memory) for the model of
+    h: buffer within the memory budget, frames per second of a train step and of the dataloader. Returns the
+    calibration of the highest throughput (min of model and dataloader) with all measured candidates.
+
+    The model is measured with the time steps it is trained with (utils.model_time_steps, as run_hcomb_cv), the
+    dataloaders (buffer and throughput) with h.TIME_STEPS which they read. The throughputs are frames of the data.
+    '''
+    time_steps = h.TIME_STEPS
+    model_time_steps = utils.model_time_steps(h)
+    memory_bytes = available_memory_bytes()
+    candidates = []
+    for batch_size in sorted(candidate_batch_sizes):
+        buffer = feasible_buffer(batch_size, time_steps, memory_bytes, h.N_FEATURES, h.N_CLASSES)
+        if buffer < 1:
+            break
+        model_fps = train_step_throughput(h, batch_size, model_time_steps, n_steps)
+        if model_fps is None:
+            break
+        model_fps *= time_steps / model_time_steps
+        loader_fps = loader_throughput(h, batch_size, buffer, time_steps) if measure_loader else None
+        candidates.append({'batch_size': batch_size, 'buffer': buffer, 'model_frames_per_sec': model_fps,
+                           'loader_frames_per_sec': loader_fps,
+                           'frames_per_sec': model_fps if loader_fps is None else min(model_fps, loader_fps)})
+    if len(candidates) == 0:
+        raise ValueError('Not even batch size {} fits into the memory of {}.'.format(min(candidate_batch_sizes),
+                                                                                      platform.node()))
+    best = max(candidates, key=lambda candidate: candidate['frames_per_sec'])
+    return dict(best, memory_bytes=memory_bytes, candidates=candidates)
+
+
+def _calibrate_to_pipe(h, pipe_send_end, kwargs):
+    pipe_send_end.send(calibrate(h, **kwargs))
+
+
+def calibration_for(h, cache_path=CACHE_PATH, **kwargs):
+    '''
+    Cached calibration of this machine for h, calibrated first if there is none. The measurements run in a spawned
+    child process: tensorflow keeps the gpu memory until its process ends and the caller (keras_model_run) has
+    imported keras already. One calibration at a time: the measurements of concurrent ones would compete for the
+    memory, a process waiting for the lock finds the result in the cache.
+    '''
+    key = cache_key(h)
+    cache = load_cache(cache_path)
+    if key in cache:
+        return cache[key]
+
+    os.makedirs(path.dirname(cache_path), exist_ok=True)
+    with portalocker.Lock(cache_path + '.lock', mode='a', timeout=LOCK_TIMEOUT):
+        cache = load_cache(cache_path)
+        if key in cache:
+            return cache[key]
+
+        print('Calibrating batch size and buffer of {} for time steps {} ...'.format(platform.node(), h.TIME_STEPS))
+        context = multiprocessing.get_context('spawn')
+        recv_end, send_end = context.Pipe(False)
+        p_calibration = context.Process(target=_calibrate_to_pipe, args=(h, send_end, kwargs))
+        p_calibration.start()
+        send_end.close()
+        p_calibration.join()
+        if p_calibration.exitcode != 0 or not recv_end.poll():
+            raise RuntimeError('Calibration failed (exitcode {}).'.format(p_calibration.exitcode))
+        calibration = recv_end.recv()
+        _save_to_cache(key, calibration, cache_path)
+    print('Batch size: {}, buffer: {} ({:.0f} frames/s).'.format(calibration['batch_size'], calibration['buffer'],
+                                                                 calibration['frames_per_sec']))
+    return calibration
+
+
+def cached_buffer(h, cache_path=CACHE_PATH):
+    # buffer of the calibration for h.BATCH_SIZE, else the feasible buffer for the memory available now
+    for candidate in load_cache(cache_path).get(cache_key(h), dict()).get('candidates', []):
+        if candidate['batch_size'] == h.BATCH_SIZE:
+            return candidate['buffer']
+    return max(1, feasible_buffer(h.BATCH_SIZE, h.TIME_STEPS, available_memory_bytes(), h.N_FEATURES, h.N_CLASSES))
+
+
+if __name__ == '__main__':
+    import hyperparameters as hp
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-ts', '--time_steps',
+                        type=int,
+                        default=1000,
+                        metavar="<time steps>")
+    parser.add_argument('-u', '--units',
+                        type=int,
+                        nargs='+',
+                        default=[581, 581, 581],
+                        metavar="<units per lstm layer>")
+    parser.add_argument('-g', '--gpu',
+                        type=str,
+                        default=None,
+                        metavar="<gpu>")
+    parser.add_argument('--no_loader',
+                        action='store_true',
+                        help="Skip the dataloader measurement.")
+    args = parser.parse_args()
+    if args.gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    h = hp.H(TIME_STEPS=args.time_steps, UNITS_PER_LAYER_LSTM=args.units)
+    print(json.dumps(calibration_for(h, measure_loader=not args.no_loader), indent=1))
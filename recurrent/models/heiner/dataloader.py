@@ -1,12 +1,26 @@
 import numpy as np
 import glob
+import hashlib
+import os
 from os import path
 from collections import deque
 import random
 import pickle
 import heapq
-import re
-from tqdm import tqdm
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import portalocker
+
+from input_standardization import create_input_standardization_metrics
+from bucketing import LengthBucketSampler  # common/bucketing.py, need to have common in PYTHONPATH
+from metadata_index import MetadataIndex
+from scene_instance_store import SceneInstanceStore, load_scene_instance
+
+# columns of DataLoader.plan_epoch: placement of file[file_offset:file_offset+(buffer_end-buffer_start)]
+# at buffer[row, buffer_start:buffer_end] in the fill_id-th filling of the buffer
+PLAN_COLUMNS = ('fill_id', 'row', 'buffer_start', 'buffer_end', 'file_ind', 'file_offset')
+
 
 class DataLoader:
 
@@ -15,11 +29,13 @@ class DataLoader:
                  seed=1, seed_by_epoch=True, priority_queue=True, use_every_timestep=False, mask_val=-1.0,
                  val_stateful=False, k_scenes_to_subsample=-1,
                  input_standardization=True,
-                 use_multithreading=False, val_fold3_as_test=False):
+                 use_multithreading=False, val_fold3_as_test=False, use_packed_store=True,
+                 n_io_workers=0, io_backend='threads', test_stateful=False):
 
         self.mode = mode
         self.path_pattern = path_pattern
         self.fold_nbs = fold_nbs
+        self.scene_nbs = scene_nbs
 
 
         if not (self.mode == 'train' or self.mode == 'test' or self.mode == 'val'):
@@ -34,6 +50,11 @@ class DataLoader:
         self.pickle_path = self.path_pattern
         self.pickle_path_pattern = self.path_pattern
 
+        # memory-mapped uncompressed data (cf. scene_instance_store.py), fallback are the compressed npz files
+        self.store = None
+        if use_packed_store and SceneInstanceStore.exists(self.pickle_path):
+            self.store = SceneInstanceStore(self.pickle_path)
+
         if not (type(fold_nbs) is list or type(fold_nbs) is int):
             raise TypeError('fold_nbs has to be a list of ints or -1')
         if fold_nbs == -1:
@@ -74,7 +95,11 @@ class DataLoader:
 
         self.mask_val = mask_val
         self.val_stateful = val_stateful
+        # test scene instances chunked into (batchsize, timesteps) batches like the stateful validation (instead of
+        # one whole scene instance per batch)
+        self.test_stateful = self.mode == 'test' and test_stateful
 
+        self.metadata_index = None
         self.length_dict = None
         self.scene_instance_ids_dict = None
 
@@ -82,6 +107,10 @@ class DataLoader:
 
         self.input_standardization = input_standardization
         self.input_standardization_metrics = None
+        self.input_standardization_factors = None
+        # train and stateful val: standardized once when the scene instances are written into the buffer
+        # (instead of each returned batch, which are views on the buffer)
+        self.standardize_in_buffer = False
 
         self.train_on_all_folds = False
 
@@ -90,6 +119,21 @@ class DataLoader:
         if self.use_multithreading:
             self.copy_on_return_before_refill = True
 
+        # threads or processes (cf. decode_pool.py) reading (and decompressing) the next files of the queue
+        # while the buffer is filled
+        if io_backend not in ('threads', 'processes'):
+            raise ValueError("io_backend has to be 'threads' or 'processes'")
+        self.io_pool = None
+        self.read_ahead = dict()    # filename -> future
+        if n_io_workers > 0:
+            if io_backend == 'threads':
+                self.io_pool = ThreadPoolExecutor(max_workers=n_io_workers)
+            else:
+                from decode_pool import DecodePool
+                self.io_pool = DecodePool(n_io_workers,
+                                          store_location=self.pickle_path if self.store is not None else None)
+            self.n_read_ahead = 4 * n_io_workers
+
         if self.mode != 'test' and self.input_standardization:
             if type(self.fold_nbs) is int:
                 raise ValueError('input standardization can for now just be applied if only ONE val_fold is used')
@@ -119,7 +163,7 @@ class DataLoader:
         self.features = features
         self.classes = classes
 
-        if self.mode == 'train' or (self.mode == 'val' and val_stateful):
+        if self.mode == 'train' or (self.mode == 'val' and val_stateful) or self.test_stateful:
             if self.mode == 'train':
                 self.val_stateful = False
             else:
@@ -136,6 +180,7 @@ class DataLoader:
             self.buffer_size = buffer * timesteps
 
             self.priority_queue = priority_queue
+            self.standardize_in_buffer = self.input_standardization
             self._init_buffers()
 
             self.length = None
@@ -153,29 +198,50 @@ class DataLoader:
                 self.epochs = epochs
                 self.act_epoch = 1
 
-                self.length = [int(np.ceil(len(self.filenames) / self.batchsize))]
-                self._data_efficiency = [1.0]
+                # batches of similarly long scene instances (padded to the longest one, cf. bucketing.py)
+                self.val_sampler = LengthBucketSampler(self.metadata_index_().lengths(self.filenames,
+                                                                                      self.instant_mode),
+                                                       self.batchsize)
+                self.val_batch_filenames = [[self.filenames[i] for i in batch] for batch in self.val_sampler]
+                self.filenames = [self.filenames[i] for i in self.val_sampler.order]
+                self.val_batches = self._create_val_batches()
+
+                self.length = [len(self.val_sampler)]
+                # the efficiency is the part of the (batchsize x longest scene instance) batches which is not padding
+                self._data_efficiency = [self.val_sampler.efficiency(fixed_batchsize=True)]
                 if self.epochs > 1:
                     self.act_epoch = 1
                     self.length = self.length * self.epochs
                     self._data_efficiency = self._data_efficiency * self.epochs
 
-                length_tuples = [(self.length_dict_()[fn], fn) for fn in self.filenames]
-                self.filenames = [tup[1] for tup in sorted(length_tuples, key=lambda x: x[0], reverse=True)]
-                self.filenames_deque = deque(self.filenames)
+    def _create_val_batches(self):
+        return deque(self.val_batch_filenames)
 
-    def _input_standardization_if_wanted(self, x):
+    def _input_standardization_if_wanted(self, x, out=None):
+        # (x - mean) / std fused to x * inv_std + shift in float32; in place if no out is given
+        if out is None:
+            out = x
         if self.input_standardization:
-            mean, std = self._input_standardization_metrics()
-            x -= mean
-            x /= std
-        return x
+            inv_std, shift = self._input_standardization_factors()
+            np.multiply(x, inv_std, out=out)
+            out += shift
+        elif out is not x:
+            np.copyto(out, x)
+        return out
 
     def _input_standardization_metrics(self):
         if self.input_standardization_metrics is None:
             self.input_standardization_metrics = self._load_input_standardization_metrics()
         return self.input_standardization_metrics
 
+    def _input_standardization_factors(self):
+        if self.input_standardization_factors is None:
+            mean, std = self._input_standardization_metrics()
+            inv_std = 1. / np.reshape(std, -1)
+            self.input_standardization_factors = (inv_std.astype(np.float32),
+                                                  (-np.reshape(mean, -1) * inv_std).astype(np.float32))
+        return self.input_standardization_factors
+
     def _load_input_standardization_metrics(self):
         name = 'input_standardization_metrics{}.pickle'.format('_all_train_folds' if self.train_on_all_folds else '')
         in_std_path = path.join(self.pickle_path, name)
@@ -193,62 +259,16 @@ class DataLoader:
             return (means[val_fold-1], stds[val_fold-1])
 
     def _create_input_standardization_metrics_pickle(self):
-        def calc_mean_std(in_std_path):
-            if type(in_std_path) is list:
-                all_existing_files = []
-                for in_std_path_inner in in_std_path:
-                    all_existing_files += glob.glob(in_std_path_inner)
-            else:
-                all_existing_files = glob.glob(in_std_path)
-
-            N = 0
-            sum = np.zeros((1, self.features))
-            sum_sq = np.zeros((1, self.features))
-
-            for file in tqdm(all_existing_files):
-                with np.load(file) as data:
-                    N += data['x'].shape[1]
-                    sum += np.sum(data['x'], axis=1)
-                    sum_sq += np.sum(data['x']**2, axis=1)
-
-            mean = sum / N
-            var = sum_sq / N - mean**2
-            std = np.sqrt(var)
-            mean = mean[np.newaxis, :, :]
-            std = std[np.newaxis, :, :]
-
-            return (mean, std)
-
-        in_std_path = self.pickle_path
-        if self.mode == 'test' or self.train_on_all_folds:
+        # one pass over all training folds creates the per validation fold, all train folds and test pickles
+        if self.mode == 'test':
             # calculate from all training data here
-            if not self.train_on_all_folds:
-                in_std_path = in_std_path.replace('test', 'train')
-            in_std_path = path.join(in_std_path, 'fold*', 'scene*', '*.npz')
-
-
-            metrics = calc_mean_std(in_std_path)
-
+            train_path = self.pickle_path.replace('test', 'train')
+            test_paths = [self.pickle_path]
         else:
-            all_folds = list(range(1, 7))
-            means = []
-            stds = []
-            for val_fold in all_folds:
-                used_folds = list(set(all_folds)-{val_fold})
-
-                in_std_path_loop_list = []
-                for used_fold in used_folds:
-                    in_std_path_loop_list.append(path.join(in_std_path, 'fold'+str(used_fold), 'scene*', '*.npz'))
-
-                mean, std = calc_mean_std(in_std_path_loop_list)
-                means.append(mean)
-                stds.append(std)
-
-            metrics = (means, stds)
-
-        name = 'input_standardization_metrics{}.pickle'.format('_all_train_folds' if self.train_on_all_folds else '')
-        with open(path.join(self.pickle_path, name), 'wb') as handle:
-            pickle.dump(metrics, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            train_path = self.pickle_path
+            test_path = path.join(path.dirname(path.normpath(self.pickle_path)), 'test')
+            test_paths = [test_path] if path.exists(test_path) else []
+        create_input_standardization_metrics(train_path, test_paths, features=self.features)
 
 
 
@@ -275,10 +295,7 @@ class DataLoader:
         else:
             used_labels = np.array(self.effective_len())
             used_labels *= self.batchsize * self.timesteps
-            available_labels = 0
-            length_dict = self.length_dict_()
-            for filename in self.filenames:
-                available_labels += length_dict[filename]
+            available_labels = np.sum(self.metadata_index_().lengths(list(self.filenames), self.instant_mode))
             self._data_efficiency = used_labels / available_labels
             return self._data_efficiency
 
@@ -302,7 +319,10 @@ class DataLoader:
             self.file_ind_queue = self._create_deque()
         else:
             self.file_ind_queue = self._create_deque(shuffle=False)
+        self.buffer_placements = []
         self.buffer_x = np.zeros((self.batchsize, self.buffer_size, self.features), np.float32)
+        if self.standardize_in_buffer:
+            self.buffer_x[:] = self._input_standardization_factors()[1]
 
         # last dimension: 0 -> labels, 1 -> scene_instance_id (scheme: scene_number * 1e4 + id in scene)
         self.buffer_y = np.full((self.batchsize, self.buffer_size, self.classes, 2), self.mask_val, np.float32)
@@ -324,11 +344,21 @@ class DataLoader:
             self.file_ind_queue = self._create_deque(shuffle=False)
         self.row_leftover[:, 0] = -1
         self.row_leftover[:, 1] = 0
+        self.read_ahead.clear()
         self._clear_buffers()
 
     def _clear_buffers(self):
-        self.buffer_x[:] = 0
+        if self.standardize_in_buffer:
+            # standardized zeros (padding)
+            self.buffer_x[:] = self._input_standardization_factors()[1]
+        else:
+            self.buffer_x[:] = 0
         self.buffer_y[:] = self.mask_val
+        # placements copied since the last clearing, i.e. the content of the buffer (cf. load_state_dict)
+        self.buffer_placements = []
+        self._clear_buffer_positions()
+
+    def _clear_buffer_positions(self):
         self.row_start = 0
         self.row_lengths[:] = 0
 
@@ -341,69 +371,227 @@ class DataLoader:
 
     def _fill_in_new_sequence(self, row_ind):
         if len(self.file_ind_queue) == 0:
-            return
+            return None
         act_file_ind = self.file_ind_queue.popleft()
-        self._parse_sequence(row_ind, act_file_ind, 0)
+        return self._place_sequence(row_ind, act_file_ind, 0)
 
     def _fill_in_divided_sequence(self, row_ind):
         act_file_ind = self.row_leftover[row_ind, 0]
         leftover = self.row_leftover[row_ind, 1]
         self.row_leftover[row_ind] = [-1, 0]
-        self._parse_sequence(row_ind, act_file_ind, leftover)
+        return self._place_sequence(row_ind, act_file_ind, leftover)
+
+    def _load_scene_instance(self, filename):
+        labels_key = 'y' if self.instant_mode else 'y_block'
+        data = load_scene_instance(filename, ('x', labels_key), store=self.store)
+        return data['x'], data[labels_key]
+
+    def _submit_read(self, filename):
+        if isinstance(self.io_pool, ThreadPoolExecutor):
+            return self.io_pool.submit(self._load_scene_instance, filename)
+        return self.io_pool.submit(filename, ('x', 'y' if self.instant_mode else 'y_block'))
+
+    def close(self):
+        # shuts down the threads / processes reading ahead, the loader reads the files itself afterwards
+        if self.io_pool is not None:
+            self.io_pool.shutdown()
+            self.io_pool = None
+        # the futures of a DecodePool free their (unused) shared memory blocks
+        self.read_ahead.clear()
+
+    def _schedule_read_ahead(self, filenames):
+        for filename in filenames:
+            if filename not in self.read_ahead:
+                self.read_ahead[filename] = self._submit_read(filename)
+
+    def _load_scene_instance_read_ahead(self, filename, next_filenames=()):
+        if self.io_pool is None:
+            return self._load_scene_instance(filename)
+        self._schedule_read_ahead(next_filenames)
+        future = self.read_ahead.pop(filename, None)
+        if future is None:
+            return self._load_scene_instance(filename)
+        return future.result()
+
+    def _place_sequence(self, row_ind, act_file_ind, leftover):
+        # updates the buffer positions only, returns the placement (row, buffer start, buffer end, file, file offset)
+        # which is copied by _copy_placements
+        sequence_length = self.length_dict_()[self.filenames[act_file_ind]]
+        start = self.row_lengths[row_ind]
+        if leftover != 0:
+            start_in_sequence = sequence_length - leftover
+        else:
+            start_in_sequence = 0
+        end = start + sequence_length - start_in_sequence
+        if end > self.buffer_size:
+            self.row_leftover[row_ind] = [act_file_ind, end - self.buffer_size]
+            end = self.buffer_size
 
-    def _parse_sequence(self, row_ind, act_file_ind, leftover):
-        with np.load(self.filenames[act_file_ind]) as data:
-            sequence = data['x']
-            labels = data['y'] if self.instant_mode else data['y_block']
-            sequence_length = sequence.shape[1]
-            start = self.row_lengths[row_ind]
-            if leftover != 0:
-                start_in_sequence = sequence_length - leftover
+        self.row_lengths[row_ind] = end
+        if self.val_stateful and self.row_lengths[row_ind] < self.buffer_size:
+            self.row_lengths[row_ind] = int(np.ceil(self.row_lengths[row_ind] / self.timesteps)) * self.timesteps
+        return row_ind, start, end, act_file_ind, start_in_sequence
+
+    def _copy_placements(self, placements):
+        if len(placements) == 0:
+            return
+
+        self.buffer_placements += placements
+        filenames = [self.filenames[act_file_ind] for _, _, _, act_file_ind, _ in placements]
+        scene_instance_ids = self.metadata_index_().ids(filenames)
+
+        next_filenames = ()
+        if self.io_pool is not None:
+            # all files of the placements at once, then the next ones of the queue
+            self._schedule_read_ahead(filenames)
+            next_filenames = [self.filenames[file_ind]
+                              for file_ind in itertools.islice(self.file_ind_queue, self.n_read_ahead)]
+
+        for (row_ind, start, end, act_file_ind, start_in_sequence), filename, scene_instance_id in \
+                zip(placements, filenames, scene_instance_ids):
+            sequence, labels = self._load_scene_instance_read_ahead(filename, next_filenames)
+            stop_in_sequence = start_in_sequence + (end - start)
+            if stop_in_sequence > sequence.shape[1]:
+                raise ValueError('{}: placement up to frame {} but only {} frames of x (label length {}).'
+                                 .format(filename, stop_in_sequence, sequence.shape[1],
+                                         self.length_dict_()[filename]))
+            if self.io_pool is not None and stop_in_sequence < sequence.shape[1]:
+                # the rest is needed after the next clearing of the buffer
+                self._schedule_read_ahead([filename])
+
+            if self.standardize_in_buffer:
+                self._input_standardization_if_wanted(sequence[0, start_in_sequence:stop_in_sequence, :],
+                                                      out=self.buffer_x[row_ind, start:end, :])
             else:
-                start_in_sequence = 0
-            end = start + sequence_length - start_in_sequence
-            if end > self.buffer_size:
-                self.row_leftover[row_ind] = [act_file_ind, end - self.buffer_size]
-                end = self.buffer_size
-            self.buffer_x[row_ind, start:end, :] = sequence[:, start_in_sequence:start_in_sequence+(end - start), :]
+                self.buffer_x[row_ind, start:end, :] = sequence[:, start_in_sequence:stop_in_sequence, :]
 
             if len(labels.shape) == 3:
                 bs, _, ncl = labels.shape
                 if bs == 1 and ncl == self.classes:
-                    self.buffer_y[row_ind, start:end, :, 0] = labels[:, start_in_sequence:start_in_sequence+(end - start), :]
+                    self.buffer_y[row_ind, start:end, :, 0] = labels[:, start_in_sequence:stop_in_sequence, :]
             else:
                 if self.instant_mode:
-                    self.buffer_y[row_ind, start:end, :, 0] = \
-                        labels[:, start_in_sequence:start_in_sequence + (end - start)].T
+                    self.buffer_y[row_ind, start:end, :, 0] = labels[:, start_in_sequence:stop_in_sequence].T
                 else:
                     flat_steps, _ = labels.shape
                     labels = labels.reshape((self.classes, flat_steps // self.classes))
-                    self.buffer_y[row_ind, start:end, :, 0] = \
-                        labels[:, start_in_sequence:start_in_sequence + (end - start)].T
+                    self.buffer_y[row_ind, start:end, :, 0] = labels[:, start_in_sequence:stop_in_sequence].T
 
-        scene_instance_id = self.scene_instance_ids_dict_()[self.filenames[act_file_ind]]
-        self.buffer_y[row_ind, start:end, :, 1] = scene_instance_id
-        self.row_lengths[row_ind] = end
-        if self.val_stateful and self.row_lengths[row_ind] < self.buffer_size:
-            self.row_lengths[row_ind] = int(np.ceil(self.row_lengths[row_ind] / self.timesteps)) * self.timesteps
+            self.buffer_y[row_ind, start:end, :, 1] = scene_instance_id
 
-    def fill_buffer(self):
+    def _parse_sequence(self, row_ind, act_file_ind, leftover):
+        self._copy_placements([self._place_sequence(row_ind, act_file_ind, leftover)])
+
+    def _fill_buffer_placements(self, placements):
         filled = True
         for row_ind in range(self.batchsize):
             stopping_condition = self.row_lengths[row_ind] >= self.buffer_size
             if not stopping_condition:
                 if self.row_leftover[row_ind, 0] != -1:
-                    self._fill_in_divided_sequence(row_ind)
+                    placement = self._fill_in_divided_sequence(row_ind)
                 else:
                     if self.priority_queue:
                         _, row_ind = heapq.heappop(self.heap)
-                    self._fill_in_new_sequence(row_ind)
+                    placement = self._fill_in_new_sequence(row_ind)
                     if self.priority_queue:
                         heapq.heappush(self.heap, (self.row_lengths[row_ind] + self.row_leftover[row_ind, 1], row_ind))
+                if placement is not None:
+                    placements.append(placement)
                 if self.row_lengths[row_ind] < self.buffer_size:
                     filled = False
         return filled
 
+    def fill_buffer(self):
+        placements = []
+        filled = self._fill_buffer_placements(placements)
+        self._copy_placements(placements)
+        return filled
+
+    def _fill_until_filled(self):
+        placements = []
+        while not self._nothing_left():
+            filled = self._fill_buffer_placements(placements)
+            if self.priority_queue:
+                filled = self.heap[0][0] >= self.buffer_size
+            if filled:
+                break
+        return placements
+
+    def plan_epoch(self):
+        '''
+        Dry run of the buffer filling for the rest of the actual epoch (train and stateful val). Returns the placement
+        table (columns: PLAN_COLUMNS), i.e. which part of which file goes to which row and position of the buffer in
+        which filling of the buffer (fill_id). The state of the loader is not changed.
+        '''
+        saved = (self.file_ind_queue.copy(), self.row_leftover.copy(), self.row_lengths.copy(), self.row_start,
+                 list(self.heap) if self.priority_queue else None)
+        table = []
+        fill_id = 0
+        try:
+            while True:
+                if self.row_start == self.buffer_size:
+                    self._clear_buffer_positions()
+                    fill_id += 1
+                rows_lengths_available = (self.row_lengths - self.row_start)
+                if np.all(rows_lengths_available >= self.timesteps):
+                    self.row_start += self.timesteps
+                    continue
+                if self._nothing_left():
+                    if self.use_every_timestep and np.any(rows_lengths_available > 0):
+                        self.row_start += self.timesteps
+                        continue
+                    break
+                table += [(fill_id,) + tuple(placement) for placement in self._fill_until_filled()]
+        finally:
+            self.file_ind_queue, self.row_leftover, self.row_lengths, self.row_start, heap = saved
+            if self.priority_queue:
+                self.heap = heap
+        return np.array(table, dtype=np.int64).reshape((-1, len(PLAN_COLUMNS)))
+
+    def state_dict(self):
+        '''
+        Snapshot of everything which determines the next batches (random state, epoch, file queue, buffer positions,
+        heap and the placements of the actual buffer content), e.g. to resume in the middle of an epoch.
+        '''
+        if self.mode == 'test' and not self.test_stateful:
+            raise ValueError('state_dict is available for training, validation or stateful test loaders only.')
+        state = {'mode': self.mode,
+                 'random_state': random.getstate(),
+                 'act_epoch': self.act_epoch,
+                 'filenames': list(self.filenames)}
+        if self.mode == 'val' and not self.val_stateful:
+            state['val_batches'] = list(self.val_batches)
+            return state
+        state.update({'file_ind_queue': list(self.file_ind_queue),
+                      'row_leftover': self.row_leftover.copy(),
+                      'row_lengths': self.row_lengths.copy(),
+                      'row_start': self.row_start,
+                      'heap': list(self.heap) if self.priority_queue else None,
+                      'buffer_placements': list(self.buffer_placements)})
+        return state
+
+    def load_state_dict(self, state):
+        if state['mode'] != self.mode:
+            raise ValueError('state of a {} loader can not be loaded into a {} loader.'.format(state['mode'],
+                                                                                              self.mode))
+        random.setstate(state['random_state'])
+        self.act_epoch = state['act_epoch']
+        self.filenames = list(state['filenames'])
+        if self.mode == 'val' and not self.val_stateful:
+            self.val_batches = deque(state['val_batches'])
+            return
+
+        self.file_ind_queue = deque(state['file_ind_queue'])
+        self.read_ahead.clear()
+        self._clear_buffers()
+        # the buffer content is restored by copying the placements again (positions are part of the state)
+        self._copy_placements(list(state['buffer_placements']))
+        self.row_leftover[:] = state['row_leftover']
+        self.row_lengths[:] = state['row_lengths']
+        self.row_start = state['row_start']
+        if self.priority_queue:
+            self.heap = list(state['heap'])
+
     def _nothing_left(self):
         queue_empty = len(self.file_ind_queue) == 0
         no_leftover_rows = self.row_leftover[:, 0] == -1
@@ -428,6 +616,8 @@ class DataLoader:
                 ret = self._next_batch_val_not_stateful()
             else:
                 ret = self._next_batch_train_val_stateful()
+        elif self.test_stateful:
+            ret = self._next_batch_train_val_stateful()
         else:
             ret = self._next_batch_test()
         return ret
@@ -455,8 +645,8 @@ class DataLoader:
                 else:
                     keep_states = self.row_leftover[:, 0] != -1
                 keep_states = keep_states[:, np.newaxis]
-                return self._input_standardization_if_wanted(x), y, keep_states
-            return self._input_standardization_if_wanted(x), y
+                return x, y, keep_states
+            return x, y
 
         if self.row_start == self.buffer_size:
             self._clear_buffers()
@@ -474,25 +664,19 @@ class DataLoader:
                         return None, None, None
                     else:
                         return None, None
-            while not self._nothing_left():
-                filled = self.fill_buffer()
-                if self.priority_queue:
-                    filled = self.heap[0][0] >= self.buffer_size
-                if filled:
-                    break
-            # _ = self.fill_buffer()
+            self._copy_placements(self._fill_until_filled())
             return self._next_batch_train_val_stateful()
 
     def _next_batch_test(self):
         if len(self.filenames) > 0:
             filename = self.filenames.popleft()
-            with np.load(filename) as data:
-                sequence = data['x']
-                labels = data['y'] if self.instant_mode else data['y_block']
-                labels = np.stack([labels,
-                                   np.full(labels.shape, self.scene_instance_ids_dict_()[filename], dtype=np.float32)],
-                                  axis=3)
-                return self._input_standardization_if_wanted(sequence), labels
+            sequence, labels = self._load_scene_instance(filename)
+            labels = np.stack([labels,
+                               np.full(labels.shape, self.scene_instance_ids_dict_()[filename], dtype=np.float32)],
+                              axis=3)
+            # memory-mapped data is read-only -> standardize into a new array
+            out = None if sequence.flags.writeable else np.empty(sequence.shape, np.float32)
+            return self._input_standardization_if_wanted(sequence, out=out), labels
         else:
             return None, None
 
@@ -501,33 +685,29 @@ class DataLoader:
         '''
         Scene instances doesn't overlap -> padding is applied. With this it is possible to reset the state.
         '''
-        if len(self.filenames_deque) > 0:
-            max_length = self.length_dict_()[self.filenames_deque[0]]
+        if len(self.val_batches) > 0:
+            batch_filenames = self.val_batches.popleft()
+            max_length = max(self.length_dict_()[filename] for filename in batch_filenames)
             b_x = np.zeros((self.batchsize, max_length, self.features), np.float32)
 
             # last dimension: 0 -> labels, 1 -> scene_instance_id (scheme: scene_number * 1e4 + id in scene)
             b_y = np.full((self.batchsize, max_length, self.classes, 2), self.mask_val, np.float32)
 
-            r=0
-            while r < self.batchsize and len(self.filenames_deque) > 0:
-                next_filename = self.filenames_deque.popleft()
-                with np.load(next_filename) as data:
-                    sequence = data['x']
-                    length = sequence.shape[1]
-                    labels = data['y'] if self.instant_mode else data['y_block']
-                    b_x[r, :length, :] = sequence[0, :, :]
-                    b_y[r, :length, :, 0] = labels[0, :, :]
+            for r, next_filename in enumerate(batch_filenames):
+                sequence, labels = self._load_scene_instance(next_filename)
+                length = sequence.shape[1]
+                b_x[r, :length, :] = sequence[0, :, :]
+                b_y[r, :length, :, 0] = labels[0, :, :]
 
                 scene_instance_id = self.scene_instance_ids_dict_()[next_filename]
                 b_y[r, :length, :, 1] = scene_instance_id
-                r += 1
             return self._input_standardization_if_wanted(b_x), b_y
         else:
             self.act_epoch += 1
             if self.act_epoch > self.epochs:
                 return None, None
             else:
-                self.filenames_deque = deque(self.filenames)
+                self.val_batches = self._create_val_batches()
                 return self._next_batch_val_not_stateful()
 
     def len(self):
@@ -540,35 +720,30 @@ class DataLoader:
             self._calculate_length()
         return self.effective_length
 
-    def _calculate_length(self):
+    def _epoch_lengths_cache_key(self):
+        lengths = self.metadata_index_().lengths(self.filenames, self.instant_mode)
+        files_digest = hashlib.sha1(('\n'.join(self.filenames) + str(lengths.tolist())).encode()).hexdigest()
+        return (self.mode, self.instant_mode, str(self.fold_nbs), str(self.scene_nbs), self.batchsize, self.timesteps,
+                self.buffer_size, self.seed, self.seed_by_epoch, self.epochs, self.priority_queue,
+                self.use_every_timestep, self.val_stateful, files_digest)
 
-        def nothing_left_length(dq, left_lengths, sim_lengths):
-            queue_empty = len(dq) == 0
-            no_leftover_rows = left_lengths == 0
-            no_leftover_rows[sim_lengths == self.buffer_size] = True
-            no_leftover = np.all(no_leftover_rows)
-            return queue_empty and no_leftover
-
-        def add_to_length_until_buffersize(l, row):
-            sim_lengths[row] += l
-            leftover = sim_lengths[row] - self.buffer_size
-            if leftover > 0:
-                sim_lengths[row] = self.buffer_size
-                if self.val_stateful:
-                    return leftover, 0
-                return leftover
-            else:
-                if self.val_stateful and sim_lengths[row] < self.buffer_size:
-                    old_length = sim_lengths[row]
-                    sim_lengths[row] = int(np.ceil(sim_lengths[row] / self.timesteps)) * self.timesteps
-                    return 0, sim_lengths[row] - old_length     # second value are the skipped steps
-                if self.val_stateful:
-                    return 0, 0
-                return 0
+    def _calculate_length(self):
+        # subsampled scenes are drawn per epoch -> nothing to cache
+        use_cache = self.k_scenes_to_subsample == -1
+        cache_path = path.join(self.pickle_path, 'epoch_lengths.pickle')
+
+        if use_cache:
+            key = self._epoch_lengths_cache_key()
+            cache = dict()
+            if path.exists(cache_path):
+                with open(cache_path, 'rb') as handle:
+                    cache = pickle.load(handle)
+            if key in cache:
+                self.length, self.effective_length = (list(l) for l in cache[key])
+                return
 
         self.length = []
         self.effective_length = []
-        length_dict = self.length_dict_()
         for epoch in range(1, self.epochs+1):
             self.reset_filenames()
             if self.k_scenes_to_subsample != -1:
@@ -578,118 +753,121 @@ class DataLoader:
                                      'Got: {}'.format(available_ks, self.k_scenes_to_subsample))
                 self.subsample_filenames()
 
-            length = 0
             self._seed(epoch)
             if self.mode == 'train':
                 dq = self._create_deque()
             else:
                 dq = self._create_deque(shuffle=False)
-            sim_lengths = np.zeros(self.batchsize, dtype=np.int32)
-            left_lengths = np.zeros(self.batchsize, dtype=np.int32)
-
-            heap = None
-            if self.priority_queue:
-                heap = [(length + left_lengths[i], i) for i, length in enumerate(sim_lengths)]
-                heapq.heapify(heap)
+            file_lengths = self.metadata_index_().lengths([self.filenames[ind] for ind in dq], self.instant_mode)
 
-            skipped_steps = 0
-            while not nothing_left_length(dq, left_lengths, sim_lengths):
-                filled = True
-                for row in range(0, self.batchsize):
-                    stopping_condition = sim_lengths[row] >= self.buffer_size
-                    if not stopping_condition:
-                        if left_lengths[row] > 0:
-                            sim_lengths[row] += left_lengths[row]
-                            if self.val_stateful:
-                                old_length = sim_lengths[row]
-                                sim_lengths[row] = int(np.ceil(sim_lengths[row] / self.timesteps)) * self.timesteps
-                                skipped_steps += (sim_lengths[row] - old_length)
-                            if sim_lengths[row] > self.buffer_size:
-                                left_lengths[row] = sim_lengths[row] - self.buffer_size
-                                sim_lengths[row] = self.buffer_size
-                            left_lengths[row] = 0
-                        elif len(dq) > 0:
-                            if self.priority_queue:
-                                _, row = heapq.heappop(heap)
-                            curr_ind = dq.popleft()
-                            l = self.length_dict_()[self.filenames[curr_ind]]
-                            if self.val_stateful:
-                                leftover, skipped = add_to_length_until_buffersize(l, row)
-                                skipped_steps += skipped
-                            else:
-                                leftover = add_to_length_until_buffersize(l, row)
-                            left_lengths[row] = leftover
-                            if self.priority_queue:
-                                heapq.heappush(heap, (sim_lengths[row] + left_lengths[row], row))
-                        if sim_lengths[row] < self.buffer_size:
-                            filled = False
-                if self.priority_queue:
-                    filled = heap[0][0] >= self.buffer_size
-                if filled:
-                    length += self.buffer_size // self.timesteps
-                    sim_lengths[:] = 0
-                    if self.priority_queue:
-                        heap = [(l + left_lengths[i], i) for i, l in enumerate(sim_lengths)]
-                        heapq.heapify(heap)
-            if self.use_every_timestep:
-                effective_length = length
-                sim_and_left_lengths = sim_lengths + left_lengths
-                effective_length += (np.sum(sim_and_left_lengths) - skipped_steps) / (self.timesteps * self.batchsize)
-                last_batch_defining_row = np.max(sim_and_left_lengths)
-                length += int(np.ceil(last_batch_defining_row / float(self.timesteps)))
-            else:
-                last_batch_defining_row = np.min(sim_lengths)
-                length += last_batch_defining_row // self.timesteps
-                effective_length = length
+            length, effective_length = simulate_epoch_length(file_lengths.tolist(), self.batchsize, self.timesteps,
+                                                             self.buffer_size, self.priority_queue,
+                                                             self.val_stateful, self.use_every_timestep)
             self.effective_length.append(effective_length)
             self.length.append(length)
 
+        if use_cache:
+            # several processes (e.g. the workers of worker_pool.py) share the data folder -> read, update and replace
+            # under a lock, the entries of the others written since the read above are kept
+            with portalocker.Lock(cache_path + '.lock', mode='a', timeout=60):
+                cache = dict()
+                if path.exists(cache_path):
+                    with open(cache_path, 'rb') as handle:
+                        cache = pickle.load(handle)
+                cache[key] = (self.length, self.effective_length)
+                tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                with open(tmp_path, 'wb') as handle:
+                    pickle.dump(cache, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+
+    def metadata_index_(self):
+        if self.metadata_index is None:
+            self.metadata_index = MetadataIndex.load_or_create(self.pickle_path)
+
+        return self.metadata_index
+
     def length_dict_(self):
         if self.length_dict is None:
-            pickle_path = path.join(self.pickle_path, 'file_lengths.pickle')
-            if not path.exists(pickle_path):
-                self._create_length_dict()
-            with open(pickle_path, 'rb') as handle:
-                self.length_dict = pickle.load(handle)
+            self.length_dict = self.metadata_index_().length_dict(self.instant_mode)
 
         return self.length_dict
 
-    def _create_length_dict(self):
-        all_existing_files = glob.glob(self.pickle_path_pattern)
-
-        def get_length(file):
-            with np.load(file) as data:
-                return data['y'].shape[1] if self.instant_mode else data['y_block'].shape[1]
-
-        d = {file: get_length(file) for file in tqdm(all_existing_files)}
-        with open(path.join(self.pickle_path, 'file_lengths.pickle'), 'wb') as handle:
-            pickle.dump(d, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
     def scene_instance_ids_dict_(self):
         if self.scene_instance_ids_dict is None:
-            pickle_path = path.join(self.pickle_path, 'scene_instances_ids.pickle')
-            if not path.exists(pickle_path):
-                self._create_scene_instance_ids_dict()
-            with open(pickle_path, 'rb') as handle:
-                self.scene_instance_ids_dict = pickle.load(handle)
+            self.scene_instance_ids_dict = self.metadata_index_().scene_instance_ids_dict()
 
         return self.scene_instance_ids_dict
 
-    def _create_scene_instance_ids_dict(self):
-        all_existing_files = glob.glob(self.pickle_path_pattern)
-        all_existing_files = sorted(all_existing_files)
-        scene_nb_regex = re.compile('scene([0-9]+)[_/]')
-
-        scene_counts = dict()
-
-        def get_scene_instance_id(file):
-            scene_number = int(scene_nb_regex.findall(file)[0])
-            if scene_number not in scene_counts:
-                scene_counts[scene_number] = 1
-            id_ = scene_number*1e4 + scene_counts[scene_number]
-            scene_counts[scene_number] += 1
-            return id_
 
-        d = {file: get_scene_instance_id(file) for file in tqdm(all_existing_files)}
-        with open(path.join(self.pickle_path, 'scene_instances_ids.pickle'), 'wb') as handle:
-            pickle.dump(d, handle, protocol=pickle.HIGHEST_PROTOCOL)
+def simulate_epoch_length(file_lengths, batchsize, timesteps, buffer_size, priority_queue, val_stateful,
+                          use_every_timestep):
+    '''
+    Simulates the filling of the buffer for one epoch (file_lengths in the order of the file queue) and returns the
+    number of batches and the effective number of batches. Plain python ints instead of numpy scalars, the logic
+    (including the row taken from the heap and the overwritten leftovers) is the one of DataLoader.fill_buffer.
+    '''
+    def ceil_to_timesteps(l):
+        return -(-l // timesteps) * timesteps
+
+    length = 0
+    dq = deque(file_lengths)
+    sim_lengths = [0] * batchsize
+    left_lengths = [0] * batchsize
+
+    heap = None
+    if priority_queue:
+        heap = [(l + left_lengths[i], i) for i, l in enumerate(sim_lengths)]
+        heapq.heapify(heap)
+
+    skipped_steps = 0
+    while len(dq) > 0 or not all(left_lengths[i] == 0 or sim_lengths[i] == buffer_size for i in range(batchsize)):
+        filled = True
+        for row in range(0, batchsize):
+            if sim_lengths[row] < buffer_size:
+                if left_lengths[row] > 0:
+                    sim_lengths[row] += left_lengths[row]
+                    if val_stateful:
+                        old_length = sim_lengths[row]
+                        sim_lengths[row] = ceil_to_timesteps(sim_lengths[row])
+                        skipped_steps += (sim_lengths[row] - old_length)
+                    if sim_lengths[row] > buffer_size:
+                        left_lengths[row] = sim_lengths[row] - buffer_size
+                        sim_lengths[row] = buffer_size
+                    left_lengths[row] = 0
+                elif len(dq) > 0:
+                    if priority_queue:
+                        _, row = heapq.heappop(heap)
+                    sim_lengths[row] += dq.popleft()
+                    leftover = sim_lengths[row] - buffer_size
+                    if leftover > 0:
+                        sim_lengths[row] = buffer_size
+                    else:
+                        leftover = 0
+                        if val_stateful and sim_lengths[row] < buffer_size:
+                            old_length = sim_lengths[row]
+                            sim_lengths[row] = ceil_to_timesteps(sim_lengths[row])
+                            skipped_steps += sim_lengths[row] - old_length
+                    left_lengths[row] = leftover
+                    if priority_queue:
+                        heapq.heappush(heap, (sim_lengths[row] + left_lengths[row], row))
+                if sim_lengths[row] < buffer_size:
+                    filled = False
+        if priority_queue:
+            filled = heap[0][0] >= buffer_size
+        if filled:
+            length += buffer_size // timesteps
+            sim_lengths = [0] * batchsize
+            if priority_queue:
+                heap = [(l + left_lengths[i], i) for i, l in enumerate(sim_lengths)]
+                heapq.heapify(heap)
+    if use_every_timestep:
+        effective_length = length
+        sim_and_left_lengths = [sim_lengths[i] + left_lengths[i] for i in range(batchsize)]
+        effective_length += (sum(sim_and_left_lengths) - skipped_steps) / (timesteps * batchsize)
+        last_batch_defining_row = max(sim_and_left_lengths)
+        length += -(-last_batch_defining_row // timesteps)
+    else:
+        last_batch_defining_row = min(sim_lengths)
+        length += last_batch_defining_row // timesteps
+        effective_length = length
+    return length, effective_length
@@ -1,4 +1,5 @@
 import numpy as np
+import os
 from os import path
 import glob
 from random import seed
@@ -22,9 +23,6 @@ class DataLoaderTester(DataLoader):
         self._init_buffers()
         self.scene_instance_ids_dict = {filename: int(filename[filename.find('factor')+6:filename.find('.npz')])
                                         for filename in self.filenames}
-        self.path_pattern = path.join(path_pattern, '*.npz')
-        self.pickle_path_pattern = path.join(path_pattern, '*.npz')
-        self.pickle_path = path_pattern
 
         if mode == 'train':
             inds = list(range(len(self.filenames)))
@@ -43,6 +41,9 @@ class DataLoaderTester(DataLoader):
 # test
 import tempfile
 tmp_dir = tempfile.mkdtemp()
+# the lengths are read from the metadata index of the data location -> fold*/scene* layout below train/
+scene_dir = path.join(tmp_dir, 'train', 'fold1', 'scene1')
+os.makedirs(scene_dir)
 factors = [2, 3, 4, 5, 6, 7, 8, 9, 10]
 length = 40
 multiples = np.array(list(range(length))) + 1
@@ -56,9 +57,9 @@ for factor in factors:
     y = np.expand_dims(y, axis=0)
     y_block = y
     name = 'factor' + str(factor) + '.npz'
-    save_path = path.join(tmp_dir, name)
+    save_path = path.join(scene_dir, name)
     np.savez(save_path, x=x, y=y, y_block=y_block)
-path_pattern = tmp_dir + '/*.npz'
+path_pattern = scene_dir + '/*.npz'
 filenames = glob.glob(path_pattern)
 dloader = DataLoaderTester('val', filenames, batchsize=2, timesteps=3, epochs=1, buffer=5, val_stateful=True,
                            features=1, classes=1, path_pattern=tmp_dir, seed_by_epoch=False, use_every_timestep=True)
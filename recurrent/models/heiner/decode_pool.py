@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from os import path
+
+import numpy as np
+
+from scene_instance_store import SceneInstanceStore, load_scene_instance
+
+# POSIX shared memory blocks are files in /dev/shm (Linux)
+SHM_DIR = '/dev/shm'
+
+_worker_stores = dict()
+
+
+def _aligned(offset, alignment=64):
+    return -(-offset // alignment) * alignment
+
+
+def _decode_to_shared_memory(filename, keys, store_location):
+    store = None
+    if store_location is not None:
+        if store_location not in _worker_stores:
+            _worker_stores[store_location] = SceneInstanceStore(store_location)
+        store = _worker_stores[store_location]
+
+    data = load_scene_instance(filename, keys, store=store)
+
+    layout = []
+    size = 0
+    for key in keys:
+        array = data[key]
+        layout.append((key, array.shape, array.dtype.str, size))
+        size = _aligned(size + array.nbytes)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for key, shape, dtype, offset in layout:
+        view = np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+        view[...] = data[key]
+        del view
+    name = shm.name
+    # the main process takes over the block (and unlinks it)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return name, layout
+
+
+def _unlink(name):
+    try:
+        os.unlink(path.join(SHM_DIR, name.lstrip('/')))
+    except FileNotFoundError:
+        pass
+
+
+def _attach(name, layout):
+    shm_path = path.join(SHM_DIR, name.lstrip('/'))
+    if path.exists(shm_path):
+        # zero-copy: the mapping stays valid after the unlink until the arrays are garbage collected
+        block = np.memmap(shm_path, dtype=np.uint8, mode='r+')
+        _unlink(name)
+        return tuple(np.ndarray(shape, dtype, buffer=block, offset=offset) for _, shape, dtype, offset in layout)
+
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = tuple(np.ndarray(shape, dtype, buffer=shm.buf, offset=offset).copy()
+                   for _, shape, dtype, offset in layout)
+    shm.close()
+    shm.unlink()
+    return arrays
+
+
+def _discard(future):
+    if not future.cancelled() and future.exception() is None:
+        _unlink(future.result()[0])
+
+
+class DecodeFuture:
+
+    def __init__(self, future):
+        self.future = future
+        self.consumed = False
+
+    def result(self):
+        self.consumed = True
+        return _attach(*self.future.result())
+
+    def __del__(self):
+        # scheduled but never used (e.g. read ahead at the end of an epoch) -> free the block once it exists
+        if not self.consumed:
+            self.future.add_done_callback(_discard)
+
+
+class DecodePool:
+    '''
+    Worker processes that open and decompress scene instances and write them into multiprocessing.shared_memory
+    blocks. The main process maps the blocks as numpy arrays, i.e. nothing is pickled apart from the block layout.
+    Same interface as the thread pool of the DataLoader read ahead: submit(...).result() -> tuple of arrays (keys).
+    '''
+
+    def __init__(self, n_workers, store_location=None):
+        # the workers are started lazily at the first submit, possibly after tensorflow (cuda) is initialized in this
+        # process -> forkserver instead of fork
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.store_location = store_location
+
+    def submit(self, filename, keys):
+        return DecodeFuture(self.executor.submit(_decode_to_shared_memory, filename, keys, self.store_location))
+
+    def load(self, filename, keys):
+        return self.submit(filename, keys).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
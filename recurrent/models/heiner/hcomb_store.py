@@ -0,0 +1,296 @@
+import argparse
+import os
+import pickle
+import sqlite3
+from contextlib import contextmanager
+from os import path
+
+import portalocker
+
+import hyperparameters as hp
+import utils
+
+DB_NAME = 'hyperparameter_combinations.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hcombs (
+    id INTEGER PRIMARY KEY,
+    stage INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hcombs_stage ON hcombs (stage, finished);
+CREATE INDEX IF NOT EXISTS hcombs_fingerprint ON hcombs (fingerprint);
+CREATE TABLE IF NOT EXISTS hcombs_to_run (
+    position INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL UNIQUE,
+    data BLOB NOT NULL
+);
+'''
+
+
+def exists(save_path):
+    return path.exists(path.join(save_path, DB_NAME))
+
+
+class SQLiteHCombManager(hp.HCombManager):
+    '''
+    Drop-in for HCombManager: the hcombs and the hcombs to run are rows of a SQLite database in save_path instead of
+    two pickles which are read and rewritten as a whole under a file lock for every change. Every change is one
+    transaction on one row, poll_hcomb claims the next hcomb to run atomically. The csv (and pickle) files are
+    written on demand by export().
+
+    hyperparameter_combinations.pickle is imported when the database is created. The hcombs to run are still added
+    to hyperparameter_combinations_to_run.pickle by RandomSearch, poll_hcomb moves them into the database.
+    '''
+
+    def __init__(self, save_path, timeout=60, db_path=None):
+        self.save_path = save_path
+        self.timeout = timeout
+
+        self.filepath = path.join(self.save_path, 'hyperparameter_combinations.pickle')
+        self.filepath_to_run = path.join(self.save_path, 'hyperparameter_combinations_to_run.pickle')
+        self.db_path = db_path if db_path is not None else path.join(self.save_path, DB_NAME)
+
+        with self._transaction() as db:
+            for statement in _SCHEMA.split(';'):
+                if statement.strip():
+                    db.execute(statement)
+            if db.execute('SELECT COUNT(*) FROM hcombs').fetchone()[0] == 0 and path.exists(self.filepath):
+                with open(self.filepath, 'rb') as handle:
+                    hcomb_list = pickle.load(handle)
+                # HCombManager addresses the hcombs by their index in the list
+                for id_, hcomb in enumerate(hcomb_list):
+                    self._insert(db, id_, hcomb)
+
+    @contextmanager
+    def _transaction(self):
+        # the model directories are on the network file system shared by the hosts, where the locks of SQLite are not
+        # reliable -> every transaction holds the lock file (portalocker, as HCombManager does for the pickles) too,
+        # this makes e.g. the claim of poll_hcomb atomic across hosts
+        with portalocker.Lock(self.db_path + '.lock', mode='a', timeout=self.timeout):
+            # a connection per transaction -> the manager can be passed to the (forked) hcomb processes,
+            # no WAL journal (shared memory index) on a network file system
+            db = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            try:
+                # IMMEDIATE: the write lock is taken at the start -> read and write of a row are atomic
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    yield db
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+            finally:
+                db.close()
+
+    def _insert(self, db, id_, h):
+        db.execute('INSERT INTO hcombs (id, stage, finished, fingerprint, data) VALUES (?, ?, ?, ?, ?)',
+                   (id_, h['STAGE'], int(h['finished']), hp.hcomb_fingerprint(h),
+                    pickle.dumps(h, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def _update(self, db, id_, h):
+        if type(h) is not dict:
+            h = h.__dict__
+        db.execute('UPDATE hcombs SET stage = ?, finished = ?, data = ? WHERE id = ?',
+                   (h['STAGE'], int(h['finished']), pickle.dumps(h, protocol=pickle.HIGHEST_PROTOCOL), id_))
+
+    def _select(self, db, id_):
+        row = db.execute('SELECT data FROM hcombs WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            raise IndexError('No hcomb with ID {}.'.format(id_))
+        return pickle.loads(row[0])
+
+    ################################################# HCOMBS TO RUN
+
+    def add_hcombs_to_run(self, hcombs, prepend=False):
+        # hcombs already in the queue are skipped (with prepend they move to the front)
+        with self._transaction() as db:
+            self._add_hcombs_to_run(db, hcombs, prepend)
+
+    def _add_hcombs_to_run(self, db, hcombs, prepend):
+        if len(hcombs) == 0:
+            return
+        first, last = db.execute('SELECT MIN(position), MAX(position) FROM hcombs_to_run').fetchone()
+        if first is None:
+            first, last = 0, -1
+        for i, h in enumerate(hcombs):
+            # the whole dict as in utils.unique_dict
+            h_fingerprint = utils.fingerprint(h)
+            if prepend:
+                db.execute('DELETE FROM hcombs_to_run WHERE fingerprint = ?', (h_fingerprint,))
+                position = first - len(hcombs) + i
+            elif db.execute('SELECT 1 FROM hcombs_to_run WHERE fingerprint = ?',
+                            (h_fingerprint,)).fetchone() is not None:
+                continue
+            else:
+                last += 1
+                position = last
+            db.execute('INSERT OR IGNORE INTO hcombs_to_run (position, fingerprint, data) VALUES (?, ?, ?)',
+                       (position, h_fingerprint, pickle.dumps(h, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def add_ids_to_run(self, ids):
+        # the rows of the database, hyperparameter_combinations.pickle is not up to date
+        with self._transaction() as db:
+            self._add_hcombs_to_run(db, [self._select(db, id_) for id_ in ids], prepend=True)
+
+    def _import_hcombs_to_run(self, db):
+        # hcombs added to the pickle by RandomSearch since the last poll are appended to the queue
+        if not path.exists(self.filepath_to_run):
+            return
+        with portalocker.Lock(self.filepath_to_run, mode='rb', timeout=self.timeout) as handle:
+            hcombs_to_run = pickle.load(handle)
+            self._add_hcombs_to_run(db, hcombs_to_run, prepend=False)
+            os.remove(self.filepath_to_run)
+        csv_path = self.filepath_to_run.replace('.pickle', '.csv')
+        if path.exists(csv_path):
+            os.remove(csv_path)
+
+    def poll_hcomb(self, timeout=60):
+        self.timeout = timeout
+
+        with self._transaction() as db:
+            self._import_hcombs_to_run(db)
+            row = db.execute('SELECT position, data FROM hcombs_to_run ORDER BY position LIMIT 1').fetchone()
+            if row is None:
+                return None
+            db.execute('DELETE FROM hcombs_to_run WHERE position = ?', (row[0],))
+            return pickle.loads(row[1])
+
+    ################################################# HCOMBS
+
+    def get_hcomb_id(self, h, always_append_hcombs=False):
+        with self._transaction() as db:
+            row = db.execute('SELECT id FROM hcombs WHERE fingerprint = ? ORDER BY id LIMIT 1',
+                             (hp.hcomb_fingerprint(h),)).fetchone()
+            if row is not None and not always_append_hcombs:
+                index = row[0]
+                already_contained = True
+            else:
+                index = db.execute('SELECT COALESCE(MAX(id) + 1, 0) FROM hcombs').fetchone()[0]
+                h['ID'] = index
+                new_h = hp.H()
+                new_h.from_dict(h)
+                new_h.init_metrics_and_stats()
+                self._insert(db, index, new_h.__dict__)
+                already_contained = False
+
+            h = hp.H()
+            h.__dict__ = self._select(db, index)
+            return index, h, already_contained
+
+    def get_hcomb_per_id(self, id_):
+        with self._transaction() as db:
+            h = hp.H()
+            h.__dict__ = self._select(db, id_)
+            return h
+
+    def hcombs_per_stage(self, stage, finished=None):
+        # dicts of the hcombs in stage (optionally just the finished or unfinished ones) ordered by ID
+        with self._transaction() as db:
+            if finished is None:
+                rows = db.execute('SELECT data FROM hcombs WHERE stage = ? ORDER BY id', (stage,))
+            else:
+                rows = db.execute('SELECT data FROM hcombs WHERE stage = ? AND finished = ? ORDER BY id',
+                                  (stage, int(finished)))
+            return [pickle.loads(data) for data, in rows.fetchall()]
+
+    def hcomb_list(self):
+        with self._transaction() as db:
+            return [pickle.loads(data) for data, in db.execute('SELECT data FROM hcombs ORDER BY id').fetchall()]
+
+    def hcombs_to_run(self):
+        with self._transaction() as db:
+            return [pickle.loads(data) for data, in
+                    db.execute('SELECT data FROM hcombs_to_run ORDER BY position').fetchall()]
+
+    def set_hostname_and_batch_size(self, id_, h, hostname, batch_size):
+        h = h.__dict__
+
+        if h['HOSTNAME'] != hostname:
+            print(f'{h["HOSTNAME"]} != {hostname}')
+            h['HOSTNAME'] = hostname
+            h['BATCH_SIZE'] = batch_size
+
+        self.replace_at_id(id_, h)
+
+    def finish_stage(self, id_, h, best_val_acc_mean, best_val_acc_std, best_val_acc_mean_bac2, best_val_acc_std_bac2,
+                     elapsed_time_minutes):
+        h = h.__dict__
+
+        # finished all
+        h['finished'] = False
+        h['elapsed_time_minutes'] = elapsed_time_minutes
+        self._update_val_metrics_mean_std(h, best_val_acc_mean, best_val_acc_std, best_val_acc_mean_bac2,
+                                          best_val_acc_std_bac2)
+
+        self.replace_at_id(id_, h)
+
+    def next_stage(self, id_, h):
+        h = h.__dict__
+
+        h['STAGE'] += 1
+
+        self.replace_at_id(id_, h)
+
+    def finish_hcomb(self, id_, h):
+        h = h.__dict__
+
+        # finished all
+        h['finished'] = True
+
+        self.replace_at_id(id_, h)
+
+    def finish_epoch(self, id_, h, val_acc, best_val_acc, val_acc_bac2, best_val_acc_bac2,
+                     fold_ind, epochs_finished, best_epoch, elapsed_time_minutes):
+        h = h.__dict__
+
+        h['epochs_finished'][fold_ind] = epochs_finished
+        h['best_epochs'][fold_ind] = best_epoch
+        h['elapsed_time_minutes'] = elapsed_time_minutes
+        self._update_val_metrics(h, val_acc, best_val_acc, val_acc_bac2, best_val_acc_bac2, fold_ind)
+
+        self.replace_at_id(id_, h)
+
+    def replace_at_id(self, id_, h):
+        with self._transaction() as db:
+            self._update(db, id_, h)
+
+    ################################################# EXPORT
+
+    def export(self, write_pickles=False):
+        '''
+        Writes hyperparameter_combinations(_to_run).csv as HCombManager did after every change, with write_pickles
+        also the pickles (e.g. for RandomSearch.add_hcombs_to_run_via_id of another model).
+        '''
+        hcomb_list = self.hcomb_list()
+        if write_pickles:
+            with portalocker.Lock(self.filepath, mode='ab', timeout=self.timeout) as handle:
+                self._write_hcomb_list(hcomb_list, handle)
+        elif len(hcomb_list) > 0:
+            hp.write_to_csv_from_data(hcomb_list, self.filepath)
+
+        hcombs_to_run = self.hcombs_to_run()
+        if len(hcombs_to_run) > 0:
+            hp.write_to_csv_from_data(hcombs_to_run, self.filepath_to_run)
+
+
+def create_hcomb_manager(save_path, use_sqlite=False):
+    # the database is used once it exists in save_path
+    if use_sqlite or exists(save_path):
+        return SQLiteHCombManager(save_path)
+    return hp.HCombManager(save_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_path',
+                        type=str,
+                        metavar="<save path>",
+                        help="Model directory containing the hyperparameter combinations, e.g. .../LDNN_v1.")
+    parser.add_argument('-p', '--pickles',
+                        action='store_true',
+                        help="Write hyperparameter_combinations.pickle as well.")
+    args = parser.parse_args()
+    SQLiteHCombManager(args.save_path).export(write_pickles=args.pickles)
@@ -1,15 +1,32 @@
 import pickle
-from copy import deepcopy
 import os
 from os import path
 
-from utils import unique_dict
+from utils import fingerprint, unique_dict
 
 import numpy as np
 import portalocker
 
 import csv
 
+# run state and metrics of a hcomb: not part of the comparison whether a hcomb is already contained
+NOT_COMPARED_KEYS = ('ID', 'STAGE', 'BATCH_SIZE', 'HOSTNAME', 'finished', 'epochs_finished', 'best_epochs', 'METRIC',
+                     'val_acc', 'best_val_acc', 'best_val_acc_mean', 'best_val_acc_std',
+                     'val_acc_bac2', 'best_val_acc_bac2', 'best_val_acc_mean_bac2', 'best_val_acc_std_bac2',
+                     'elapsed_time_minutes')
+
+
+def hcomb_fingerprint(h):
+    '''
+    Fingerprint of the search relevant fields of a hcomb (dict): two hcombs with the same fingerprint are the same
+    combination, independent of their run state and metrics.
+    '''
+    if 'RECURRENT_DROPOUT_MODE' not in h:
+        # combinations from before the mode existed
+        h = dict(h, RECURRENT_DROPOUT_MODE='numpy')
+    return fingerprint(h, ignore_keys=NOT_COMPARED_KEYS)
+
+
 class H:
     def __init__(self, ID=-1, N_CLASSES=13, TIME_STEPS=2000, N_FEATURES=160, BATCH_SIZE=64, MAX_EPOCHS=50,
                  UNITS_PER_LAYER_LSTM=None, UNITS_PER_LAYER_MLP=None, LEARNING_RATE=0.001,
@@ -19,7 +36,7 @@ class H:
                  ALL_FOLDS=-1, STAGE=1,
                  LABEL_MODE='blockbased',
                  MASK_VAL=-1, VAL_STATEFUL=True, METRIC='BAC',
-                 HOSTNAME=''):
+                 HOSTNAME='', RECURRENT_DROPOUT_MODE='numpy'):
         ################################################################################################################
 
         self.ID = ID
@@ -68,6 +85,8 @@ class H:
         self.LEARNING_RATE = LEARNING_RATE
 
         self.RECURRENT_DROPOUT = RECURRENT_DROPOUT
+        # 'numpy': weights changed before and restored after each batch, 'graph': DropConnect layers
+        self.RECURRENT_DROPOUT_MODE = RECURRENT_DROPOUT_MODE
         self.INPUT_DROPOUT = INPUT_DROPOUT
         self.LSTM_OUTPUT_DROPOUT = LSTM_OUTPUT_DROPOUT
         self.MLP_OUTPUT_DROPOUT = MLP_OUTPUT_DROPOUT
@@ -159,6 +178,10 @@ class HCombManager:
         pickle_name_to_run = 'hyperparameter_combinations_to_run.pickle'
         self.filepath_to_run = path.join(self.save_path, pickle_name_to_run)
 
+        # fingerprint -> ID index of the hcombs (written under the lock of the hcomb list)
+        pickle_name_fingerprints = 'hyperparameter_combinations_fingerprints.pickle'
+        self.filepath_fingerprints = path.join(self.save_path, pickle_name_fingerprints)
+
         if not path.exists(self.filepath):
             with portalocker.Lock(self.filepath, mode='ab', timeout=self.timeout) as handle:
                 hcomb_list = []
@@ -185,13 +208,15 @@ class HCombManager:
         with portalocker.Lock(self.filepath, mode='r+b', timeout=self.timeout) as handle:
             hcomb_list = self._read_hcomb_list(handle)
 
-            # h = h.__dict__
+            h_fingerprint = hcomb_fingerprint(h)
+            ids_per_fingerprint, index_changed = self._read_ids_per_fingerprint(hcomb_list)
+            index = ids_per_fingerprint.get(h_fingerprint)
+            if index is not None and hcomb_fingerprint(hcomb_list[index]) != h_fingerprint:
+                # the list was changed without the index (e.g. change_hcomb_list.py)
+                ids_per_fingerprint, index_changed = self._build_ids_per_fingerprint(hcomb_list), True
+                index = ids_per_fingerprint.get(h_fingerprint)
 
-            hcomb_list_copy = deepcopy(hcomb_list)
-            for hcomb in hcomb_list_copy:
-                self._make_comparable(hcomb, h)
-            if h in hcomb_list_copy and not always_append_hcombs:
-                index = hcomb_list_copy.index(h)
+            if index is not None and not always_append_hcombs:
                 already_contained = True
             else:
                 h['ID'] = len(hcomb_list)
@@ -200,15 +225,41 @@ class HCombManager:
                 new_h.init_metrics_and_stats()
                 h = new_h.__dict__
                 hcomb_list.append(h)
-                index = hcomb_list.index(h)
+                index = len(hcomb_list) - 1
                 already_contained = False
+                # first hcomb of a fingerprint wins
+                ids_per_fingerprint.setdefault(h_fingerprint, index)
+                index_changed = True
 
-            self._write_hcomb_list(hcomb_list, handle)
+                self._write_hcomb_list(hcomb_list, handle)
+
+            if index_changed:
+                self._write_ids_per_fingerprint(len(hcomb_list), ids_per_fingerprint)
 
             h = H()
             h.__dict__ = hcomb_list[index]
             return index, h, already_contained
 
+    def _build_ids_per_fingerprint(self, hcomb_list):
+        ids_per_fingerprint = dict()
+        for id_, hcomb in enumerate(hcomb_list):
+            ids_per_fingerprint.setdefault(hcomb_fingerprint(hcomb), id_)
+        return ids_per_fingerprint
+
+    def _read_ids_per_fingerprint(self, hcomb_list):
+        # the stored index if it covers all hcombs of the list, else rebuilt (one hash per hcomb) -> (index, rebuilt)
+        if path.exists(self.filepath_fingerprints):
+            with open(self.filepath_fingerprints, 'rb') as handle:
+                n_hcombs, ids_per_fingerprint = pickle.load(handle)
+            if n_hcombs == len(hcomb_list):
+                return ids_per_fingerprint, False
+        return self._build_ids_per_fingerprint(hcomb_list), True
+
+    def _write_ids_per_fingerprint(self, n_hcombs, ids_per_fingerprint):
+        with open(self.filepath_fingerprints + '.tmp', 'wb') as handle:
+            pickle.dump((n_hcombs, ids_per_fingerprint), handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.filepath_fingerprints + '.tmp', self.filepath_fingerprints)
+
     def get_hcomb_per_id(self, id_):
         with portalocker.Lock(self.filepath, mode='r+b', timeout=self.timeout) as handle:
             hcomb_list = self._read_hcomb_list(handle)
@@ -232,28 +283,6 @@ class HCombManager:
 
             self._write_hcomb_list(hcomb_list, handle)
 
-    def _make_comparable(self, hcomb, h):
-        hcomb['ID'] = h['ID']       # if the same hcomb id drawn again
-        hcomb['STAGE'] = h['STAGE']
-        hcomb['BATCH_SIZE'] = h['BATCH_SIZE']
-        hcomb['HOSTNAME'] = h['HOSTNAME']
-        hcomb['finished'] = h['finished']
-        hcomb['epochs_finished'] = h['epochs_finished']
-        hcomb['best_epochs'] = h['best_epochs']
-        hcomb['METRIC'] = h['METRIC']
-
-        hcomb['val_acc'] = h['val_acc']
-        hcomb['best_val_acc'] = h['best_val_acc']
-        hcomb['best_val_acc_mean'] = h['best_val_acc_mean']
-        hcomb['best_val_acc_std'] = h['best_val_acc_std']
-
-        hcomb['val_acc_bac2'] = h['val_acc_bac2']
-        hcomb['best_val_acc_bac2'] = h['best_val_acc_bac2']
-        hcomb['best_val_acc_mean_bac2'] = h['best_val_acc_mean_bac2']
-        hcomb['best_val_acc_std_bac2'] = h['best_val_acc_std_bac2']
-
-        hcomb['elapsed_time_minutes'] = h['elapsed_time_minutes']
-
     def finish_stage(self, id_, h, best_val_acc_mean, best_val_acc_std, best_val_acc_mean_bac2, best_val_acc_std_bac2,
                      elapsed_time_minutes):
         with portalocker.Lock(self.filepath, mode='r+b', timeout=self.timeout) as handle:
@@ -340,6 +369,10 @@ class HCombManager:
 
             self._write_hcomb_list(hcomb_list, handle)
 
+    def add_ids_to_run(self, ids):
+        # in front of the hcombs to run (e.g. promoted to the next stage)
+        RandomSearch().add_hcombs_to_run_via_id(ids, self.save_path)
+
     def _read_hcomb_list(self, handle):
         return pickle.load(handle)
 
@@ -354,6 +387,153 @@ class HCombManager:
             os.remove(self.filepath_to_run)
 
 
+class SuccessiveHalvingScheduler:
+    '''
+    Asynchronous successive halving over the stages of the random search (rungs): the budget of a stage is its
+    validation fold (H.VAL_FOLDS) and at most max_epochs_per_stage[stage] epochs, by default H.MAX_EPOCHS in the last
+    stage and eta times less in every stage before (at least grace_epochs + 1). A hcomb which finished a stage is
+    promoted to the next one if its mean best validation accuracy is in the top 1 / eta of the results of that stage
+    so far (at least min_results_per_stage results). Hcombs not promoted right away can still be promoted later as
+    more (worse) results arrive -> next_promotion, which run_gpu asks before polling a new hcomb.
+
+    Runs are stopped early if their best validation accuracy after an epoch is below the stop_quantile of the best
+    validation accuracies the other hcombs of the stage had after the same epoch of the same validation fold (median
+    stopping rule by default).
+
+    The results are kept in save_path/successive_halving.pickle (locked like the hcomb list) -> shared by all GPUs.
+    The curves are one record per epoch appended to save_path/successive_halving_curves.pickle, every process reads the
+    records appended since its last read only.
+    '''
+
+    def __init__(self, save_path, eta=3, last_stage=3, min_results_per_stage=None, max_epochs_per_stage=None,
+                 stop_quantile=0.5, grace_epochs=3, min_results_per_epoch=None, timeout=60):
+        if eta < 2:
+            raise ValueError('eta has to be at least 2. Got: {}'.format(eta))
+        if not 0. <= stop_quantile < 1.:
+            raise ValueError('stop_quantile has to be in [0, 1). Got: {}'.format(stop_quantile))
+
+        self.eta = eta
+        self.last_stage = last_stage
+        self.min_results_per_stage = min_results_per_stage if min_results_per_stage is not None else eta
+        self.max_epochs_per_stage = max_epochs_per_stage if max_epochs_per_stage is not None else dict()
+        self.stop_quantile = stop_quantile
+        self.grace_epochs = grace_epochs
+        self.min_results_per_epoch = min_results_per_epoch if min_results_per_epoch is not None else eta
+        self.timeout = timeout
+
+        self.filepath = path.join(save_path, 'successive_halving.pickle')
+        if not path.exists(self.filepath):
+            with portalocker.Lock(self.filepath, mode='ab', timeout=self.timeout) as handle:
+                self._write_state(self._empty_state(), handle)
+
+        self.curves_filepath = path.join(save_path, 'successive_halving_curves.pickle')
+        if not path.exists(self.curves_filepath):
+            with portalocker.Lock(self.curves_filepath, mode='ab', timeout=self.timeout):
+                pass
+        # (stage, val fold, epoch) -> {ID: best val acc after the epoch}, the records up to _curves_offset
+        self._curves = dict()
+        self._curves_offset = 0
+
+    @staticmethod
+    def _empty_state():
+        return {
+            'results': dict(),      # stage -> {ID: mean best val acc}
+            'promoted': dict()      # stage -> IDs promoted from this stage
+        }
+
+    def _read_state(self, handle):
+        handle.seek(0)
+        return pickle.load(handle)
+
+    def _write_state(self, state, handle):
+        handle.seek(0)
+        handle.truncate()
+        pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def max_epochs(self, stage, max_epochs):
+        # increasing budgets: eta times the epochs of the stage before
+        default = max(int(np.ceil(max_epochs / self.eta ** max(self.last_stage - stage, 0))), self.grace_epochs + 1)
+        return min(max_epochs, self.max_epochs_per_stage.get(stage, default))
+
+    def _is_top(self, results, id_):
+        # rank of id_ within the top len // eta of the stage
+        n_top = len(results) // self.eta
+        if len(results) < self.min_results_per_stage or n_top == 0:
+            return False
+        ranked = sorted(results, key=lambda other_id: (-results[other_id], other_id))
+        return id_ in ranked[:n_top]
+
+    def report_epoch(self, id_, stage, val_fold, epoch, best_val_acc):
+        with portalocker.Lock(self.curves_filepath, mode='ab', timeout=self.timeout) as handle:
+            pickle.dump((stage, val_fold, epoch, id_, best_val_acc), handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _read_curves(self):
+        # the records appended by all processes since the last read
+        with portalocker.Lock(self.curves_filepath, mode='rb', timeout=self.timeout) as handle:
+            handle.seek(self._curves_offset)
+            while True:
+                try:
+                    stage, val_fold, epoch, id_, best_val_acc = pickle.load(handle)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                self._curves.setdefault((stage, val_fold, epoch), dict())[id_] = best_val_acc
+                self._curves_offset = handle.tell()
+        return self._curves
+
+    def should_stop(self, id_, stage, val_fold, epoch, best_val_acc):
+        if epoch < self.grace_epochs or epoch == 0:
+            return False
+        others = [acc for other_id, acc in self._read_curves().get((stage, val_fold, epoch), dict()).items()
+                  if other_id != id_]
+        if len(others) < self.min_results_per_epoch:
+            return False
+        return best_val_acc < np.percentile(others, 100 * self.stop_quantile)
+
+    def report_stage(self, id_, stage, best_val_acc_mean):
+        '''
+        Records the result of a finished stage. Returns whether the hcomb goes to the next stage.
+        '''
+        with portalocker.Lock(self.filepath, mode='r+b', timeout=self.timeout) as handle:
+            state = self._read_state(handle)
+            results = state['results'].setdefault(stage, dict())
+            results[id_] = best_val_acc_mean
+            promoted = state['promoted'].setdefault(stage, set())
+            go_to_next_stage = id_ in promoted or (stage < self.last_stage and self._is_top(results, id_))
+            if go_to_next_stage:
+                promoted.add(id_)
+            self._write_state(state, handle)
+            return go_to_next_stage
+
+    def next_promotion(self, hcm):
+        '''
+        Promotes the best finished hcomb (of the highest stage) which is now in the top 1 / eta of its stage and
+        returns it (dict at its next stage, not finished) for run_gpu. None if there is none.
+        '''
+        with portalocker.Lock(self.filepath, mode='r+b', timeout=self.timeout) as handle:
+            state = self._read_state(handle)
+            for stage in sorted(state['results'], reverse=True):
+                if stage >= self.last_stage:
+                    continue
+                results = state['results'][stage]
+                promoted = state['promoted'].setdefault(stage, set())
+                for id_ in sorted(results, key=lambda other_id: (-results[other_id], other_id)):
+                    if id_ in promoted or not self._is_top(results, id_):
+                        continue
+                    h = hcm.get_hcomb_per_id(id_)
+                    if h.STAGE != stage:
+                        # was run further in the meantime (e.g. added again by hand)
+                        promoted.add(id_)
+                        continue
+                    promoted.add(id_)
+                    self._write_state(state, handle)
+                    h = h.__dict__
+                    h['STAGE'] = stage + 1
+                    h['finished'] = False
+                    return h
+            self._write_state(state, handle)
+        return None
+
+
 class RandomSearch:
 
     def __init__(self, metric_used='BAC', STAGE=1, time_steps=1000, label_mode='blockbased'):
@@ -0,0 +1,133 @@
+import argparse
+import glob
+import pickle
+from multiprocessing import Pool
+from os import path
+
+import numpy as np
+from tqdm import tqdm
+
+from scene_instance_store import SceneInstanceStore, load_scene_instance
+
+ALL_FOLDS = list(range(1, 7))
+
+_stores = dict()
+
+
+def _file_statistics(filename_and_store_location):
+    filename, store_location = filename_and_store_location
+    store = None
+    if store_location is not None:
+        if store_location not in _stores:
+            _stores[store_location] = SceneInstanceStore(store_location)
+        store = _stores[store_location]
+
+    x = load_scene_instance(filename, ('x',), store=store)['x'][0].astype(np.float64)
+    mean = np.mean(x, axis=0)
+    m2 = np.sum((x - mean)**2, axis=0)
+    return x.shape[0], mean, m2
+
+
+def merge_statistics(a, b):
+    # (count, mean, sum of squared deviations) of the union (Chan et al.)
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta**2 * (n_a * n_b / n)
+    return n, mean, m2
+
+
+def mean_std(statistics):
+    n, mean, m2 = statistics
+    # same shapes as before: (1, 1, features)
+    return mean[np.newaxis, np.newaxis, :], np.sqrt(m2 / n)[np.newaxis, np.newaxis, :]
+
+
+def fold_statistics(train_path, features=160, n_workers=None):
+    '''
+    One pass over all training files (in a process pool): per fold count, mean and sum of squared deviations.
+    '''
+    store_location = train_path if SceneInstanceStore.exists(train_path) else None
+    tasks = []
+    for fold in ALL_FOLDS:
+        tasks += [(filename, store_location)
+                  for filename in sorted(glob.glob(path.join(train_path, 'fold'+str(fold), 'scene*', '*.npz')))]
+    fold_of_task = [int(path.basename(path.dirname(path.dirname(filename)))[len('fold'):]) for filename, _ in tasks]
+
+    statistics = {fold: (0, np.zeros(features), np.zeros(features)) for fold in ALL_FOLDS}
+    with Pool(n_workers) as pool:
+        for fold, file_statistics in zip(fold_of_task, tqdm(pool.imap(_file_statistics, tasks, chunksize=8),
+                                                            total=len(tasks),
+                                                            desc='input standardization statistics')):
+            statistics[fold] = merge_statistics(statistics[fold], file_statistics)
+    return statistics
+
+
+def create_input_standardization_metrics(train_path, test_paths=(), features=160, n_workers=None,
+                                         overwrite=False):
+    '''
+    Writes all input standardization pickles from one pass over the training data:
+    - train_path/input_standardization_metrics.pickle: (means, stds) with the validation fold k at index k-1
+      (statistics of the other five folds)
+    - train_path/input_standardization_metrics_all_train_folds.pickle: (mean, std) of all six folds
+    - <test path>/input_standardization_metrics.pickle: (mean, std) of all six folds
+    Existing pickles are kept unless overwrite is True.
+    '''
+    outputs = [(path.join(train_path, 'input_standardization_metrics.pickle'), 'per_val_fold'),
+               (path.join(train_path, 'input_standardization_metrics_all_train_folds.pickle'), 'all_folds')]
+    outputs += [(path.join(test_path, 'input_standardization_metrics.pickle'), 'all_folds')
+                for test_path in test_paths]
+    outputs = [(pickle_path, kind) for pickle_path, kind in outputs if overwrite or not path.exists(pickle_path)]
+    if len(outputs) == 0:
+        return
+
+    statistics = fold_statistics(train_path, features, n_workers)
+
+    all_folds = (0, np.zeros(features), np.zeros(features))
+    for fold in ALL_FOLDS:
+        all_folds = merge_statistics(all_folds, statistics[fold])
+
+    means = []
+    stds = []
+    for val_fold in ALL_FOLDS:
+        used_folds = (0, np.zeros(features), np.zeros(features))
+        for fold in ALL_FOLDS:
+            if fold != val_fold:
+                used_folds = merge_statistics(used_folds, statistics[fold])
+        mean, std = mean_std(used_folds)
+        means.append(mean)
+        stds.append(std)
+
+    for pickle_path, kind in outputs:
+        metrics = (means, stds) if kind == 'per_val_fold' else mean_std(all_folds)
+        with open(pickle_path, 'wb') as handle:
+            pickle.dump(metrics, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('train_path',
+                        type=str,
+                        metavar="<train path>",
+                        help="Path containing the training fold* folders, e.g. /mnt/binaural/data/scenes2018/train.")
+    parser.add_argument('-t', '--test_paths',
+                        nargs='*',
+                        default=[],
+                        metavar="<test paths>",
+                        help="Paths (e.g. .../scenes2018/test) which get the statistics of all training folds.")
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        dest="n_workers",
+                        metavar="<number of workers>",
+                        help="Number of processes reading the scene instances (default: number of cpus).")
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help="Recalculate existing pickles.")
+    args = parser.parse_args()
+    create_input_standardization_metrics(args.train_path, args.test_paths, n_workers=args.n_workers,
+                                         overwrite=args.overwrite)
@@ -17,7 +17,8 @@ logger = logging.getLogger('exceptions_logger')
 def my_handler(type, value, tb):
     logger.exception("Uncaught exception: {0}".format(str(value)))
 
-def run_experiment(tmux, STAGE, metric_used, available_gpus, number_of_hcombs, reset_hcombs, time_steps, model_name='LDNN_v1'):
+def run_experiment(tmux, STAGE, metric_used, available_gpus, number_of_hcombs, reset_hcombs, time_steps, model_name='LDNN_v1',
+                   use_sqlite=False):
     use_tmux.set_use_tmux(tmux)
     gpu_str = ''
     if type(available_gpus) is str:
@@ -60,7 +61,7 @@ def run_experiment(tmux, STAGE, metric_used, available_gpus, number_of_hcombs, r
         p_intro.start()
 
 
-        run_function = partial(run.run_gpu, save_path=save_path, reset_hcombs=reset_hcombs)
+        run_function = partial(run.run_gpu, save_path=save_path, reset_hcombs=reset_hcombs, use_sqlite=use_sqlite)
 
         for gpu in available_gpus:
 
@@ -75,7 +76,7 @@ def run_experiment(tmux, STAGE, metric_used, available_gpus, number_of_hcombs, r
     else:
         if type(available_gpus) is list:
             available_gpus = available_gpus[0]
-        run.run_gpu(available_gpus, save_path, reset_hcombs)
+        run.run_gpu(available_gpus, save_path, reset_hcombs, use_sqlite=use_sqlite)
         sys.exit(0)
 
 if __name__ == "__main__":
@@ -134,6 +135,11 @@ if __name__ == "__main__":
                         dest="time_steps",
                         metavar="<time steps>",
                         help="number of time steps for sequences.")
+    parser.add_argument('-db', '--sqlite',
+                        action='store_true',
+                        dest="use_sqlite",
+                        help="hcombs in a SQLite database (hcomb_store.py) instead of the pickles. "
+                             "Used anyway once the database exists.")
     
     args = parser.parse_args()
     run_experiment(**vars(args))
\ No newline at end of file
@@ -1,20 +1,25 @@
 import datetime
 import multiprocessing
 import os
+import pickle
 import shutil
 import sys
+import traceback
 from pprint import pprint
 from timeit import default_timer as timer
 
 import keras.backend as K
 import numpy as np
 from keras.callbacks import ModelCheckpoint
-from keras.layers import Dense, Input, Dropout, CuDNNLSTM
+from keras.layers import Dense, Input, Dropout
 from keras.models import Model
 from keras.optimizers import Adam
 
-import add_to_random_search
+import hcomb_store
 import hyperparameters as hp
+import metrics_log
+import model_cache
+import model_extension as m_ext
 import plotting as plot
 import tensorflow_utils
 import train_utils as tr_utils
@@ -22,11 +27,20 @@ import use_tmux as use_tmux
 import utils
 from my_tmuxprocess import TmuxProcess
 
+# training iterations between two mid epoch states (dataloader, weights, optimizer) -> resume at the exact batch
+MID_EPOCH_STATE_EVERY = 250
+# iterations between two printed iteration lines, the timings of all iterations are in the telemetry csv logs
+ITERATION_LOG_EVERY = 10
 
-def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT):
+
+def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT, scheduler=None):
     ################################################# CROSS VALIDATION
     start = timer()
 
+    # promotion to the next stage and early stopping of dominated runs (shared by all hcombs of the model)
+    if scheduler is None:
+        scheduler = hp.SuccessiveHalvingScheduler(os.path.dirname(model_dir))
+
     NUMBER_OF_CLASSES = 13
     # METRICS 
 
@@ -40,9 +54,7 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
 
     go_to_next_stage = False
 
-    subsample_time_steps = False
-    if h.TIME_STEPS >= 2000:
-        subsample_time_steps = True
+    subsample_time_steps = utils.subsample_time_steps(h)
 
     print(5 * '\n' + 'Starting Cross Validation STAGE {}...\n'.format(h.STAGE))
 
@@ -58,35 +70,14 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
 
         print('\nBuild model...\n')
 
-        time_steps = h.TIME_STEPS if not subsample_time_steps else h.TIME_STEPS // 2
-        x = Input(batch_shape=(h.BATCH_SIZE, time_steps, h.N_FEATURES), name='Input', dtype='float32')
-        y = x
-
-        # Input dropout
-        y = Dropout(h.INPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, h.N_FEATURES))(y)
-        for units in h.UNITS_PER_LAYER_LSTM:
-            y = CuDNNLSTM(units, return_sequences=True, stateful=True)(y)
-
-            # LSTM Output dropout
-            y = Dropout(h.LSTM_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
-        for units in h.UNITS_PER_LAYER_MLP:
-            if units != h.N_CLASSES:
-                y = Dense(units, activation='relu')(y)
-            else:
-                y = Dense(units, activation='linear')(y)
-
-            # MLP Output dropout but not last layer
-            if units != h.N_CLASSES:
-                y = Dropout(h.MLP_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
-        model = Model(x, y)
+        time_steps = utils.model_time_steps(h)
+        loss_weights = tensorflow_utils.get_loss_weights(TRAIN_FOLDS, h.TRAIN_SCENES, h.LABEL_MODE)
+        # the model is compiled here already, a model with the same architecture (e.g. of the previous fold) is reused
+        model, model_from_cache = model_cache.compiled_model(h, time_steps, loss_weights)
 
         model.summary()
         print(5 * '\n')
 
-        my_loss = tensorflow_utils.my_loss_builder(h.MASK_VAL,
-                                                   tensorflow_utils.get_loss_weights(TRAIN_FOLDS, h.TRAIN_SCENES,
-                                                                                     h.LABEL_MODE))
-
         ################################################# LOAD CHECKPOINTED MODEL
 
         model_is_resumed = False
@@ -107,16 +98,11 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
                 h.val_acc[val_fold - 1] = val_acc
                 hcm.replace_at_id(ID, h)
 
-        ################################################# COMPILE MODEL
-
-        adam = Adam(lr=h.LEARNING_RATE, clipnorm=1.)
-        model.compile(optimizer=adam, loss=my_loss, metrics=None, sample_weight_mode='temporal')
-
-        print('\nModel compiled.\n')
+        print('\nModel {}.\n'.format('reinitialized (compiled graph reused)' if model_from_cache else 'compiled'))
 
         ################################################# DATA LOADER
         use_multithreading = True
-        BUFFER = utils.get_buffer_size_wrt_time_steps(h.TIME_STEPS)
+        BUFFER = utils.get_buffer_size_wrt_time_steps(h)
 
         train_loader, val_loader = tr_utils.create_dataloaders(h.LABEL_MODE, TRAIN_FOLDS, h.TRAIN_SCENES,
                                                                h.BATCH_SIZE,
@@ -142,11 +128,18 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
         # training phase
         train_phase = tr_utils.Phase('train', model, train_loader, BUFFER, *args,
                                      no_new_weighting=True if 'nnw' in model_save_dir else False,
-                                     subsample_time_steps=subsample_time_steps)
+                                     subsample_time_steps=subsample_time_steps,
+                                     mid_epoch_state_path=os.path.join(model_save_dir, 'mid_epoch_state_train.pickle'),
+                                     mid_epoch_state_every=MID_EPOCH_STATE_EVERY,
+                                     recurrent_dropout_mode=h.RECURRENT_DROPOUT_MODE,
+                                     telemetry_path=os.path.join(model_save_dir, 'telemetry_train.csv'),
+                                     print_every=ITERATION_LOG_EVERY)
 
         # validation phase
         val_phase = tr_utils.Phase('val', model, val_loader, BUFFER, *args,
-                                   no_new_weighting=True if 'nnw' in model_save_dir else False)
+                                   no_new_weighting=True if 'nnw' in model_save_dir else False,
+                                   telemetry_path=os.path.join(model_save_dir, 'telemetry_val.csv'),
+                                   print_every=ITERATION_LOG_EVERY)
 
         # needed for early stopping
         best_val_acc = -1 if not model_is_resumed else best_val_acc_
@@ -154,58 +147,64 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
         best_epoch = 0 if not model_is_resumed else best_epoch_
         epochs_without_improvement = 0 if not model_is_resumed else epochs_without_improvement_
 
-        if model_is_resumed:
-            old_metrics = utils.load_metrics(model_save_dir)
+        # per epoch records and per iteration values appended after every epoch
+        run_metrics_log = metrics_log.MetricsLog(model_save_dir)
+
+        if not model_is_resumed:
+            run_metrics_log.truncate(0)
+        else:
+            epochs_done = run_metrics_log.n_epochs
+            if epochs_finished_old is not None:
+                epochs_done = epochs_done if epochs_finished > epochs_done else epochs_finished
+            # the iterations of the epochs after the checkpoint are cut exactly
+            run_metrics_log.truncate(epochs_done)
 
             # merge metrics
-            h.METRIC = old_metrics['metric']
+            h.METRIC = run_metrics_log.metric
             train_phase.metric = h.METRIC
             val_phase.metric = h.METRIC
 
-            train_iterations_done = old_metrics['train_losses'].shape[0]
-            val_iterations_done = old_metrics['val_losses'].shape[0]
-            epochs_done = old_metrics['val_accs'].shape[0]
-            if epochs_finished_old is not None:
-                epochs_done_old = epochs_done
-                epochs_done = epochs_done if epochs_finished > epochs_done else epochs_finished
-                train_iterations_done = int(train_iterations_done / epochs_done_old) * epochs_done
-                val_iterations_done = int(val_iterations_done / epochs_done_old) * epochs_done
-
-            train_phase.losses = old_metrics['train_losses'].tolist()[:train_iterations_done]
-            train_phase.accs = old_metrics['train_accs'].tolist()[:epochs_done]
-            val_phase.losses = old_metrics['val_losses'].tolist()[:val_iterations_done]
-            val_phase.accs = old_metrics['val_accs'].tolist()[:epochs_done]
-            val_phase.accs_bac2 = old_metrics['val_accs_bac2'].tolist()[:epochs_done]
-            val_phase.class_accs = old_metrics['val_class_accs'].tolist()[:epochs_done]
-            val_phase.class_accs_bac2 = old_metrics['val_class_accs_bac2'].tolist()[:epochs_done]
-            val_phase.class_scene_accs = old_metrics['val_class_scene_accs'].tolist()[:epochs_done]
-            val_phase.class_scene_accs_bac2 = old_metrics['val_class_scene_accs_bac2'].tolist()[:epochs_done]
-            val_phase.scene_accs = old_metrics['val_scene_accs'].tolist()[:epochs_done]
-            val_phase.scene_accs_bac2 = old_metrics['val_scene_accs_bac2'].tolist()[:epochs_done]
-            train_phase.sens_spec_class_scene = old_metrics['train_sens_spec_class_scene'].tolist()[:epochs_done]
-            val_phase.sens_spec_class_scene = old_metrics['val_sens_spec_class_scene'].tolist()[:epochs_done]
-            val_phase.sens_spec_class = old_metrics['val_sens_spec_class'].tolist()[:epochs_done]
-
-            if 'global_gradient_norm' in old_metrics:
-                train_phase.global_gradient_norms = old_metrics['global_gradient_norm'].tolist()[
-                                                    :train_iterations_done]
+            # the per iteration values stay in the log, the phases hold those of the running epoch only
+            train_phase.accs = run_metrics_log.epoch_values('train_accs')
+            val_phase.accs = run_metrics_log.epoch_values('val_accs')
+            val_phase.accs_bac2 = run_metrics_log.epoch_values('val_accs_bac2')
+            val_phase.class_accs = run_metrics_log.epoch_values('val_class_accs')
+            val_phase.class_accs_bac2 = run_metrics_log.epoch_values('val_class_accs_bac2')
+            val_phase.class_scene_accs = run_metrics_log.epoch_values('val_class_scene_accs')
+            val_phase.class_scene_accs_bac2 = run_metrics_log.epoch_values('val_class_scene_accs_bac2')
+            val_phase.scene_accs = run_metrics_log.epoch_values('val_scene_accs')
+            val_phase.scene_accs_bac2 = run_metrics_log.epoch_values('val_scene_accs_bac2')
+            train_phase.sens_spec_class_scene = run_metrics_log.epoch_values('train_sens_spec_class_scene')
+            val_phase.sens_spec_class_scene = run_metrics_log.epoch_values('val_sens_spec_class_scene')
+            val_phase.sens_spec_class = run_metrics_log.epoch_values('val_sens_spec_class')
 
             best_val_acc = np.max(val_phase.accs)
-            best_val_acc_bac2 = old_metrics['val_accs_bac2'][np.argmax(val_phase.accs)]
+            best_val_acc_bac2 = val_phase.accs_bac2[int(np.argmax(val_phase.accs))]
 
             # set the dataloaders to correct epoch
             train_phase.resume_from_epoch(h.epochs_finished[val_fold - 1] + 1)
             val_phase.resume_from_epoch(h.epochs_finished[val_fold - 1] + 1)
 
+        if train_phase.load_mid_epoch_state() > 0:
+            print('Resuming epoch {} at training iteration {}.'.format(train_phase.e + 1,
+                                                                       train_phase.resumed_iteration + 1))
+
         stage_was_finished = True
+        # stopped by the scheduler: the stage is finished with the epochs done so far (never an already finished stage)
+        stopped_early = False
 
         loss_is_nan = False
 
-        for e in range(h.epochs_finished[val_fold - 1], h.MAX_EPOCHS):
+        for e in range(h.epochs_finished[val_fold - 1], scheduler.max_epochs(h.STAGE, h.MAX_EPOCHS)):
 
             # early stopping
             if epochs_without_improvement >= h.PATIENCE_IN_EPOCHS and h.PATIENCE_IN_EPOCHS > 0:
                 break
+            elif scheduler.should_stop(ID, h.STAGE, val_fold, e, best_val_acc):
+                print('Stopped: best val acc {} after {} epochs is dominated by the other hcombs of stage {}.'
+                      .format(best_val_acc, e, h.STAGE))
+                stopped_early = True
+                break
             else:
                 stage_was_finished = False
 
@@ -221,29 +220,27 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
 
             tr_utils.update_latest_model_ckp(model_ckp_last, model_save_dir, e, val_phase.accs[-1])
             tr_utils.update_best_model_ckp(model_ckp_best, model_save_dir, e, val_phase.accs[-1])
+            train_phase.remove_mid_epoch_state()
 
-            metrics = {
-                'metric': h.METRIC,
-                'train_losses': np.array(train_phase.losses),
-                'train_accs': np.array(train_phase.accs),
-                'val_losses': np.array(val_phase.losses),
-                'val_accs': np.array(val_phase.accs),
-                'val_accs_bac2': np.array(val_phase.accs_bac2),
-                'val_class_accs': np.array(val_phase.class_accs),
-                'val_class_accs_bac2': np.array(val_phase.class_accs_bac2),
-                'val_class_scene_accs': np.array(val_phase.class_scene_accs),
-                'val_class_scene_accs_bac2': np.array(val_phase.class_scene_accs_bac2),
-                'val_scene_accs': np.array(val_phase.scene_accs),
-                'val_scene_accs_bac2': np.array(val_phase.scene_accs_bac2),
-                'train_sens_spec_class_scene': np.array(train_phase.sens_spec_class_scene),
-                'val_sens_spec_class_scene': np.array(val_phase.sens_spec_class_scene),
-                'val_sens_spec_class': np.array(val_phase.sens_spec_class)
-            }
-
+            iteration_values = {'train_losses': train_phase.losses, 'val_losses': val_phase.losses}
             if GLOBAL_GRADIENT_NORM_PLOT:
-                metrics['global_gradient_norm'] = np.array(train_phase.global_gradient_norms)
-
-            utils.pickle_metrics(metrics, model_save_dir)
+                iteration_values['global_gradient_norm'] = train_phase.global_gradient_norms
+            run_metrics_log.append(h.METRIC, {
+                'train_accs': train_phase.accs[-1],
+                'val_accs': val_phase.accs[-1],
+                'val_accs_bac2': val_phase.accs_bac2[-1],
+                'val_class_accs': val_phase.class_accs[-1],
+                'val_class_accs_bac2': val_phase.class_accs_bac2[-1],
+                'val_class_scene_accs': val_phase.class_scene_accs[-1],
+                'val_class_scene_accs_bac2': val_phase.class_scene_accs_bac2[-1],
+                'val_scene_accs': val_phase.scene_accs[-1],
+                'val_scene_accs_bac2': val_phase.scene_accs_bac2[-1],
+                'train_sens_spec_class_scene': train_phase.sens_spec_class_scene[-1],
+                'val_sens_spec_class_scene': val_phase.sens_spec_class_scene[-1],
+                'val_sens_spec_class': val_phase.sens_spec_class[-1]
+            }, iteration_values)
+            for values in iteration_values.values():
+                del values[:]
 
             if val_phase.accs[-1] > best_val_acc:
                 best_val_acc = val_phase.accs[-1]
@@ -255,19 +252,24 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
 
             hcm.finish_epoch(ID, h, val_phase.accs[-1], best_val_acc, val_phase.accs_bac2[-1], best_val_acc_bac2,
                              val_fold - 1, e + 1, best_epoch, (timer() - start) / 60)
+            scheduler.report_epoch(ID, h.STAGE, val_fold, e + 1, best_val_acc)
 
             if INTERMEDIATE_PLOTS:
-                plot.plot_metrics(metrics, model_save_dir)
+                plot.plot_metrics(run_metrics_log.load(), model_save_dir)
 
             if GLOBAL_GRADIENT_NORM_PLOT:
-                plot.plot_global_gradient_norm(np.array(train_phase.global_gradient_norms), model_save_dir,
-                                               epochs_done=e + 1)
+                plot.plot_global_gradient_norm(run_metrics_log.iteration_values('global_gradient_norm'),
+                                               model_save_dir, epochs_done=e + 1)
 
-            del metrics
+        # metrics.pickle for the analysis scripts
+        run_metrics_log.export()
+
+        train_phase.close()
+        val_phase.close()
 
         if not loss_is_nan:
 
-            if not stage_was_finished:
+            if not stage_was_finished or stopped_early:
 
                 best_val_class_accuracies_over_folds[val_fold - 1] = val_phase.class_accs[best_epoch - 1]
                 best_val_acc_over_folds[val_fold - 1] = val_phase.accs[best_epoch - 1]
@@ -316,18 +318,14 @@ def run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM
             else:
                 metrics_over_folds = utils.load_metrics(model_dir)
 
-            # STAGE thresholds
-            stage_thresholds = {1: 0.81, 2: 0.81, 3: np.inf}  # 3 is the last stage
-
-            if metrics_over_folds['best_val_acc_mean_over_folds'] >= stage_thresholds[h.STAGE]:
-                go_to_next_stage = True
+            # top 1 / eta of the stage so far -> next stage, the others may be promoted later by run_gpu
+            go_to_next_stage = scheduler.report_stage(ID, h.STAGE, metrics_over_folds['best_val_acc_mean_over_folds'])
 
             if go_to_next_stage:
                 hcm.next_stage(ID, h)
 
             else:
-                if h.STAGE == 3 or stage_thresholds[h.STAGE] != np.inf:
-                    hcm.finish_hcomb(ID, h)
+                hcm.finish_hcomb(ID, h)
 
             return go_to_next_stage
 
@@ -356,9 +354,7 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
         from keras import regularizers
         reg = regularizers.l2(0.0000459)
 
-    subsample_time_steps = False
-    if h.TIME_STEPS >= 2000:
-        subsample_time_steps = True
+    subsample_time_steps = utils.subsample_time_steps(h)
 
     if h.TIME_STEPS >= 2000:
         from keras import regularizers
@@ -369,14 +365,16 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
 
     print('\nBuild model...\n')
 
-    time_steps = h.TIME_STEPS if not subsample_time_steps else h.TIME_STEPS // 2
+    time_steps = utils.model_time_steps(h)
     x = Input(batch_shape=(h.BATCH_SIZE, time_steps, h.N_FEATURES), name='Input', dtype='float32')
     y = x
 
     # Input dropout
     y = Dropout(h.INPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, h.N_FEATURES))(y)
     for units in h.UNITS_PER_LAYER_LSTM:
-        y = CuDNNLSTM(units, return_sequences=True, stateful=True, kernel_regularizer=reg, recurrent_regularizer=reg)(y)
+        y = m_ext.recurrent_layer(units, h.RECURRENT_DROPOUT, h.RECURRENT_DROPOUT_MODE,
+                                  return_sequences=True, stateful=True, kernel_regularizer=reg,
+                                  recurrent_regularizer=reg)(y)
 
         # LSTM Output dropout
         y = Dropout(h.LSTM_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
@@ -432,7 +430,7 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
 
     ################################################# DATA LOADER
     use_multithreading = True
-    BUFFER = utils.get_buffer_size_wrt_time_steps(h.TIME_STEPS)
+    BUFFER = utils.get_buffer_size_wrt_time_steps(h)
 
     train_loader = tr_utils.create_train_dataloader(h.LABEL_MODE, ALL_FOLDS, -1, h.BATCH_SIZE, h.TIME_STEPS,
                                                     h.MAX_EPOCHS, 160, 13,
@@ -451,35 +449,37 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
     train_phase = tr_utils.Phase('train', model, train_loader, BUFFER, *args,
                                  no_new_weighting=True if 'nnw' in model_save_dir else False,
                                  changbin_recurrent_dropout=True if 'changbin' in model_dir else False,
-                                 subsample_time_steps=subsample_time_steps)
+                                 subsample_time_steps=subsample_time_steps,
+                                 mid_epoch_state_path=os.path.join(model_save_dir, 'mid_epoch_state_train.pickle'),
+                                 mid_epoch_state_every=MID_EPOCH_STATE_EVERY,
+                                 recurrent_dropout_mode=h.RECURRENT_DROPOUT_MODE,
+                                 telemetry_path=os.path.join(model_save_dir, 'telemetry_train.csv'),
+                                 print_every=ITERATION_LOG_EVERY)
 
-    if model_is_resumed:
-        try:
-            old_metrics = utils.load_metrics(model_save_dir, name="metrics_train")
+    run_metrics_log = metrics_log.MetricsLog(model_save_dir, name="metrics_train")
 
+    if not model_is_resumed:
+        run_metrics_log.truncate(0)
+    else:
+        epochs_done = run_metrics_log.n_epochs
+        if epochs_finished_old is not None:
+            epochs_done = epochs_done if epochs_finished > epochs_done else epochs_finished
+        run_metrics_log.truncate(epochs_done)
+
+        if run_metrics_log.n_epochs > 0:
             # merge metrics
-            h.METRIC = old_metrics['metric']
+            h.METRIC = run_metrics_log.metric
             train_phase.metric = h.METRIC
 
-            train_iterations_done = old_metrics['train_losses'].shape[0]
-            epochs_done = old_metrics['train_accs'].shape[0]
-            if epochs_finished_old is not None:
-                epochs_done_old = epochs_done
-                epochs_done = epochs_done if epochs_finished > epochs_done else epochs_finished
-                train_iterations_done = int(train_iterations_done / epochs_done_old) * epochs_done
-
-            train_phase.losses = old_metrics['train_losses'].tolist()[:train_iterations_done]
-            train_phase.accs = old_metrics['train_accs'].tolist()[:epochs_done]
-            train_phase.sens_spec_class_scene = old_metrics['train_sens_spec_class_scene'].tolist()[:epochs_done]
-
-            if 'global_gradient_norm' in old_metrics:
-                train_phase.global_gradient_norms = old_metrics['global_gradient_norm'].tolist()[
-                                                    :train_iterations_done]
-        except:
-            pass
+            train_phase.accs = run_metrics_log.epoch_values('train_accs')
+            train_phase.sens_spec_class_scene = run_metrics_log.epoch_values('train_sens_spec_class_scene')
 
         train_phase.resume_from_epoch(h.epochs_finished[val_fold - 1] + 1)
 
+    if train_phase.load_mid_epoch_state() > 0:
+        print('Resuming epoch {} at training iteration {}.'.format(train_phase.e + 1,
+                                                                   train_phase.resumed_iteration + 1))
+
     for e in range(h.epochs_finished[val_fold - 1], h.MAX_EPOCHS):
 
         train_loss_is_nan, _ = train_phase.run()
@@ -491,28 +491,30 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
             break
 
         tr_utils.update_latest_model_ckp(model_ckp_last, model_save_dir, e, 0.0)
+        train_phase.remove_mid_epoch_state()
 
-        metrics = {
-            'metric': h.METRIC,
-            'train_losses': np.array(train_phase.losses),
-            'train_accs': np.array(train_phase.accs),
-            'train_sens_spec_class_scene': np.array(train_phase.sens_spec_class_scene),
-        }
-
+        iteration_values = {'train_losses': train_phase.losses}
         if GLOBAL_GRADIENT_NORM_PLOT:
-            metrics['global_gradient_norm'] = np.array(train_phase.global_gradient_norms)
-
-        utils.pickle_metrics(metrics, model_save_dir, name="metrics_train")
+            iteration_values['global_gradient_norm'] = train_phase.global_gradient_norms
+        run_metrics_log.append(h.METRIC, {
+            'train_accs': train_phase.accs[-1],
+            'train_sens_spec_class_scene': train_phase.sens_spec_class_scene[-1],
+        }, iteration_values)
+        for values in iteration_values.values():
+            del values[:]
 
         hcm.finish_epoch(ID, h, 0.0, 0.0, 0.0, 0.0, val_fold - 1, e + 1, e + 1, (timer() - start) / 60)
 
         if INTERMEDIATE_PLOTS:
-            plot.plot_metrics(metrics, model_save_dir)
+            plot.plot_metrics(run_metrics_log.load(), model_save_dir)
 
         if GLOBAL_GRADIENT_NORM_PLOT:
-            plot.plot_global_gradient_norm(np.array(train_phase.global_gradient_norms), model_save_dir,
+            plot.plot_global_gradient_norm(run_metrics_log.iteration_values('global_gradient_norm'), model_save_dir,
                                            epochs_done=e + 1)
 
+    run_metrics_log.export()
+    train_phase.close()
+
     del model
     K.clear_session()
 
@@ -520,22 +522,28 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
 
     ################################################## TESTING
 
-    test_loader = tr_utils.create_test_dataloader(h.LABEL_MODE)
+    # the test scene instances are chunked into (BATCH_SIZE, TIME_STEPS) batches, the states of the rows are kept
+    # while a scene instance continues (instead of one whole scene instance per batch with batch size 1)
+    test_loader = tr_utils.create_test_dataloader(h.LABEL_MODE, stateful=True, BATCHSIZE=h.BATCH_SIZE,
+                                                  TIMESTEPS=h.TIME_STEPS,
+                                                  BUFFER=utils.get_buffer_size_wrt_time_steps(h))
 
     ################################################# MODEL DEFINITION
 
     print('\nBuild model for testing...\n')
 
-    x = Input(batch_shape=(1, None, h.N_FEATURES), name='Input', dtype='float32')
+    x = Input(batch_shape=(h.BATCH_SIZE, h.TIME_STEPS, h.N_FEATURES), name='Input', dtype='float32')
     y = x
 
     # Input dropout
-    y = Dropout(h.INPUT_DROPOUT, noise_shape=(1, 1, h.N_FEATURES))(y)
+    y = Dropout(h.INPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, h.N_FEATURES))(y)
     for units in h.UNITS_PER_LAYER_LSTM:
-        y = CuDNNLSTM(units, return_sequences=True, stateful=True, kernel_regularizer=reg, recurrent_regularizer=reg)(y)
+        # no dropout for testing (the DropConnect layers have the weights of the plain ones)
+        y = m_ext.recurrent_layer(units, return_sequences=True, stateful=True, kernel_regularizer=reg,
+                                  recurrent_regularizer=reg)(y)
 
         # LSTM Output dropout
-        y = Dropout(h.LSTM_OUTPUT_DROPOUT, noise_shape=(1, 1, units))(y)
+        y = Dropout(h.LSTM_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
     for units in h.UNITS_PER_LAYER_MLP:
         if units != h.N_CLASSES:
             y = Dense(units, activation='relu', kernel_regularizer=reg, kernel_initializer=kernel_initializer_dense)(y)
@@ -544,7 +552,7 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
 
         # MLP Output dropout but not last layer
         if units != h.N_CLASSES:
-            y = Dropout(h.MLP_OUTPUT_DROPOUT, noise_shape=(1, 1, units))(y)
+            y = Dropout(h.MLP_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
     model = Model(x, y)
 
     model.summary()
@@ -560,9 +568,12 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
         print('\nModel compiled.\n')
 
         test_phase = tr_utils.TestPhase(model, test_loader, h.OUTPUT_THRESHOLD, h.MASK_VAL, 1, val_fold_str, model_save_dir,
-                                        metric=('BAC', 'BAC2'), ret=('final', 'per_class', 'per_class_scene', 'per_scene'))
+                                        metric=('BAC', 'BAC2'), ret=('final', 'per_class', 'per_class_scene', 'per_scene'),
+                                        telemetry_path=os.path.join(model_save_dir, 'telemetry_test.csv'),
+                                        print_every=ITERATION_LOG_EVERY)
 
         test_loss_is_nan, _ = test_phase.run()
+        test_phase.close()
 
         metrics_test = {
             'metric': h.METRIC,
@@ -581,6 +592,7 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
         utils.pickle_metrics(metrics_test, model_save_dir)
 
     else:
+        test_loader.close()
         print('\n\n\n---------------------------------------\n\n\n')
         print("ERROR: No testing possible, because no trained model saved.")
         print('\n\n\n---------------------------------------\n\n\n')
@@ -590,43 +602,74 @@ def run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_N
 
 
 def run_hcomb(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT, pipe_send_end,
-              final_experiment=False):
+              final_experiment=False, scheduler=None, n_cores_to_use=3):
     # Memory leak fix
     cfg = K.tf.ConfigProto()
     cfg.gpu_options.allow_growth = True
-    n_cores_to_use = 3
     cfg.intra_op_parallelism_threads = n_cores_to_use
     cfg.inter_op_parallelism_threads = n_cores_to_use
     K.set_session(K.tf.Session(config=cfg))
 
 
     # LOGGING
-    sys.stdout = utils.UnbufferedLogAndPrint(os.path.join(model_dir, 'logfile'), sys.stdout)
-    sys.stderr = utils.UnbufferedLogAndPrint(os.path.join(model_dir, 'errorfile'), sys.stderr)
+    log_stdout = utils.BufferedLogAndPrint(os.path.join(model_dir, 'logfile'), sys.stdout)
+    log_stderr = utils.BufferedLogAndPrint(os.path.join(model_dir, 'errorfile'), sys.stderr)
+    sys.stdout = log_stdout
+    sys.stderr = log_stderr
 
-    ################################################# HCOMB
-
-    print(5 * '\n' + 'Hyperparameter combination...\n')
-    pprint(h.__dict__)
-
-    if not final_experiment:
-        go_to_next_stage = run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT)
-    else:
-        go_to_next_stage = run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT)
+    try:
+        ################################################# HCOMB
 
-    pipe_send_end.send(go_to_next_stage)
+        print(5 * '\n' + 'Hyperparameter combination...\n')
+        pprint(h.__dict__)
 
-
-def run_gpu(gpu, save_path, reset_hcombs, INTERMEDIATE_PLOTS=True, GLOBAL_GRADIENT_NORM_PLOT=True, final_experiment=False):
-
-    hcm = hp.HCombManager(save_path)
+        if not final_experiment:
+            go_to_next_stage = run_hcomb_cv(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT,
+                                            scheduler)
+        else:
+            go_to_next_stage = run_hcomb_final(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT)
+
+        pipe_send_end.send(go_to_next_stage)
+    except BaseException:
+        # multiprocessing prints the traceback to the terminal after the log is closed -> errorfile here
+        log_stderr.write_log(traceback.format_exc())
+        raise
+    finally:
+        # run_hcomb is the target of a child process -> no atexit handlers
+        log_stdout.close()
+        log_stderr.close()
+
+
+def run_gpu(gpu, save_path, reset_hcombs, INTERMEDIATE_PLOTS=True, GLOBAL_GRADIENT_NORM_PLOT=True, final_experiment=False,
+            use_sqlite=False, n_cores_to_use=3, current_hcomb_path=None, max_epochs_per_stage=None):
+    '''
+    Runs hcombs (one process each) until there are no more to run. gpu: CUDA_VISIBLE_DEVICES ('' -> cpu only).
+    With current_hcomb_path the running hcomb is kept in this file: a hcomb of a crashed run_gpu (e.g. restarted by
+    worker_pool.py) is resumed first. max_epochs_per_stage: stage -> epochs of the stage (SuccessiveHalvingScheduler).
+    '''
+
+    # SQLite store if asked for or already existing in save_path, otherwise the pickles
+    hcm = hcomb_store.create_hcomb_manager(save_path, use_sqlite=use_sqlite)
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, max_epochs_per_stage=max_epochs_per_stage)
 
     os.environ['CUDA_VISIBLE_DEVICES'] = gpu
     # K.set_session(K.tf.Session(config=K.tf.ConfigProto(intra_op_parallelism_threads=n_cores_to_use,
     #                                                    inter_op_parallelism_threads=n_cores_to_use)))
 
     while True:
-        h = hcm.poll_hcomb()
+        h = None
+        resumed = False
+        if current_hcomb_path is not None and os.path.exists(current_hcomb_path):
+            with open(current_hcomb_path, 'rb') as handle:
+                h = pickle.load(handle)
+            resumed = True
+            print('Resuming hcomb_{} of the crashed run.'.format(h['ID']))
+        if h is None and not final_experiment:
+            # finished hcombs which made it into the top of their stage in the meantime come first
+            h = scheduler.next_promotion(hcm)
+        promoted = h is not None and not resumed
+        if h is None:
+            h = hcm.poll_hcomb()
         if h is None:
             return gpu
 
@@ -638,20 +681,28 @@ def run_gpu(gpu, save_path, reset_hcombs, INTERMEDIATE_PLOTS=True, GLOBAL_GRADIE
 
         if h.finished:
             print('Hyperparameter Combination for this model version already evaluated. ABORT.')
+            if resumed:
+                os.remove(current_hcomb_path)
             continue
 
+        if current_hcomb_path is not None and not resumed:
+            with open(current_hcomb_path + '.tmp', 'wb') as handle:
+                pickle.dump(h.__dict__, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(current_hcomb_path + '.tmp', current_hcomb_path)
+
         if final_experiment:
-            hostname, batch_size = utils.get_hostname_batch_size_wrt_time_steps(h.TIME_STEPS, gpu)
-            assert batch_size >= h.BATCH_SIZE, """Final Experiment has to be run with at most the same batch_size.
-            Hyperparameter search on hostname: {} with batch size: {}. Now hostname: {} with batch size: {}.  
-                                                """.format(h.HOSTNAME, h.BATCH_SIZE, hostname, batch_size)
+            # the batch size of the search has to fit, not to be the fastest one of this machine
+            hostname, max_batch_size = utils.get_hostname_max_batch_size_wrt_time_steps(h)
+            assert h.BATCH_SIZE <= max_batch_size, """Final Experiment has to be run with the batch_size of the search.
+            Hyperparameter search on hostname: {} with batch size: {}. Now hostname: {} with at most batch size: {}.
+                                                """.format(h.HOSTNAME, h.BATCH_SIZE, hostname, max_batch_size)
 
         else:
-            hcm.set_hostname_and_batch_size(ID, h, *utils.get_hostname_batch_size_wrt_time_steps(h.TIME_STEPS, gpu))
+            hcm.set_hostname_and_batch_size(ID, h, *utils.get_hostname_batch_size_wrt_time_steps(h))
 
         model_dir = os.path.join(save_path, 'hcomb_' + str(ID))
 
-        if reset_hcombs and already_contained and os.path.exists(model_dir):
+        if reset_hcombs and already_contained and not promoted and not resumed and os.path.exists(model_dir):
             shutil.rmtree(model_dir)
 
         os.makedirs(model_dir, exist_ok=True)
@@ -662,21 +713,25 @@ def run_gpu(gpu, save_path, reset_hcombs, INTERMEDIATE_PLOTS=True, GLOBAL_GRADIE
         if use_tmux.use_tmux:
             p_hcomb = TmuxProcess(session_name=use_tmux.session_name, target=run_hcomb,
                                   args=(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT, send_end,
-                                        final_experiment),
+                                        final_experiment, scheduler, n_cores_to_use),
                                   name='gpu{}_run_hcomb_{}'.format(gpu, ID))
         else:
             p_hcomb = multiprocessing.Process(target=run_hcomb,
                                               args=(h, ID, hcm, model_dir, INTERMEDIATE_PLOTS, GLOBAL_GRADIENT_NORM_PLOT,
-                                              send_end, final_experiment))
+                                              send_end, final_experiment, scheduler, n_cores_to_use))
 
         print('Running hcomb_{} on GPU {}.'.format(ID, gpu))
         print('Start: {}'.format(datetime.datetime.now().isoformat()))
         p_hcomb.start()
+        # just the child holds the send end -> no result instead of a blocking recv if the child died
+        send_end.close()
         p_hcomb.join()
         print('Exitcode {}.'.format(p_hcomb.exitcode))
         if p_hcomb.exitcode == 1:
             print('Aborted by CTRL + C.')
         print('End: {}\n'.format(datetime.datetime.now().isoformat()))
-        go_to_next_stage = recv_end.recv()
+        go_to_next_stage = recv_end.recv() if recv_end.poll() else False
         if go_to_next_stage:
-            add_to_random_search.add_hcombs_from_ids(ID, save_path)
+            hcm.add_ids_to_run([ID])
+        if current_hcomb_path is not None:
+            os.remove(current_hcomb_path)
@@ -0,0 +1,154 @@
+import argparse
+import glob
+import re
+from multiprocessing import Pool
+from os import path
+
+import numpy as np
+from tqdm import tqdm
+
+from scene_instance_store import _npz_shape
+
+METADATA_INDEX_NAME = 'metadata_index.npz'
+
+COLUMNS = ('filenames', 'folds', 'scenes', 'scene_instance_ids', 'lengths_instant', 'lengths_blockbased',
+           'positives_instant', 'negatives_instant', 'positives_blockbased', 'negatives_blockbased',
+           'frame_offsets', 'x_byte_offsets')
+
+fold_nb_regex = re.compile('fold([0-9]+)[_/]')
+scene_nb_regex = re.compile('scene([0-9]+)[_/]')
+
+
+def _read_metadata(filename):
+    with np.load(filename) as data:
+        _, x_length, features = _npz_shape(data, 'x')
+        y = data['y'][0]
+        y_block = data['y_block'][0]
+    # the dataloader places the features by the label lengths (and the packed store by the instant ones)
+    if not x_length == y.shape[0] == y_block.shape[0]:
+        raise ValueError('{}: lengths of x ({}), y ({}) and y_block ({}) differ.'.format(filename, x_length, y.shape[0],
+                                                                                       y_block.shape[0]))
+    return (features, y.shape[0], y_block.shape[0],
+            np.sum(y == 1, axis=0), np.sum(y == 0, axis=0),
+            np.sum(y_block == 1, axis=0), np.sum(y_block == 0, axis=0))
+
+
+def create_metadata_index(location_path, n_workers=None):
+    '''
+    Creates the metadata index of all scene instances (fold*/scene*/*.npz) below location_path in one parallel pass.
+    Only the (small) labels are decompressed, the feature shapes are read from the npz headers.
+
+    The scene instance ids follow the original scheme: files sorted over all folds, ids counted per scene.
+    The frame (and byte) offsets are the positions within the packed arrays of scene_instance_store.py.
+    '''
+    filenames = sorted(glob.glob(path.join(location_path, 'fold*', 'scene*', '*.npz')))
+    if len(filenames) == 0:
+        raise ValueError('no scene instances found in {}.'.format(location_path))
+    relative_names = [path.relpath(filename, location_path) for filename in filenames]
+
+    with Pool(n_workers) as pool:
+        metadata = list(tqdm(pool.imap(_read_metadata, filenames, chunksize=16), total=len(filenames),
+                             desc='creating metadata index'))
+
+    features, lengths_instant, lengths_blockbased, pos_i, neg_i, pos_b, neg_b = zip(*metadata)
+
+    folds = np.array([int(fold_nb_regex.findall(name)[0]) for name in relative_names], dtype=np.int32)
+    scenes = np.array([int(scene_nb_regex.findall(name)[0]) for name in relative_names], dtype=np.int32)
+
+    scene_instance_ids = np.zeros(len(filenames), dtype=np.float64)
+    scene_counts = dict()
+    for i, scene_number in enumerate(scenes):
+        scene_counts[scene_number] = scene_counts.get(scene_number, 0) + 1
+        scene_instance_ids[i] = scene_number*1e4 + scene_counts[scene_number]
+
+    lengths_instant = np.array(lengths_instant, dtype=np.int64)
+    frame_offsets = np.zeros(len(filenames), dtype=np.int64)
+    for fold in np.unique(folds):
+        in_fold = np.where(folds == fold)[0]
+        frame_offsets[in_fold[1:]] = np.cumsum(lengths_instant[in_fold])[:-1]
+
+    np.savez(path.join(location_path, METADATA_INDEX_NAME),
+             filenames=np.array(relative_names),
+             folds=folds,
+             scenes=scenes,
+             scene_instance_ids=scene_instance_ids,
+             lengths_instant=lengths_instant,
+             lengths_blockbased=np.array(lengths_blockbased, dtype=np.int64),
+             positives_instant=np.array(pos_i, dtype=np.int32),
+             negatives_instant=np.array(neg_i, dtype=np.int32),
+             positives_blockbased=np.array(pos_b, dtype=np.int32),
+             negatives_blockbased=np.array(neg_b, dtype=np.int32),
+             frame_offsets=frame_offsets,
+             # relative to the start of the array data of the fold's packed_x.npy (float32)
+             x_byte_offsets=frame_offsets * np.array(features, dtype=np.int64) * 4)
+
+
+class MetadataIndex:
+    '''
+    Columnar metadata of all scene instances of a data location (e.g. .../train), one row per scene instance.
+    The columns are NumPy arrays sorted by filename, lookups of many files are vectorized via searchsorted.
+    '''
+
+    def __init__(self, location_path):
+        self.location_path = location_path
+        with np.load(path.join(location_path, METADATA_INDEX_NAME)) as index:
+            for column in COLUMNS:
+                setattr(self, column, index[column])
+        # absolute filenames like the ones of the dataloader's glob (location_path/fold*/scene*/*.npz)
+        self.filenames = np.array([path.join(location_path, name) for name in self.filenames.tolist()])
+
+    @staticmethod
+    def load_or_create(location_path, n_workers=None):
+        if not path.exists(path.join(location_path, METADATA_INDEX_NAME)):
+            create_metadata_index(location_path, n_workers)
+        return MetadataIndex(location_path)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def rows(self, filenames):
+        filenames = np.asarray(filenames)
+        if len(filenames) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.searchsorted(self.filenames, filenames)
+        rows[rows == len(self)] = 0
+        if not np.all(self.filenames[rows] == filenames):
+            raise ValueError('files not contained in the metadata index of {}.'.format(self.location_path))
+        return rows
+
+    def lengths(self, filenames, instant_mode=True):
+        lengths = self.lengths_instant if instant_mode else self.lengths_blockbased
+        return lengths[self.rows(filenames)]
+
+    def ids(self, filenames):
+        return self.scene_instance_ids[self.rows(filenames)]
+
+    def class_counts(self, filenames, instant_mode=True):
+        rows = self.rows(filenames)
+        if instant_mode:
+            return self.positives_instant[rows], self.negatives_instant[rows]
+        return self.positives_blockbased[rows], self.negatives_blockbased[rows]
+
+    # dicts for the code that looks up single files (formerly file_lengths.pickle and scene_instances_ids.pickle)
+    def length_dict(self, instant_mode=True):
+        lengths = self.lengths_instant if instant_mode else self.lengths_blockbased
+        return dict(zip(self.filenames.tolist(), lengths.tolist()))
+
+    def scene_instance_ids_dict(self):
+        return dict(zip(self.filenames.tolist(), self.scene_instance_ids.tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('location_path',
+                        type=str,
+                        metavar="<location path>",
+                        help="Path containing the fold* folders, e.g. /mnt/binaural/data/scenes2018/train.")
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        dest="n_workers",
+                        metavar="<number of workers>",
+                        help="Number of processes reading the scene instances (default: number of cpus).")
+    args = parser.parse_args()
+    create_metadata_index(args.location_path, args.n_workers)
@@ -0,0 +1,155 @@
+import os
+import pickle
+from os import path
+
+import numpy as np
+
+# per iteration values: float64 appended to <key>.f8 (readable as np.memmap), the rest is one record per epoch
+ITERATION_DTYPE = np.float64
+ITERATION_KEYS = ('train_losses', 'val_losses', 'global_gradient_norm')
+EPOCHS_FILE = 'epochs.pickle'
+
+
+def log_dir(folder_path, name='metrics'):
+    return path.join(folder_path, name + '_log')
+
+
+def exists(folder_path, name='metrics'):
+    return path.exists(path.join(log_dir(folder_path, name), EPOCHS_FILE))
+
+
+class MetricsLog:
+    '''
+    Append-only metrics of a run in folder_path/<name>_log: the per epoch values (accuracies, sensitivities, ...) are
+    one pickle record per epoch appended to epochs.pickle, the per iteration values (losses, gradient norms) are
+    appended to one raw float64 file per key. An epoch costs a write of the epoch only instead of the whole history.
+
+    A record holds the number of iterations per key up to its epoch -> a crash between the two writes and a resume at
+    an earlier epoch (truncate) cut the iteration files exactly. load() gives the dict of utils.pickle_metrics with
+    the iteration values memory mapped.
+
+    A <name>.pickle of a run started before the log is imported, its iterations are split evenly over the epochs.
+    '''
+
+    def __init__(self, folder_path, name='metrics'):
+        self.folder_path = folder_path
+        self.name = name
+        self.dir = log_dir(folder_path, name)
+        self.epochs_path = path.join(self.dir, EPOCHS_FILE)
+
+        self.records = []
+        if path.exists(self.epochs_path):
+            # an epoch whose record was not written completely is dropped together with its iterations
+            self.records, size = self._read_records()
+            if path.getsize(self.epochs_path) > size:
+                os.truncate(self.epochs_path, size)
+            self.truncate(len(self.records))
+        else:
+            os.makedirs(self.dir, exist_ok=True)
+            pickle_path = path.join(folder_path, name + '.pickle')
+            if path.exists(pickle_path):
+                with open(pickle_path, 'rb') as handle:
+                    self._import(pickle.load(handle))
+
+    def _read_records(self):
+        # the records and the size of the complete ones
+        records = []
+        size = 0
+        with open(self.epochs_path, 'rb') as handle:
+            while True:
+                try:
+                    records.append(pickle.load(handle))
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+                size = handle.tell()
+        return records, size
+
+    def _iteration_path(self, key):
+        return path.join(self.dir, key + '.f8')
+
+    @property
+    def n_epochs(self):
+        return len(self.records)
+
+    @property
+    def metric(self):
+        return self.records[-1]['metric'] if self.records else None
+
+    def n_iterations(self, key):
+        return self.records[-1]['n_iterations'].get(key, 0) if self.records else 0
+
+    def append(self, metric, epoch_values, iteration_values):
+        '''
+        Appends an epoch: epoch_values key -> value of this epoch, iteration_values key -> values of the iterations of
+        this epoch.
+        '''
+        n_iterations = dict(self.records[-1]['n_iterations']) if self.records else dict()
+        for key, values in iteration_values.items():
+            values = np.asarray(values, dtype=ITERATION_DTYPE).ravel()
+            with open(self._iteration_path(key), 'ab') as handle:
+                handle.write(values.tobytes())
+            n_iterations[key] = n_iterations.get(key, 0) + values.shape[0]
+
+        record = {'metric': metric, 'values': epoch_values, 'n_iterations': n_iterations}
+        with open(self.epochs_path, 'ab') as handle:
+            pickle.dump(record, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.records.append(record)
+
+    def truncate(self, n_epochs):
+        # keeps the first n_epochs epochs (rewrites the epoch records, cuts the iteration files)
+        n_iterations = self.records[n_epochs - 1]['n_iterations'] if n_epochs > 0 else dict()
+        if n_epochs < len(self.records):
+            self.records = self.records[:n_epochs]
+            with open(self.epochs_path + '.tmp', 'wb') as handle:
+                for record in self.records:
+                    pickle.dump(record, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.epochs_path + '.tmp', self.epochs_path)
+        for file_name in os.listdir(self.dir):
+            if file_name.endswith('.f8'):
+                size = n_iterations.get(file_name[:-3], 0) * np.dtype(ITERATION_DTYPE).itemsize
+                if path.getsize(path.join(self.dir, file_name)) > size:
+                    os.truncate(path.join(self.dir, file_name), size)
+
+    def epoch_values(self, key):
+        return [record['values'][key] for record in self.records]
+
+    def iteration_values(self, key):
+        n = self.n_iterations(key)
+        if n == 0:
+            return np.zeros(0, dtype=ITERATION_DTYPE)
+        return np.memmap(self._iteration_path(key), dtype=ITERATION_DTYPE, mode='r', shape=(n,))
+
+    def load(self):
+        # the metrics dict as pickled by utils.pickle_metrics before
+        if not self.records:
+            return dict()
+        metrics = {'metric': self.metric}
+        for key in self.records[-1]['values']:
+            metrics[key] = np.array(self.epoch_values(key))
+        for key in self.records[-1]['n_iterations']:
+            metrics[key] = self.iteration_values(key)
+        return metrics
+
+    def export(self):
+        # <name>.pickle for the analysis scripts (once per run instead of every epoch)
+        if not self.records:
+            return
+        metrics = {key: np.array(value) if isinstance(value, np.memmap) else value
+                   for key, value in self.load().items()}
+        with open(path.join(self.folder_path, self.name + '.pickle'), 'wb') as handle:
+            pickle.dump(metrics, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _import(self, metrics):
+        epoch_keys = [key for key, value in metrics.items()
+                      if key != 'metric' and key not in ITERATION_KEYS and len(value) > 0]
+        iteration_keys = [key for key in metrics if key in ITERATION_KEYS]
+        n_epochs = min(len(metrics[key]) for key in epoch_keys) if epoch_keys else 0
+        for e in range(n_epochs):
+            iteration_values = dict()
+            for key in iteration_keys:
+                per_epoch = len(metrics[key]) // n_epochs
+                end = len(metrics[key]) if e == n_epochs - 1 else (e + 1) * per_epoch
+                iteration_values[key] = metrics[key][e * per_epoch:end]
+            self.append(metrics['metric'], {key: metrics[key][e] for key in epoch_keys}, iteration_values)
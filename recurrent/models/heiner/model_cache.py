@@ -0,0 +1,97 @@
+from collections import OrderedDict
+
+import numpy as np
+from keras import backend as K
+from keras.layers import Dense, Dropout, Input
+from keras.models import Model
+from keras.optimizers import Adam
+
+import model_extension as m_ext
+import tensorflow_utils
+
+# compiled models kept per process (the graphs of evicted models stay in the session until K.clear_session)
+MAX_CACHED_MODELS = 2
+
+_cache = OrderedDict()
+
+
+def architecture_signature(h, time_steps, loss_weights):
+    '''
+    Everything which is baked into the compiled graph: layers, units, batch shape, dropout rates (python floats in the
+    graph) and the shape of the loss weights. The values of the loss weights and the learning rate are variables and
+    may differ between two folds / hcombs with the same signature.
+    '''
+    graph_recurrent_dropout = h.RECURRENT_DROPOUT if h.RECURRENT_DROPOUT_MODE == 'graph' else 0.
+    return (h.BATCH_SIZE, time_steps, h.N_FEATURES, h.N_CLASSES,
+            tuple(h.UNITS_PER_LAYER_LSTM), tuple(h.UNITS_PER_LAYER_MLP),
+            h.INPUT_DROPOUT, h.LSTM_OUTPUT_DROPOUT, h.MLP_OUTPUT_DROPOUT,
+            h.RECURRENT_DROPOUT_MODE, graph_recurrent_dropout,
+            h.MASK_VAL, np.shape(loss_weights))
+
+
+def build_model(h, time_steps):
+    x = Input(batch_shape=(h.BATCH_SIZE, time_steps, h.N_FEATURES), name='Input', dtype='float32')
+    y = x
+
+    # Input dropout
+    y = Dropout(h.INPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, h.N_FEATURES))(y)
+    for units in h.UNITS_PER_LAYER_LSTM:
+        y = m_ext.recurrent_layer(units, h.RECURRENT_DROPOUT, h.RECURRENT_DROPOUT_MODE,
+                                  return_sequences=True, stateful=True)(y)
+
+        # LSTM Output dropout
+        y = Dropout(h.LSTM_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
+    for units in h.UNITS_PER_LAYER_MLP:
+        if units != h.N_CLASSES:
+            y = Dense(units, activation='relu')(y)
+        else:
+            y = Dense(units, activation='linear')(y)
+
+        # MLP Output dropout but not last layer
+        if units != h.N_CLASSES:
+            y = Dropout(h.MLP_OUTPUT_DROPOUT, noise_shape=(h.BATCH_SIZE, 1, units))(y)
+    return Model(x, y)
+
+
+class CachedModel:
+
+    def __init__(self, h, time_steps, loss_weights):
+        self.model = build_model(h, time_steps)
+        # variable instead of a constant in the loss -> the graph can be reused with the weights of other train folds
+        self.loss_weights = K.variable(loss_weights, dtype='float32', name='loss_weights')
+        self.optimizer = Adam(lr=h.LEARNING_RATE, clipnorm=1.)
+        self.model.compile(optimizer=self.optimizer, loss=tensorflow_utils.my_loss_builder(h.MASK_VAL,
+                                                                                          self.loss_weights),
+                           metrics=None, sample_weight_mode='temporal')
+
+    def reinitialize(self, loss_weights, learning_rate):
+        # fresh draw of the initial weights and fresh optimizer state (iterations and moments) as after a rebuild,
+        # the compiled train and predict functions (cf. model_extension.py) stay attached to the model
+        variables = self.model.weights + self.optimizer.weights
+        K.get_session().run([variable.initializer for variable in variables])
+        K.set_value(self.loss_weights, loss_weights)
+        K.set_value(self.optimizer.lr, learning_rate)
+        self.model.reset_states()
+
+
+def compiled_model(h, time_steps, loss_weights):
+    '''
+    Returns a compiled model for the hyperparameter combination h (reinitialized if a model with the same
+    architecture signature was compiled before in this process) and whether it came from the cache.
+    '''
+    signature = architecture_signature(h, time_steps, loss_weights)
+    if signature in _cache:
+        cached = _cache.pop(signature)
+        cached.reinitialize(loss_weights, h.LEARNING_RATE)
+        from_cache = True
+    else:
+        cached = CachedModel(h, time_steps, loss_weights)
+        from_cache = False
+    _cache[signature] = cached
+    while len(_cache) > MAX_CACHED_MODELS:
+        _cache.popitem(last=False)
+    return cached.model, from_cache
+
+
+def clear():
+    _cache.clear()
@@ -1,9 +1,11 @@
-from functools import partial
-
+import numpy as np
 from keras import backend as K
-from keras.layers import CuDNNLSTM, Layer
+from keras.layers import CuDNNLSTM, LSTM, Layer
 from keras.legacy import interfaces
 
+# numpy: Phase._recurrent_dropout (weights changed before and restored after each batch), graph: DropConnect layers
+RECURRENT_DROPOUT_MODES = ('numpy', 'graph')
+
 
 class MyDropout(Layer):
     """Applies Dropout to the input.
@@ -65,7 +67,18 @@ class MyDropout(Layer):
         return input_shape
 
 
+def _drop_connect(recurrent_kernel, rate, seed=None, training=None):
+    # one mask for the whole recurrent kernel per batch (i.e. per call of the train function), scaled by 1/(1-rate)
+    # like the numpy variant of Phase._recurrent_dropout; no dropout in the inference phase
+    if not 0. < rate < 1.:
+        return recurrent_kernel
+    return K.in_train_phase(lambda: K.dropout(recurrent_kernel, rate, seed=seed), recurrent_kernel, training=training)
+
+
 class DropConnectCuDNNLSTM(CuDNNLSTM):
+    """CuDNNLSTM with DropConnect on the recurrent kernel (https://arxiv.org/pdf/1708.02182.pdf) within the graph.
+    Same weights as CuDNNLSTM, i.e. checkpoints can be loaded into a CuDNNLSTM (e.g. for testing).
+    """
     def __init__(self, units, rate, seed=None, **kwargs):
         super(DropConnectCuDNNLSTM, self).__init__(units, **kwargs)
         self.rate = min(1., max(0., rate))
@@ -79,12 +92,7 @@ class DropConnectCuDNNLSTM(CuDNNLSTM):
         input_h = tf.expand_dims(input_h, axis=0)
         input_c = tf.expand_dims(input_c, axis=0)
 
-        def dropped_recurrent_kernel(recurrent_kernel_):
-            recurrent_kernel_ = K.print_tensor(recurrent_kernel_, 'DropConnect {}: in_train_phase '.format(self.name))
-            return K.dropout(recurrent_kernel_, self.rate, seed=self.seed)
-
-        def standard_recurrent_kernel(recurrent_kernel_):
-            return K.print_tensor(recurrent_kernel_, 'DropConnect {}: not_train_phase '.format(self.name))
+        recurrent_kernel = _drop_connect(self.recurrent_kernel, self.rate, self.seed)
 
         params = self._canonical_to_params(
             weights=[
@@ -92,14 +100,10 @@ class DropConnectCuDNNLSTM(CuDNNLSTM):
                 self.kernel_f,
                 self.kernel_c,
                 self.kernel_o,
-                K.in_train_phase(partial(dropped_recurrent_kernel, self.recurrent_kernel_i),
-                                 partial(standard_recurrent_kernel, self.recurrent_kernel_i)),
-                K.in_train_phase(partial(dropped_recurrent_kernel, self.recurrent_kernel_f),
-                                 partial(standard_recurrent_kernel, self.recurrent_kernel_f)),
-                K.in_train_phase(partial(dropped_recurrent_kernel, self.recurrent_kernel_c),
-                                 partial(standard_recurrent_kernel, self.recurrent_kernel_c)),
-                K.in_train_phase(partial(dropped_recurrent_kernel, self.recurrent_kernel_o),
-                                 partial(standard_recurrent_kernel, self.recurrent_kernel_o)),
+                recurrent_kernel[:, :self.units],
+                recurrent_kernel[:, self.units: self.units * 2],
+                recurrent_kernel[:, self.units * 2: self.units * 3],
+                recurrent_kernel[:, self.units * 3:],
             ],
             biases=[
                 self.bias_i_i,
@@ -137,6 +141,64 @@ class DropConnectCuDNNLSTM(CuDNNLSTM):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+class DropConnectLSTM(LSTM):
+    """CPU fallback of DropConnectCuDNNLSTM: LSTM with the dropped recurrent kernel of the cell during the call
+    (the mask is sampled once per batch, not per time step).
+    """
+    def __init__(self, units, rate, seed=None, **kwargs):
+        super(DropConnectLSTM, self).__init__(units, **kwargs)
+        self.rate = min(1., max(0., rate))
+        self.seed = seed
+
+    def call(self, inputs, mask=None, training=None, initial_state=None):
+        cell = self.cell
+        original_kernels = (cell.recurrent_kernel, cell.recurrent_kernel_i, cell.recurrent_kernel_f,
+                            cell.recurrent_kernel_c, cell.recurrent_kernel_o)
+        recurrent_kernel = _drop_connect(cell.recurrent_kernel, self.rate, self.seed, training=training)
+        cell.recurrent_kernel = recurrent_kernel
+        cell.recurrent_kernel_i = recurrent_kernel[:, :self.units]
+        cell.recurrent_kernel_f = recurrent_kernel[:, self.units: self.units * 2]
+        cell.recurrent_kernel_c = recurrent_kernel[:, self.units * 2: self.units * 3]
+        cell.recurrent_kernel_o = recurrent_kernel[:, self.units * 3:]
+        try:
+            return super(DropConnectLSTM, self).call(inputs, mask=mask, training=training,
+                                                     initial_state=initial_state)
+        finally:
+            cell.recurrent_kernel, cell.recurrent_kernel_i, cell.recurrent_kernel_f, \
+                cell.recurrent_kernel_c, cell.recurrent_kernel_o = original_kernels
+
+    def get_config(self):
+        config = {
+            'rate': self.rate,
+            'seed': self.seed
+        }
+        base_config = super(DropConnectLSTM, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def gpu_available():
+    from keras.backend import tensorflow_backend
+    return len(tensorflow_backend._get_available_gpus()) > 0
+
+
+def recurrent_layer(units, recurrent_dropout=0., recurrent_dropout_mode='numpy', **kwargs):
+    """LSTM layer of the models: CuDNNLSTM on a GPU, otherwise LSTM with the CuDNN gate activations.
+    recurrent_dropout_mode 'graph': DropConnect on the recurrent kernel within the graph (instead of the numpy
+    variant of Phase._recurrent_dropout which changes the weights before and after each batch).
+    """
+    if recurrent_dropout_mode not in RECURRENT_DROPOUT_MODES:
+        raise ValueError('recurrent_dropout_mode has to be one of {}. Got: {}'.format(RECURRENT_DROPOUT_MODES,
+                                                                                  recurrent_dropout_mode))
+    drop_connect = recurrent_dropout_mode == 'graph' and 0. < recurrent_dropout < 1.
+    if gpu_available():
+        if drop_connect:
+            return DropConnectCuDNNLSTM(units, recurrent_dropout, **kwargs)
+        return CuDNNLSTM(units, **kwargs)
+    if drop_connect:
+        return DropConnectLSTM(units, recurrent_dropout, recurrent_activation='sigmoid', **kwargs)
+    return LSTM(units, recurrent_activation='sigmoid', **kwargs)
+
+
 def _make_train_and_predict_function(model, calc_global_gradient_norm):
     if not hasattr(model, 'train_function'):
         raise RuntimeError('You must compile your model before using it.')
@@ -299,10 +361,22 @@ def test_and_predict_on_batch(model, x, y, sample_weight=None):
     return outputs
 
 
+def _make_reset_with_keep_states_function(model):
+    # one graph function for all states of all stateful layers: state <- state * keep (keep: (batch_size, 1))
+    if not hasattr(model, 'reset_with_keep_states_function'):
+        model.reset_with_keep_states_function = None
+    if model.reset_with_keep_states_function is None:
+        keep = K.placeholder(shape=(None, 1), name='keep_states')
+        updates = []
+        for layer in model.layers:
+            if hasattr(layer, 'reset_states') and getattr(layer, 'stateful', False):
+                updates += [K.update(state, state * keep) for state in layer.states if state is not None]
+        model.reset_with_keep_states_function = K.function([keep], [],
+                                                           updates=updates,
+                                                           name='reset_with_keep_states_function')
+
+
 def reset_with_keep_states(model, keep_states):
-    for layer in model.layers:
-        if hasattr(layer, 'reset_states') and getattr(layer, 'stateful', False):
-            #alternative: with K.get_session():
-            for state in layer.states:
-                old_state = K.eval(state)   # should be a numpy array
-                K.set_value(state, old_state * keep_states)
+    # keep_states: (batch_size, 1), 1 -> keep the states of the row, 0 -> reset them
+    _make_reset_with_keep_states_function(model)
+    model.reset_with_keep_states_function([np.asarray(keep_states, dtype=K.floatx())])
@@ -0,0 +1,123 @@
+import queue
+import threading
+
+import numpy as np
+
+
+class BatchPrefetcher:
+    '''
+    Runs dloader.next_batch() in a background thread and copies the batches into a pool of n_slots preallocated
+    slots (replaces GeneratorEnqueuer with max_queue_size=1 and copy_on_return_before_refill).
+
+    The returned arrays are views on a slot. A slot is given back to the producer when the consumer asks for the
+    next batch (or calls release()), i.e. a batch is valid until the next call of next().
+
+    As the producer runs ahead, the state of the dataloader can be snapshotted after each batch (snapshot_states=True,
+    a copy of the file queue and the buffer placements per batch -> only if the states are needed). state_dict() is
+    the state after the last batch given to the consumer.
+    '''
+
+    _end = object()
+
+    def __init__(self, dloader, n_slots=3, snapshot_states=False):
+        if n_slots < 2:
+            raise ValueError('n_slots has to be at least 2 (one for the consumer, one for the producer)')
+
+        self.dloader = dloader
+        # the slots take over the job of the copies before the refill of the buffer
+        self.dloader.copy_on_return_before_refill = False
+
+        self.slots = [None] * n_slots
+        self.free_slots = queue.Queue()
+        for slot_ind in range(n_slots):
+            self.free_slots.put(slot_ind)
+        self.ready = queue.Queue()
+
+        self.snapshot_states = snapshot_states and hasattr(dloader, 'state_dict') \
+            and (dloader.mode != 'test' or getattr(dloader, 'test_stateful', False))
+        self.consumer_state = None
+
+        self.consumer_slot = None
+        self.finished = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            if self.snapshot_states:
+                self.consumer_state = self.dloader.state_dict()
+            self.thread = threading.Thread(target=self._produce, name='batch_prefetcher', daemon=True)
+            self.thread.start()
+
+    def _slot_arrays(self, slot_ind, ret):
+        arrays = self.slots[slot_ind]
+        # validation without state (padded to the longest scene instance) and test batches vary in shape
+        if arrays is None or len(arrays) != len(ret) \
+                or any(a.shape != r.shape or a.dtype != r.dtype for a, r in zip(arrays, ret)):
+            arrays = tuple(np.empty(r.shape, r.dtype) for r in ret)
+            self.slots[slot_ind] = arrays
+        return arrays
+
+    def _produce(self):
+        try:
+            while not self.stop_event.is_set():
+                ret = self.dloader.next_batch()
+                if ret[0] is None or ret[1] is None:
+                    break
+
+                slot_ind = self.free_slots.get()
+                if slot_ind is None:    # close()
+                    return
+                arrays = self._slot_arrays(slot_ind, ret)
+                for a, r in zip(arrays, ret):
+                    np.copyto(a, r)
+                state = self.dloader.state_dict() if self.snapshot_states else None
+                self.ready.put((slot_ind, arrays, state))
+            self.ready.put((None, self._end, None))
+        except Exception as e:
+            self.ready.put((None, e, None))
+
+    def release(self):
+        if self.consumer_slot is not None:
+            self.free_slots.put(self.consumer_slot)
+            self.consumer_slot = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.start()
+        self.release()
+        if self.finished:
+            raise StopIteration
+
+        slot_ind, arrays, state = self.ready.get()
+        if arrays is self._end:
+            self.finished = True
+            raise StopIteration
+        if isinstance(arrays, Exception):
+            self.finished = True
+            raise arrays
+
+        self.consumer_slot = slot_ind
+        self.consumer_state = state
+        return arrays
+
+    def state_dict(self):
+        if not self.snapshot_states:
+            raise ValueError('states are not snapshotted (snapshot_states=False or no state_dict of the dataloader).')
+        if self.consumer_state is None:
+            return self.dloader.state_dict()
+        return self.consumer_state
+
+    def load_state_dict(self, state):
+        if self.thread is not None:
+            raise ValueError('the state has to be loaded before the first batch is requested.')
+        self.dloader.load_state_dict(state)
+
+    def close(self):
+        self.stop_event.set()
+        # unblock the producer if it waits for a free slot
+        self.free_slots.put(None)
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,144 @@
+import argparse
+import glob
+import os
+from os import path
+
+import numpy as np
+from tqdm import tqdm
+
+# keys of the compressed npz files written by convert_data.convert_from_list
+KEYS = ('x', 'y', 'y_block')
+
+PACKED_INDEX_NAME = 'packed_index.npz'
+
+
+def _packed_path(fold_path, key):
+    return path.join(fold_path, 'packed_{}.npy'.format(key))
+
+
+def _relative_name(filename):
+    # scene instances are stored as <location>/fold*/scene*/<name>.npz -> key within a fold is 'scene*/<name>.npz'
+    scene_path, name = path.split(filename)
+    return path.join(path.basename(scene_path), name)
+
+
+def _fold_path(filename):
+    return path.dirname(path.dirname(filename))
+
+
+def _npz_shape(data, key):
+    # reads just the header of the array inside the zip archive -> no decompression of the data itself
+    with data.zip.open(key + '.npy') as handle:
+        version = np.lib.format.read_magic(handle)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(handle)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(handle)
+    return shape
+
+
+def create_packed_store(location_path, features=160, classes=13):
+    '''
+    One-time conversion of all compressed scene instances (fold*/scene*/*.npz) below location_path (e.g. .../train)
+    into one contiguous, uncompressed float32 .npy per fold and key (x, y, y_block). The frames of all scene instances
+    of a fold are concatenated along the time axis, the offsets are saved in packed_index.npz of the fold.
+    '''
+    dims = {'x': features, 'y': classes, 'y_block': classes}
+
+    for fold_path in sorted(glob.glob(path.join(location_path, 'fold*'))):
+        filenames = sorted(glob.glob(path.join(fold_path, 'scene*', '*.npz')))
+        if len(filenames) == 0:
+            continue
+
+        lengths = np.zeros((len(filenames), len(KEYS)), np.int64)
+        for i, filename in enumerate(tqdm(filenames, desc='reading shapes {}'.format(path.basename(fold_path)))):
+            with np.load(filename) as data:
+                for k, key in enumerate(KEYS):
+                    shape = _npz_shape(data, key)
+                    if len(shape) != 3 or shape[0] != 1 or shape[2] != dims[key]:
+                        raise ValueError('{} of {} has unexpected shape {}.'.format(key, filename, shape))
+                    lengths[i, k] = shape[1]
+
+        starts = np.zeros_like(lengths)
+        starts[1:] = np.cumsum(lengths, axis=0)[:-1]
+
+        tmp_paths = {key: _packed_path(fold_path, key) + '.tmp' for key in KEYS}
+        packed = {key: np.lib.format.open_memmap(tmp_paths[key], mode='w+', dtype=np.float32,
+                                                 shape=(int(np.sum(lengths[:, k])), dims[key]))
+                  for k, key in enumerate(KEYS)}
+
+        for i, filename in enumerate(tqdm(filenames, desc='packing {}'.format(path.basename(fold_path)))):
+            with np.load(filename) as data:
+                for k, key in enumerate(KEYS):
+                    packed[key][starts[i, k]:starts[i, k] + lengths[i, k]] = data[key][0]
+
+        for key in KEYS:
+            packed[key].flush()
+            del packed[key]
+            os.replace(tmp_paths[key], _packed_path(fold_path, key))
+
+        # the index is written last: its existence marks the fold as completely converted
+        np.savez(path.join(fold_path, PACKED_INDEX_NAME),
+                 names=np.array([_relative_name(filename) for filename in filenames]),
+                 starts=starts, lengths=lengths)
+
+
+class SceneInstanceStore:
+    '''
+    Reader of the packed store created by create_packed_store. The packed arrays are opened as memory maps, so
+    loading a scene instance is just slicing -> zero-copy and no decompression.
+    '''
+
+    def __init__(self, location_path):
+        self.location_path = location_path
+        self._folds = dict()
+
+    @staticmethod
+    def exists(location_path):
+        return len(glob.glob(path.join(location_path, 'fold*', PACKED_INDEX_NAME))) > 0
+
+    def _fold(self, fold_path):
+        if fold_path not in self._folds:
+            index_path = path.join(fold_path, PACKED_INDEX_NAME)
+            if not path.exists(index_path):
+                self._folds[fold_path] = None
+            else:
+                with np.load(index_path) as index:
+                    names = index['names'].tolist()
+                    starts = index['starts']
+                    lengths = index['lengths']
+                positions = {name: i for i, name in enumerate(names)}
+                packed = {key: np.load(_packed_path(fold_path, key), mmap_mode='r') for key in KEYS}
+                self._folds[fold_path] = (positions, starts, lengths, packed)
+        return self._folds[fold_path]
+
+    def __contains__(self, filename):
+        fold = self._fold(_fold_path(filename))
+        return fold is not None and _relative_name(filename) in fold[0]
+
+    def load(self, filename, keys=KEYS):
+        positions, starts, lengths, packed = self._fold(_fold_path(filename))
+        i = positions[_relative_name(filename)]
+        data = dict()
+        for key in keys:
+            k = KEYS.index(key)
+            # leading batch dimension of one, like in the npz files
+            data[key] = packed[key][starts[i, k]:starts[i, k] + lengths[i, k]][np.newaxis]
+        return data
+
+
+def load_scene_instance(filename, keys=KEYS, store=None):
+    if store is not None and filename in store:
+        return store.load(filename, keys)
+    with np.load(filename) as data:
+        return {key: data[key] for key in keys}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('location_path',
+                        type=str,
+                        metavar="<location path>",
+                        help="Path containing the fold* folders, e.g. /mnt/binaural/data/scenes2018/train.")
+    args = parser.parse_args()
+    create_packed_store(args.location_path)
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+class StreamingPredictions:
+    '''
+    Reassembles the predictions of the stateful test batches (many scene instances chunked into a
+    (batchsize, timesteps) grid, cf. DataLoader(test_stateful=True)) per scene instance.
+
+    The chunks of a scene instance are in one row of consecutive batches, i.e. appending them in the order of the
+    batches gives the prediction of the whole scene instance.
+    '''
+
+    def __init__(self, mask_val):
+        self.mask_val = mask_val
+        self.chunks = dict()   # scene instance id -> list of (frames, classes) arrays
+
+    def add_batch(self, y_prob, b_y):
+        scene_instance_ids = b_y[:, :, 0, 1]
+        for row in range(scene_instance_ids.shape[0]):
+            row_ids = scene_instance_ids[row]
+            # the scene instances of a row follow each other -> unique gives them in order of the frames
+            unique_ids, first = np.unique(row_ids, return_index=True)
+            for scene_instance_id in unique_ids[np.argsort(first)]:
+                if scene_instance_id == self.mask_val:
+                    continue
+                self.chunks.setdefault(scene_instance_id, []).append(y_prob[row, row_ids == scene_instance_id])
+
+    def predictions(self):
+        # scene instance id -> (length, classes)
+        return {scene_instance_id: np.concatenate(chunks, axis=0) for scene_instance_id, chunks in self.chunks.items()}
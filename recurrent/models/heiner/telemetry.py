@@ -0,0 +1,129 @@
+import os
+import time
+
+import numpy as np
+
+# per iteration: seconds (time.perf_counter) of the parts of Phase.run / TestPhase.run and the throughput
+COLUMNS = ('total', 'data_loading', 'tf_graph', 'apply_dropout', 'train_predict', 'dropout_load_original',
+           'accuracy_metrics', 'frames', 'samples', 'frames_per_sec', 'samples_per_sec')
+TIMING_COLUMNS = COLUMNS[:7]
+# parts in the log line of an iteration, the parts of tf_graph are in the csv log only
+LOG_LINE_COLUMNS = ('data_loading', 'tf_graph', 'accuracy_metrics')
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+_column_index = {column: i for i, column in enumerate(COLUMNS)}
+
+
+def timer():
+    return time.perf_counter()
+
+
+def format_seconds(seconds):
+    # millisecond resolution (strftime of whole seconds gave 00:00:00 for most parts)
+    return '{:.3f}s'.format(seconds)
+
+
+class IterationTelemetry:
+    '''
+    Records the timings and the throughput of every iteration of an epoch in a preallocated array (no formatting or
+    printing in the loop). The rows are appended to a csv log every flush_every iterations and at the end of the
+    epoch; summary() gives percentiles per column over the epoch.
+    '''
+
+    def __init__(self, log_path=None, flush_every=100):
+        self.log_path = log_path
+        self.flush_every = flush_every
+
+        self.records = np.full((0, len(COLUMNS)), np.nan)
+        self.iterations = np.zeros(0, dtype=np.int64)
+        self.epoch = 0
+        self.n = 0
+        self.n_flushed = 0
+
+        if self.log_path is not None and not os.path.exists(self.log_path):
+            with open(self.log_path, 'w') as handle:
+                handle.write(','.join(('epoch', 'iteration') + COLUMNS) + '\n')
+
+    def begin_epoch(self, epoch, n_iterations):
+        # the arrays are only reallocated if an epoch has more iterations than the ones before
+        if self.records.shape[0] < n_iterations:
+            self.records = np.full((n_iterations, len(COLUMNS)), np.nan)
+            self.iterations = np.zeros(n_iterations, dtype=np.int64)
+        else:
+            self.records[:] = np.nan
+        self.epoch = epoch
+        self.n = 0
+        self.n_flushed = 0
+
+    def record(self, iteration, frames, samples, **seconds):
+        if self.n == self.records.shape[0]:
+            # more iterations than announced in begin_epoch (e.g. a resumed epoch), grow by doubling
+            self.records = np.concatenate((self.records, np.full(self.records.shape, np.nan)))
+            self.iterations = np.concatenate((self.iterations, np.zeros_like(self.iterations)))
+        row = self.records[self.n]
+        for column, value in seconds.items():
+            row[_column_index[column]] = value
+        row[_column_index['frames']] = frames
+        row[_column_index['samples']] = samples
+        total = row[_column_index['total']]
+        if total > 0:
+            row[_column_index['frames_per_sec']] = frames / total
+            row[_column_index['samples_per_sec']] = samples / total
+        self.iterations[self.n] = iteration
+        self.n += 1
+
+        if self.flush_every > 0 and self.n - self.n_flushed >= self.flush_every:
+            self.flush()
+
+    def last_str(self):
+        # the line of the last iteration for the log output
+        row = self.records[self.n - 1]
+        parts = ['{}: {}'.format(column, format_seconds(row[_column_index[column]]))
+                 for column in LOG_LINE_COLUMNS if not np.isnan(row[_column_index[column]])]
+        return 'time spent: {} ({}), frames/s: {:.0f}'.format(format_seconds(row[_column_index['total']]),
+                                                              ', '.join(parts), row[_column_index['frames_per_sec']])
+
+    def flush(self):
+        if self.log_path is None or self.n == self.n_flushed:
+            self.n_flushed = self.n
+            return
+        rows = np.column_stack((np.full(self.n - self.n_flushed, self.epoch),
+                                self.iterations[self.n_flushed:self.n],
+                                self.records[self.n_flushed:self.n]))
+        with open(self.log_path, 'ab') as handle:
+            np.savetxt(handle, rows, fmt='%.6g', delimiter=',')
+        self.n_flushed = self.n
+
+    def end_epoch(self):
+        self.flush()
+        return self.summary()
+
+    def summary(self, percentiles=SUMMARY_PERCENTILES):
+        '''
+        Column -> {'p50': ..., 'p90': ..., 'p99': ..., 'sum': ...} over the iterations of the epoch, the throughput
+        columns are the whole epoch (frames / seconds).
+        '''
+        records = self.records[:self.n]
+        summary = dict()
+        for i, column in enumerate(COLUMNS):
+            values = records[:, i]
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                continue
+            summary[column] = dict(zip(['p{}'.format(p) for p in percentiles], np.percentile(values, percentiles)))
+            summary[column]['sum'] = np.sum(values)
+        if 'frames_per_sec' in summary and summary['total']['sum'] > 0:
+            summary['frames_per_sec']['epoch'] = summary['frames']['sum'] / summary['total']['sum']
+            summary['samples_per_sec']['epoch'] = summary['samples']['sum'] / summary['total']['sum']
+        return summary
+
+    def summary_str(self):
+        summary = self.summary()
+        if 'frames_per_sec' not in summary:
+            return ''
+        parts = ['{} p50/p90/p99: {}/{}/{}'.format(column, *[format_seconds(summary[column]['p{}'.format(p)])
+                                                             for p in SUMMARY_PERCENTILES])
+                 for column in TIMING_COLUMNS if column in summary]
+        return 'time spent: {} ({}), frames/s: {:.0f}, samples/s: {:.1f}'.format(
+            format_seconds(summary['total']['sum']), ', '.join(parts),
+            summary['frames_per_sec']['epoch'], summary['samples_per_sec']['epoch'])
@@ -68,8 +68,12 @@ def mask_from(y_true, mask_val):
 
 
 def my_loss_builder(mask_val, loss_weights):
+    # loss_weights: array (constant in the graph) or variable (can be set without recompiling, cf. model_cache.py)
+    if not isinstance(loss_weights, K.tf.Variable):
+        loss_weights = K.constant(loss_weights, dtype='float32')
+
     def my_loss(y_true, y_pred):
-        entropy = weighted_cross_entropy_with_logits(y_true, y_pred, K.constant(loss_weights, dtype='float32'))
+        entropy = weighted_cross_entropy_with_logits(y_true, y_pred, loss_weights)
         mask = mask_from(y_true, mask_val)
         entropy *= mask
         entropy /= K.mean(mask)
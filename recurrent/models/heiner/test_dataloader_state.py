@@ -0,0 +1,93 @@
+import os
+from os import path
+
+import numpy as np
+import pytest
+
+from dataloader import DataLoader
+from prefetch import BatchPrefetcher
+
+# run from this directory: PYTHONPATH=../../../common python -m pytest test_dataloader_state.py
+
+FEATURES = 4
+CLASSES = 13
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    # small scene instances of different lengths in train/fold1/scene*/
+    rng = np.random.RandomState(0)
+    for scene in (1, 2):
+        scene_dir = path.join(str(tmp_path), 'train', 'fold1', 'scene{}'.format(scene))
+        os.makedirs(scene_dir)
+        for instance in range(1, 6):
+            length = rng.randint(7, 30)
+            np.savez(path.join(scene_dir, 'scene_instance_factor{}.npz'.format(instance)),
+                     x=rng.normal(size=(1, length, FEATURES)).astype(np.float32),
+                     y=rng.randint(0, 2, size=(1, length, CLASSES)).astype(np.float32),
+                     y_block=rng.randint(0, 2, size=(1, length, CLASSES)).astype(np.float32))
+    return str(tmp_path)
+
+
+def _loader(data_path, mode='train', **kwargs):
+    return DataLoader(mode, 'blockbased', [1], -1, batchsize=2, timesteps=5, epochs=2, buffer=2, features=FEATURES,
+                      classes=CLASSES, path_pattern=data_path, input_standardization=False, use_packed_store=False,
+                      **kwargs)
+
+
+def _next_batches(next_batch, n):
+    batches = []
+    for _ in range(n):
+        ret = next_batch()
+        if ret[0] is None:
+            break
+        batches.append(tuple(np.copy(r) for r in ret))
+    return batches
+
+
+def _assert_same_batches(batches, other_batches):
+    assert len(batches) == len(other_batches) > 0
+    for batch, other_batch in zip(batches, other_batches):
+        for array, other_array in zip(batch, other_batch):
+            np.testing.assert_array_equal(array, other_array)
+
+
+# stateful validation without the priority queue: with it the fill does not terminate for scene instances as short
+# as these (stale heap entries of rows filled by a leftover, as in the baseline loader)
+@pytest.mark.parametrize('mode,kwargs', [('train', {}), ('val', {'val_stateful': True, 'priority_queue': False}),
+                                         ('val', {})])
+def test_state_dict_round_trip(data_path, mode, kwargs):
+    loader = _loader(data_path, mode, **kwargs)
+    _next_batches(loader.next_batch, 3)
+    state = loader.state_dict()
+    batches = _next_batches(loader.next_batch, 6)
+
+    resumed_loader = _loader(data_path, mode, **kwargs)
+    resumed_loader.load_state_dict(state)
+    _assert_same_batches(batches, _next_batches(resumed_loader.next_batch, 6))
+
+    # the same loader set back
+    loader.load_state_dict(state)
+    _assert_same_batches(batches, _next_batches(loader.next_batch, 6))
+
+
+def test_prefetcher_state_dict_round_trip(data_path):
+    prefetcher = BatchPrefetcher(_loader(data_path, use_multithreading=True), snapshot_states=True)
+    _next_batches(lambda: next(prefetcher), 3)
+    # the producer ran ahead, the state is the one after the third batch
+    state = prefetcher.state_dict()
+    batches = _next_batches(lambda: next(prefetcher), 4)
+    prefetcher.close()
+
+    resumed_prefetcher = BatchPrefetcher(_loader(data_path, use_multithreading=True), snapshot_states=True)
+    resumed_prefetcher.load_state_dict(state)
+    _assert_same_batches(batches, _next_batches(lambda: next(resumed_prefetcher), 4))
+    resumed_prefetcher.close()
+
+
+def test_prefetcher_does_not_snapshot_by_default(data_path):
+    prefetcher = BatchPrefetcher(_loader(data_path, use_multithreading=True))
+    next(prefetcher)
+    with pytest.raises(ValueError):
+        prefetcher.state_dict()
+    prefetcher.close()
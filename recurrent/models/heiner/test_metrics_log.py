@@ -0,0 +1,49 @@
+from os import path
+
+import numpy as np
+
+import metrics_log
+
+# run from this directory: python -m pytest test_metrics_log.py
+
+ITERATIONS_PER_EPOCH = {'train_losses': 4, 'val_losses': 2}
+
+
+def _append_epochs(log, n_epochs):
+    for e in range(n_epochs):
+        iteration_values = {key: np.arange(n) + 10 * e for key, n in ITERATIONS_PER_EPOCH.items()}
+        log.append('BAC', {'train_accs': 0.5 + e / 10, 'val_accs': 0.4 + e / 10}, iteration_values)
+
+
+def test_partial_record_is_dropped_on_reopen(tmp_path):
+    folder_path = str(tmp_path)
+    log = metrics_log.MetricsLog(folder_path)
+    _append_epochs(log, 3)
+
+    # a crash while appending the fourth epoch: iterations written, record only partially
+    for key, n in ITERATIONS_PER_EPOCH.items():
+        with open(path.join(log.dir, key + '.f8'), 'ab') as handle:
+            handle.write(np.ones(n, dtype=metrics_log.ITERATION_DTYPE).tobytes())
+    with open(log.epochs_path, 'rb') as handle:
+        record = handle.read()[-40:]
+    with open(log.epochs_path, 'ab') as handle:
+        handle.write(record[:20])
+
+    log = metrics_log.MetricsLog(folder_path)
+    assert log.n_epochs == 3
+    for key, n in ITERATIONS_PER_EPOCH.items():
+        assert log.n_iterations(key) == 3 * n
+        assert path.getsize(path.join(log.dir, key + '.f8')) == 3 * n * np.dtype(metrics_log.ITERATION_DTYPE).itemsize
+    np.testing.assert_allclose(log.epoch_values('val_accs'), [0.4, 0.5, 0.6])
+
+    log.truncate(1)
+    assert log.n_epochs == 1
+    for key, n in ITERATIONS_PER_EPOCH.items():
+        values = log.iteration_values(key)
+        assert len(values) == log.n_iterations(key) == n
+        np.testing.assert_array_equal(values, np.arange(n))
+
+    # the truncated log is what a reopen sees
+    log = metrics_log.MetricsLog(folder_path)
+    assert log.n_epochs == 1
+    assert [len(log.iteration_values(key)) for key in ITERATIONS_PER_EPOCH] == list(ITERATIONS_PER_EPOCH.values())
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+K = pytest.importorskip('keras.backend')
+from keras.layers import Input, LSTM
+from keras.models import Model
+
+import model_extension as m_ext
+from benchmark_recurrent_dropout import build_model, random_batch
+
+# run from this directory: python -m pytest test_recurrent_dropout.py
+
+BATCH_SIZE = 4
+TIME_STEPS = 50
+FEATURES = 8
+UNITS = 20
+RATE = 0.5
+
+
+@pytest.fixture(autouse=True)
+def clear_session():
+    yield
+    K.clear_session()
+
+
+def test_drop_connect_inference():
+    # inference phase: DropConnect layers have to give the outputs of the plain layers with the same weights,
+    # training phase: the mask changes the outputs
+    b_x, _ = random_batch(BATCH_SIZE, TIME_STEPS)
+    plain = build_model(BATCH_SIZE, TIME_STEPS, (UNITS, UNITS), 0., 'numpy')
+    drop_connect = build_model(BATCH_SIZE, TIME_STEPS, (UNITS, UNITS), RATE, 'graph')
+    drop_connect.set_weights(plain.get_weights())
+
+    plain.reset_states()
+    drop_connect.reset_states()
+    assert np.allclose(plain.predict_on_batch(b_x), drop_connect.predict_on_batch(b_x), atol=1e-5)
+
+    outputs = K.function([drop_connect.input, K.learning_phase()], [drop_connect.output])
+    drop_connect.reset_states()
+    y_test = outputs([b_x, 0])[0]
+    drop_connect.reset_states()
+    y_train = outputs([b_x, 1])[0]
+    assert not np.allclose(y_test, y_train)
+
+
+def _cpu_models():
+    # the CPU fallback directly (recurrent_layer takes DropConnectCuDNNLSTM on a GPU)
+    x = Input(batch_shape=(BATCH_SIZE, TIME_STEPS, FEATURES))
+    drop_connect_layer = m_ext.DropConnectLSTM(UNITS, RATE, recurrent_activation='sigmoid', return_sequences=True)
+    drop_connect_layer.build((BATCH_SIZE, TIME_STEPS, FEATURES))
+    cell = drop_connect_layer.cell
+    original_kernels = (cell.recurrent_kernel, cell.recurrent_kernel_i, cell.recurrent_kernel_f,
+                        cell.recurrent_kernel_c, cell.recurrent_kernel_o)
+    drop_connect = Model(x, drop_connect_layer(x))
+    plain = Model(x, LSTM(UNITS, recurrent_activation='sigmoid', return_sequences=True)(x))
+    plain.set_weights(drop_connect.get_weights())
+    return drop_connect, plain, drop_connect_layer, original_kernels
+
+
+def test_drop_connect_lstm_restores_the_cell_kernels():
+    _, _, layer, original_kernels = _cpu_models()
+    cell = layer.cell
+    kernels = (cell.recurrent_kernel, cell.recurrent_kernel_i, cell.recurrent_kernel_f, cell.recurrent_kernel_c,
+               cell.recurrent_kernel_o)
+    assert all(kernel is original_kernel for kernel, original_kernel in zip(kernels, original_kernels))
+    # the weights of the layer are the variables, not the dropped tensors of the call
+    assert cell.recurrent_kernel in layer.trainable_weights
+
+
+def test_drop_connect_lstm_masks_in_the_training_phase_only():
+    drop_connect, plain, layer, _ = _cpu_models()
+    b_x = np.random.normal(0, 1, (BATCH_SIZE, TIME_STEPS, FEATURES)).astype(np.float32)
+    recurrent_kernel = K.get_value(layer.cell.recurrent_kernel)
+
+    outputs = K.function([drop_connect.input, K.learning_phase()], [drop_connect.output])
+    y_plain = plain.predict_on_batch(b_x)
+    assert np.allclose(outputs([b_x, 0])[0], y_plain, atol=1e-5)
+    y_train = outputs([b_x, 1])[0]
+    assert not np.allclose(y_train, y_plain)
+    # a new mask per call
+    assert not np.allclose(y_train, outputs([b_x, 1])[0])
+    # the mask is not written into the variable
+    np.testing.assert_array_equal(K.get_value(layer.cell.recurrent_kernel), recurrent_kernel)
@@ -0,0 +1,124 @@
+import pytest
+
+import hyperparameters as hp
+
+# run from this directory: python -m pytest test_successive_halving.py
+
+
+class StubHCombManager:
+    # the part of HCombManager next_promotion uses: hcomb (with its current stage) per ID
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def get_hcomb_per_id(self, id_):
+        h = hp.H()
+        h.ID = id_
+        h.STAGE = self.stages[id_]
+        h.finished = True
+        return h
+
+
+@pytest.fixture
+def save_path(tmp_path):
+    return str(tmp_path)
+
+
+def test_report_stage_promotes_top_1_over_eta(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3)
+    # less than min_results_per_stage (eta) results -> no promotion, even for the best one so far
+    assert not scheduler.report_stage(0, 1, 0.5)
+    assert not scheduler.report_stage(1, 1, 0.6)
+    # 3 results -> the best one is the top 1 / 3
+    assert scheduler.report_stage(2, 1, 0.7)
+    assert not scheduler.report_stage(3, 1, 0.4)
+    # the last stage promotes nobody
+    for id_, acc in enumerate([0.5, 0.6, 0.7, 0.8]):
+        assert not scheduler.report_stage(id_, 3, acc)
+
+
+def test_report_stage_min_results_per_stage(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=2, min_results_per_stage=4)
+    for id_, acc in enumerate([0.5, 0.6, 0.7]):
+        assert not scheduler.report_stage(id_, 1, acc)
+    # 4 results, top 2
+    assert scheduler.report_stage(3, 1, 0.8)
+    assert not scheduler.report_stage(4, 1, 0.1)
+
+
+def test_next_promotion_promotes_later(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3)
+    hcm = StubHCombManager({id_: 1 for id_ in range(6)})
+    assert scheduler.next_promotion(hcm) is None
+
+    # hcomb 0 is the best but was reported before there were enough results
+    for id_, acc in [(0, 0.9), (1, 0.5)]:
+        assert not scheduler.report_stage(id_, 1, acc)
+    assert not scheduler.report_stage(2, 1, 0.6)
+
+    h = scheduler.next_promotion(hcm)
+    assert h['ID'] == 0 and h['STAGE'] == 2 and not h['finished']
+    assert scheduler.next_promotion(hcm) is None
+
+    # 6 results -> top 2: hcomb 2 is promoted now
+    for id_, acc in [(3, 0.1), (4, 0.2), (5, 0.3)]:
+        assert not scheduler.report_stage(id_, 1, acc)
+    h = scheduler.next_promotion(hcm)
+    assert h['ID'] == 2 and h['STAGE'] == 2
+    assert scheduler.next_promotion(hcm) is None
+
+
+def test_next_promotion_skips_hcombs_run_further(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3)
+    for id_, acc in [(0, 0.9), (1, 0.5), (2, 0.6)]:
+        scheduler.report_stage(id_, 1, acc)
+    # hcomb 0 is in stage 2 already (e.g. added again by hand)
+    assert scheduler.next_promotion(StubHCombManager({0: 2, 1: 1, 2: 1})) is None
+    # and counts as promoted
+    assert scheduler.next_promotion(StubHCombManager({0: 1, 1: 1, 2: 1})) is None
+
+
+def test_should_stop_after_grace_epochs_below_quantile(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3, grace_epochs=3)
+    for epoch in (2, 3):
+        for id_, acc in [(1, 0.5), (2, 0.6), (3, 0.7)]:
+            scheduler.report_epoch(id_, 1, 1, epoch, acc)
+
+    # within the grace epochs
+    assert not scheduler.should_stop(9, 1, 1, 2, 0.1)
+    # median 0.6 of the others
+    assert scheduler.should_stop(9, 1, 1, 3, 0.55)
+    assert not scheduler.should_stop(9, 1, 1, 3, 0.65)
+    # its own record does not count -> less than min_results_per_epoch others
+    assert not scheduler.should_stop(1, 1, 1, 3, 0.4)
+    # curves of another validation fold or stage
+    assert not scheduler.should_stop(9, 1, 2, 3, 0.1)
+    assert not scheduler.should_stop(9, 2, 1, 3, 0.1)
+
+
+def test_should_stop_quantile(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3, grace_epochs=1, stop_quantile=0.)
+    for id_, acc in [(1, 0.5), (2, 0.6), (3, 0.7)]:
+        scheduler.report_epoch(id_, 1, 1, 1, acc)
+    # below the worst of the others only
+    assert not scheduler.should_stop(9, 1, 1, 1, 0.55)
+    assert scheduler.should_stop(9, 1, 1, 1, 0.45)
+
+
+def test_curves_of_other_processes_are_read(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3, grace_epochs=1)
+    other_scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3, grace_epochs=1)
+    for id_, acc in [(1, 0.5), (2, 0.6)]:
+        other_scheduler.report_epoch(id_, 1, 1, 1, acc)
+    assert not scheduler.should_stop(9, 1, 1, 1, 0.1)
+    # appended after the first read
+    other_scheduler.report_epoch(3, 1, 1, 1, 0.7)
+    assert scheduler.should_stop(9, 1, 1, 1, 0.1)
+
+
+def test_max_epochs_grow_by_eta(save_path):
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, eta=3, last_stage=3, grace_epochs=3)
+    assert [scheduler.max_epochs(stage, 50) for stage in (1, 2, 3)] == [6, 17, 50]
+    assert [scheduler.max_epochs(stage, 5) for stage in (1, 2, 3)] == [4, 4, 5]
+    scheduler = hp.SuccessiveHalvingScheduler(save_path, max_epochs_per_stage={1: 10})
+    assert scheduler.max_epochs(1, 50) == 10
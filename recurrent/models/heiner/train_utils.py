@@ -1,48 +1,51 @@
-import copy
 import glob
 import os
-import time
+import pickle
 
 import numpy as np
 from keras import backend as K
-from keras.layers import CuDNNLSTM
-from keras.utils.data_utils import GeneratorEnqueuer
+from keras.layers import CuDNNLSTM, LSTM
 from skimage.util.shape import view_as_blocks
 from scipy.special import expit as sigmoid
 
 import accuracy_utils as acc_u
 import model_extension as m_ext
+import telemetry
 from dataloader import DataLoader
+from prefetch import BatchPrefetcher
+from streaming_inference import StreamingPredictions
 
 
-def calculate_sample_weights_batch(y_scene_instance_ids, file_lengths_dict, scene_instance_ids_dict, mode,
-                                   no_new_weighting=False):
-    if no_new_weighting:
-        return None
-
-    weights_per_scene = acc_u.get_scene_weights(mode)
+def create_sample_weights_lookup(file_lengths_dict, scene_instance_ids_dict, mode):
+    # lookup table: scene instance id -> scene weight * length weight (built once per dataloader)
+    weights_per_scene = acc_u.get_scene_weights(mode)[:, 0]
     weights_per_scene /= np.mean(weights_per_scene)
 
-    # commented out masking because masked time steps already dealed with in my_loss_builder
-    # here is no class-wise masking possible
+    mean_inv_file_lengths = 0.00027947386527248043 # mean inv filelength (all folds), cf. file_lengths_dict
 
-    # masked_time_steps = (y_scene_instance_ids != mask_val).astype(np.float32)
-    scene_instance_ids_in_batch = y_scene_instance_ids.astype(np.int)
-    weights = weights_per_scene[:, 0][((scene_instance_ids_in_batch // 1e4) - 1).astype(np.int)]  # * masked_time_steps
+    filenames = list(scene_instance_ids_dict.keys())
+    scene_instance_ids = np.array([scene_instance_ids_dict[f] for f in filenames]).astype(np.int64)
+    file_lengths = np.array([file_lengths_dict[f] for f in filenames], dtype=np.float64)
 
-    # remark: performance improvement possible by doing the following dict inversion
-    #         only once and not per call of this function which is done in each batch
-    inv_scene_instance_ids_dict = {v: k for k, v in scene_instance_ids_dict.items()}
-    mean_inv_file_lengths = 0.00027947386527248043 # mean inv filelength (all folds), cf. file_lengths_dict
+    # the last entry is for the id -1 (of masked time steps) which only gets the weight of scene index -2
+    # (i.e. -1 // 1e4 - 1), as before
+    sample_weights_lookup = np.zeros(np.max(scene_instance_ids) + 2, dtype=np.float64)
+    w_length = (1. / file_lengths) / mean_inv_file_lengths
+    sample_weights_lookup[scene_instance_ids] = weights_per_scene[scene_instance_ids // 10000 - 1] * w_length
+    sample_weights_lookup[-1] = weights_per_scene[-2]
+
+    return sample_weights_lookup
 
-    for sid in np.unique(scene_instance_ids_in_batch):
-        if sid == -1.0:
-            continue
 
-        w_length = (1. / file_lengths_dict[inv_scene_instance_ids_dict[sid]]) / mean_inv_file_lengths
-        weights[scene_instance_ids_in_batch == sid] *= w_length
+def calculate_sample_weights_batch(y_scene_instance_ids, sample_weights_lookup, no_new_weighting=False):
+    if no_new_weighting:
+        return None
+
+    # commented out masking because masked time steps already dealed with in my_loss_builder
+    # here is no class-wise masking possible
 
-    return weights
+    # masked_time_steps = (y_scene_instance_ids != mask_val).astype(np.float32)
+    return sample_weights_lookup[y_scene_instance_ids.astype(np.int64)]  # * masked_time_steps
 
 
 def create_generator(dloader):
@@ -54,19 +57,25 @@ def create_generator(dloader):
         yield ret
 
 
-def create_generator_multithreading(dloader):
-    standard_gen = create_generator(dloader)
-    dloader_enqueuer = GeneratorEnqueuer(standard_gen, use_multiprocessing=False)
-    dloader_enqueuer.start(workers=1, max_queue_size=1)
-    return dloader_enqueuer.get()
+def create_generator_multithreading(dloader, n_slots=3, snapshot_states=False):
+    # batches are valid until the next call of next() (cf. prefetch.py), snapshot_states for mid epoch states only
+    return BatchPrefetcher(dloader, n_slots=n_slots, snapshot_states=snapshot_states)
+
+
+def close_generator_and_dataloader(gen, dloader):
+    if isinstance(gen, BatchPrefetcher):
+        gen.close()
+        if gen.thread is not None:
+            gen.thread.join()
+    dloader.close()
 
 
 def create_train_dataloader(LABEL_MODE, TRAIN_FOLDS, TRAIN_SCENES, BATCHSIZE, TIMESTEPS, EPOCHS, NFEATURES, NCLASSES,
-                            BUFFER, use_multithreading=True, input_standardization=True):
+                            BUFFER, use_multithreading=True, input_standardization=True, n_io_workers=2):
     train_loader = DataLoader('train', LABEL_MODE, TRAIN_FOLDS, TRAIN_SCENES, batchsize=BATCHSIZE,
                               timesteps=TIMESTEPS, epochs=EPOCHS, features=NFEATURES, classes=NCLASSES,
                               buffer=BUFFER, use_multithreading=use_multithreading,
-                              input_standardization=input_standardization)
+                              input_standardization=input_standardization, n_io_workers=n_io_workers)
     train_loader_len = train_loader.len()
     print('Number of batches per epoch (training): ' + str(train_loader_len))
 
@@ -76,11 +85,12 @@ def create_train_dataloader(LABEL_MODE, TRAIN_FOLDS, TRAIN_SCENES, BATCHSIZE, TI
 
 
 def create_val_dataloader(LABEL_MODE, TRAIN_SCENES, BATCHSIZE, TIMESTEPS, EPOCHS, NFEATURES, NCLASSES, VAL_FOLDS,
-                          VAL_STATEFUL, BUFFER, use_multithreading=True, input_standardization=True):
+                          VAL_STATEFUL, BUFFER, use_multithreading=True, input_standardization=True,
+                          n_io_workers=2):
     val_loader = DataLoader('val', LABEL_MODE, VAL_FOLDS, TRAIN_SCENES, epochs=EPOCHS, batchsize=BATCHSIZE,
                             timesteps=TIMESTEPS, features=NFEATURES, classes=NCLASSES, val_stateful=VAL_STATEFUL,
                             buffer=BUFFER, use_multithreading=use_multithreading,
-                            input_standardization=input_standardization)
+                            input_standardization=input_standardization, n_io_workers=n_io_workers)
 
     val_loader_len = val_loader.len()
     print('Number of batches per epoch (validation): ' + str(val_loader_len))
@@ -90,9 +100,18 @@ def create_val_dataloader(LABEL_MODE, TRAIN_SCENES, BATCHSIZE, TIMESTEPS, EPOCHS
     return val_loader
 
 
-def create_test_dataloader(LABEL_MODE, input_standardization=True, val_fold3_as_test=False):
-    test_loader = DataLoader('test', LABEL_MODE, -1, -1, input_standardization=input_standardization,
-                             val_fold3_as_test=val_fold3_as_test)
+def create_test_dataloader(LABEL_MODE, input_standardization=True, val_fold3_as_test=False, stateful=False,
+                           BATCHSIZE=1, TIMESTEPS=4000, BUFFER=10, n_io_workers=2):
+    # stateful: the scene instances are chunked into (BATCHSIZE, TIMESTEPS) batches and the states are kept
+    # (instead of one whole scene instance per batch)
+    if stateful:
+        test_loader = DataLoader('test', LABEL_MODE, -1, -1, batchsize=BATCHSIZE, timesteps=TIMESTEPS, epochs=1,
+                                 buffer=BUFFER, input_standardization=input_standardization,
+                                 val_fold3_as_test=val_fold3_as_test, use_multithreading=True,
+                                 n_io_workers=n_io_workers, test_stateful=True)
+    else:
+        test_loader = DataLoader('test', LABEL_MODE, -1, -1, input_standardization=input_standardization,
+                                 val_fold3_as_test=val_fold3_as_test)
 
     test_loader_len = test_loader.len()
     print('Number of batches per epoch (test): ' + str(test_loader_len))
@@ -144,7 +163,7 @@ class TestPhase:
     def __init__(self, model, dloader, OUTPUT_THRESHOLD, MASK_VAL, EPOCHS, val_fold_str, model_save_dir,
                  metric='BAC2',
                  ret=('final', 'per_class', 'per_class_scene', 'per_scene'),
-                 code_test_mode=False):
+                 code_test_mode=False, collect_predictions=False, telemetry_path=None, print_every=1):
         self.prefix = 'test'
 
         self.model_save_dir = model_save_dir
@@ -185,58 +204,91 @@ class TestPhase:
 
         self.code_test_mode = code_test_mode
 
+        self.stateful = getattr(dloader, 'test_stateful', False)
+        # scene instance id -> predicted probabilities (length, classes), only for the stateful test loader
+        self.collect_predictions = collect_predictions and self.stateful
+        self.predictions = None
+
+        # timings and throughput per iteration, an iteration line is printed every print_every iterations
+        self.telemetry = telemetry.IterationTelemetry(telemetry_path)
+        self.print_every = print_every
+
+    def close(self):
+        # stops the prefetching thread and the read ahead of the dataloader (threads or processes)
+        close_generator_and_dataloader(self.gen, self.dloader)
+
     @property
     def epoch_str(self):
         return 'epoch: {:{prec}} / {:{prec}}'.format(self.e + 1, self.EPOCHS, prec=len(str(self.EPOCHS)))
 
+    def it_str(self, iteration):
+        return '{}_iteration: {:{prec}} / {:{prec}}'.format(self.prefix, iteration, self.dloader_len[self.e],
+                                                           prec=len(str(self.dloader_len[self.e])))
+
     def run(self):
-        scene_instance_id_metrics_dict = dict()
+        scene_instance_id_metrics_dict = acc_u.SceneInstanceMetricsAccumulator.from_dataloader(self.dloader)
+        streaming_predictions = StreamingPredictions(self.MASK_VAL) if self.collect_predictions else None
 
-        for iteration in range(1, self.dloader_len[self.e] + 1):
+        if self.stateful:
             self.model.reset_states()
 
-            iteration_start_time = time.time()
-            it_str = '{}_iteration: {:{prec}} / {:{prec}}'.format(self.prefix, iteration, self.dloader_len[self.e],
-                                                                  prec=len(str(self.dloader_len[self.e])))
+        self.telemetry.begin_epoch(self.e, self.dloader_len[self.e])
+        for iteration in range(1, self.dloader_len[self.e] + 1):
+            if not self.stateful:
+                self.model.reset_states()
+
+            iteration_start_time = telemetry.timer()
 
-            iteration_start_time_data_loading = time.time()
+            iteration_start_time_data_loading = telemetry.timer()
 
-            b_x, b_y = next(self.gen)
+            keep_states = None
+            if self.stateful:
+                b_x, b_y, keep_states = next(self.gen)
+            else:
+                b_x, b_y = next(self.gen)
 
-            elapsed_time_data_loading = time.time() - iteration_start_time_data_loading
+            elapsed_time_data_loading = telemetry.timer() - iteration_start_time_data_loading
 
-            iteration_start_time_tf_graph = time.time()
-            tf_graph_verbose = False
-            tf_graph_time_spent_str = ''
+            iteration_start_time_tf_graph = telemetry.timer()
 
             out_logits = self.model.predict_on_batch(b_x)
             y_pred = sigmoid(out_logits, out=out_logits)
+            if streaming_predictions is not None:
+                streaming_predictions.add_batch(y_pred.copy(), b_y)
             y_pred = np.greater_equal(y_pred, self.OUTPUT_THRESHOLD, out=y_pred)
+            if self.stateful:
+                # states of rows which continue their scene instance in the next batch are kept, the others reset
+                m_ext.reset_with_keep_states(self.model, keep_states)
 
-            elapsed_time_tf_graph = time.time() - iteration_start_time_tf_graph
+            elapsed_time_tf_graph = telemetry.timer() - iteration_start_time_tf_graph
 
-            iteration_start_time_accuracy_metrics = time.time()
+            iteration_start_time_accuracy_metrics = telemetry.timer()
             acc_u.calculate_class_accuracies_metrics_per_scene_instance_in_batch(scene_instance_id_metrics_dict,
                                                                                  y_pred, b_y, self.MASK_VAL)
-            elapsed_time_accuracy_metrics = time.time() - iteration_start_time_accuracy_metrics
-            elapsed_time = time.time() - iteration_start_time
-            time_spent_str = 'time spent: {} (data loading: {}, tf graph: {}{}, accuracy metrics: {})'.format(
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time)),
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time_data_loading)),
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time_tf_graph)),
-                tf_graph_time_spent_str if tf_graph_verbose else '',
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time_accuracy_metrics))
-            )
-            loss_log_str = '{:<20}  {:<20}  {:<20}  {}'.format(self.val_fold_str, self.epoch_str, it_str,
-                                                               time_spent_str)
-            print(loss_log_str)
-
-        scene_instance_id_metrics_dict_counts = copy.deepcopy(scene_instance_id_metrics_dict) \
+            elapsed_time_accuracy_metrics = telemetry.timer() - iteration_start_time_accuracy_metrics
+            elapsed_time = telemetry.timer() - iteration_start_time
+            self.telemetry.record(iteration, np.count_nonzero(b_y[:, :, 0, 0] != self.MASK_VAL), b_x.shape[0],
+                                  total=elapsed_time, data_loading=elapsed_time_data_loading,
+                                  tf_graph=elapsed_time_tf_graph, accuracy_metrics=elapsed_time_accuracy_metrics)
+            if iteration % self.print_every == 0 or iteration == self.dloader_len[self.e]:
+                loss_log_str = '{:<20}  {:<20}  {:<20}  {}'.format(self.val_fold_str, self.epoch_str,
+                                                                   self.it_str(iteration), self.telemetry.last_str())
+                print(loss_log_str)
+
+        self.telemetry.end_epoch()
+        print('{:<20}  {:<20}  {:<20}  {}'.format(self.val_fold_str, self.epoch_str, '', self.telemetry.summary_str()))
+
+        if streaming_predictions is not None:
+            self.predictions = streaming_predictions.predictions()
+
+        scene_instance_id_metrics_counts = scene_instance_id_metrics_dict.copy() if self.code_test_mode else None
+        scene_instance_id_metrics_dict_counts = scene_instance_id_metrics_counts.to_dict() \
             if self.code_test_mode else None
 
+        # the accumulator (two arrays) instead of the dict of arrays -> small pickle
         with open(os.path.join(self.model_save_dir, 'scene_instance_id_metrics_dict_counts.pickle'), 'wb') as handle:
             import pickle
-            pickle.dump(scene_instance_id_metrics_dict_counts, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(scene_instance_id_metrics_counts, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
         # TODO: can get a mismatch here, as number of returned values may change depending on parameter 'ret'
         final_acc, final_acc_bac2, class_accuracies, class_accuracies_bac2, \
@@ -272,7 +324,9 @@ class Phase:
                  ret=('final', 'per_class', 'per_class_scene', 'per_scene'),
                  code_test_mode=False,
                  no_new_weighting=False, changbin_recurrent_dropout=False,
-                 subsample_time_steps=False):
+                 subsample_time_steps=False,
+                 mid_epoch_state_path=None, mid_epoch_state_every=0,
+                 recurrent_dropout_mode='numpy', telemetry_path=None, print_every=1):
 
         self.subsample_time_steps = False
 
@@ -287,7 +341,8 @@ class Phase:
 
         self.recurrent_dropout = min(1., max(0., recurrent_dropout))
 
-        if self.train and 0. < self.recurrent_dropout <= 1.:
+        # recurrent_dropout_mode 'graph': done by the DropConnect layers of the model (cf. model_extension.py)
+        if self.train and 0. < self.recurrent_dropout <= 1. and recurrent_dropout_mode == 'numpy':
             self.apply_recurrent_dropout = True
         else:
             self.apply_recurrent_dropout = False
@@ -307,8 +362,15 @@ class Phase:
         self.metric = metric
         self.ret = ret
 
+        # mid epoch states (every n iterations of training, 0 -> never) to resume a killed epoch at the exact batch
+        self.mid_epoch_state_path = mid_epoch_state_path
+        self.mid_epoch_state_every = mid_epoch_state_every if mid_epoch_state_path is not None and self.train else 0
+        self.resumed_iteration = 0
+        self.resumed_metrics = None
+
         if dloader.use_multithreading:
-            self.gen = create_generator_multithreading(dloader)
+            # the prefetcher snapshots the loader state after every batch only if mid epoch states are saved
+            self.gen = create_generator_multithreading(dloader, snapshot_states=self.mid_epoch_state_every > 0)
         else:
             self.gen = create_generator(dloader)
         self.dloader_len = dloader.len()
@@ -333,10 +395,19 @@ class Phase:
         self.code_test_mode = code_test_mode
 
         self.no_new_weighting = no_new_weighting
+        self.sample_weights_lookup = None
+        if not self.no_new_weighting:
+            self.sample_weights_lookup = create_sample_weights_lookup(self.dloader.length_dict_(),
+                                                                      self.dloader.scene_instance_ids_dict_(),
+                                                                      train_or_val)
 
         self.changbin_recurrent_dropout = changbin_recurrent_dropout
         self.dropout_applied_once = False
 
+        # timings and throughput per iteration, an iteration line is printed every print_every iterations
+        self.telemetry = telemetry.IterationTelemetry(telemetry_path)
+        self.print_every = print_every
+
     def resume_from_epoch(self, resume_epoch):
         if hasattr(self.dloader, 'act_epoch'):
             for _ in range(self.e, resume_epoch - 1):
@@ -346,10 +417,81 @@ class Phase:
         else:
             raise ValueError('Can resume for training or validation loader only.')
 
+    def _stateful_layers(self):
+        return [layer for layer in self.model.layers if getattr(layer, 'stateful', False)]
+
+    def save_mid_epoch_state(self, iteration, scene_instance_id_metrics_dict):
+        loader_state = self.gen.state_dict() if isinstance(self.gen, BatchPrefetcher) else self.dloader.state_dict()
+        n_gradient_norms = iteration if self.train and self.calc_global_gradient_norm else 0
+        state = {
+            'e': self.e,
+            'iteration': iteration,
+            'dloader': loader_state,
+            'weights': self.model.get_weights(),
+            # numpy recurrent dropout draws its masks from the global numpy random state
+            'numpy_random_state': np.random.get_state(),
+            'metrics': scene_instance_id_metrics_dict.copy(),
+            'losses': self.losses[len(self.losses) - iteration:],
+            'global_gradient_norms': self.global_gradient_norms[len(self.global_gradient_norms) - n_gradient_norms:],
+            'optimizer_weights': K.batch_get_value(self.model.optimizer.weights),
+            'rnn_states': [K.batch_get_value(layer.states) for layer in self._stateful_layers()],
+            'dropout_applied_once': self.dropout_applied_once
+        }
+        # one file (weights included) renamed at the end -> a kill while saving keeps the last complete state
+        with open(self.mid_epoch_state_path + '.tmp', 'wb') as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.mid_epoch_state_path + '.tmp', self.mid_epoch_state_path)
+
+    def load_mid_epoch_state(self):
+        '''
+        Restores the state saved by save_mid_epoch_state if it belongs to the actual epoch (call after
+        resume_from_epoch). Returns the number of iterations of the epoch which are done already.
+        '''
+        if self.mid_epoch_state_path is None or not os.path.exists(self.mid_epoch_state_path):
+            return 0
+        with open(self.mid_epoch_state_path, 'rb') as handle:
+            state = pickle.load(handle)
+        if state['e'] != self.e:
+            return 0
+
+        if isinstance(self.gen, BatchPrefetcher):
+            self.gen.load_state_dict(state['dloader'])
+        else:
+            self.dloader.load_state_dict(state['dloader'])
+
+        self.model.set_weights(state['weights'])
+        np.random.set_state(state['numpy_random_state'])
+        # the optimizer weights exist after building the train function
+        m_ext._make_train_and_predict_function(self.model, self.calc_global_gradient_norm)
+        K.batch_set_value(list(zip(self.model.optimizer.weights, state['optimizer_weights'])))
+        for layer, states in zip(self._stateful_layers(), state['rnn_states']):
+            K.batch_set_value(list(zip(layer.states, states)))
+
+        self.losses += state['losses']
+        self.global_gradient_norms += state['global_gradient_norms']
+        self.dropout_applied_once = state['dropout_applied_once']
+        self.resumed_iteration = state['iteration']
+        self.resumed_metrics = state['metrics']
+        return self.resumed_iteration
+
+    def remove_mid_epoch_state(self):
+        if self.mid_epoch_state_path is None:
+            return
+        if os.path.exists(self.mid_epoch_state_path):
+            os.remove(self.mid_epoch_state_path)
+
+    def close(self):
+        # stops the prefetching thread and the read ahead of the dataloader (threads or processes)
+        close_generator_and_dataloader(self.gen, self.dloader)
+
     @property
     def epoch_str(self):
         return 'epoch: {:{prec}} / {:{prec}}'.format(self.e + 1, self.EPOCHS, prec=len(str(self.EPOCHS)))
 
+    def it_str(self, iteration):
+        return '{}_iteration: {:{prec}} / {:{prec}}'.format(self.prefix, iteration, self.dloader_len[self.e],
+                                                           prec=len(str(self.dloader_len[self.e])))
+
     def _changbin_recurrent_dropout(self):
         def _drop_in_recurrent_kernel(rk):
             # print('Zeros in weight matrix before dropout: {}'.format(np.sum(rk == 0)))
@@ -372,7 +514,7 @@ class Phase:
             return rk
 
         for layer in self.model.layers:
-            if type(layer) is CuDNNLSTM:
+            if type(layer) in (CuDNNLSTM, LSTM):
                 rk0 = _drop_in_recurrent_kernel(K.get_value(layer.weights[0]))
                 rk1 = _drop_in_recurrent_kernel(K.get_value(layer.weights[1]))
                 rk2 = _drop_in_recurrent_kernel(K.get_value(layer.weights[2]))
@@ -403,7 +545,7 @@ class Phase:
 
         original_weights_and_masks = []
         for layer in self.model.layers:
-            if type(layer) is CuDNNLSTM:
+            if type(layer) in (CuDNNLSTM, LSTM):
                 rk = K.get_value(layer.weights[1])
                 rk_old = np.copy(rk)
                 rk, mask = _drop_in_recurrent_kernel(rk)
@@ -415,7 +557,7 @@ class Phase:
     def _load_original_weights_updated(self, original_weights_and_masks):
         i = 0
         for layer in self.model.layers:
-            if type(layer) is CuDNNLSTM:
+            if type(layer) in (CuDNNLSTM, LSTM):
                 rk = K.get_value(layer.weights[1])
                 mask = original_weights_and_masks[i][1]
                 original_weights_updated = original_weights_and_masks[i][0] + (
@@ -425,18 +567,23 @@ class Phase:
                 i += 1
 
     def run(self):
-        self.model.reset_states()
-
-        scene_instance_id_metrics_dict = dict()
+        if self.resumed_metrics is not None:
+            # continue the epoch of load_mid_epoch_state (the rnn states are restored already)
+            scene_instance_id_metrics_dict = self.resumed_metrics
+            self.resumed_metrics = None
+        else:
+            self.model.reset_states()
+            scene_instance_id_metrics_dict = acc_u.SceneInstanceMetricsAccumulator.from_dataloader(self.dloader)
+        first_iteration = self.resumed_iteration + 1
+        self.resumed_iteration = 0
 
-        for iteration in range(1, self.dloader_len[self.e] + 1):
-            iteration_start_time = time.time()
-            it_str = '{}_iteration: {:{prec}} / {:{prec}}'.format(self.prefix, iteration, self.dloader_len[self.e],
-                                                                  prec=len(str(self.dloader_len[self.e])))
+        self.telemetry.begin_epoch(self.e, self.dloader_len[self.e] - first_iteration + 1)
+        for iteration in range(first_iteration, self.dloader_len[self.e] + 1):
+            iteration_start_time = telemetry.timer()
 
             is_val_loader_stateful = not self.train and self.dloader.val_stateful
 
-            iteration_start_time_data_loading = time.time()
+            iteration_start_time_data_loading = telemetry.timer()
             keep_states = None
             if is_val_loader_stateful:
                 b_x, b_y, keep_states = next(self.gen)
@@ -490,15 +637,14 @@ class Phase:
             if not (b_x != 0).any() or not (b_y[:, :, :, 0] != -1).any():
                 break
 
-            elapsed_time_data_loading = time.time() - iteration_start_time_data_loading
+            elapsed_time_data_loading = telemetry.timer() - iteration_start_time_data_loading
 
-            iteration_start_time_tf_graph = time.time()
-            tf_graph_verbose = False
-            tf_graph_time_spent_str = ''
+            iteration_start_time_tf_graph = telemetry.timer()
+            elapsed_tf_graph_parts = dict()
             if self.train:
                 original_weights_and_masks = None
 
-                iteration_start_time_tf_graph_apply_dropout = time.time()
+                iteration_start_time_tf_graph_apply_dropout = telemetry.timer()
                 if self.apply_recurrent_dropout:
                     if self.changbin_recurrent_dropout:
                         # changbin applies dropout just once in the beginning
@@ -507,16 +653,14 @@ class Phase:
                             self.dropout_applied_once = True
                     else:
                         original_weights_and_masks = self._recurrent_dropout()
-                elapsed_time_tf_graph_apply_dropout = time.time() - iteration_start_time_tf_graph_apply_dropout
+                elapsed_time_tf_graph_apply_dropout = telemetry.timer() - iteration_start_time_tf_graph_apply_dropout
 
-                iteration_start_time_tf_graph_call = time.time()
+                iteration_start_time_tf_graph_call = telemetry.timer()
                 loss, out_logits, gradient_norm = m_ext.train_and_predict_on_batch(
                     self.model, b_x, b_y[:, :, :, 0],
                     sample_weight=calculate_sample_weights_batch(
                         b_y[:, :, 0, 1],
-                        self.dloader.length_dict_(),
-                        self.dloader.scene_instance_ids_dict_(),
-                        'train',
+                        self.sample_weights_lookup,
                         no_new_weighting=self.no_new_weighting
                     ),
                     calc_global_gradient_norm=self.calc_global_gradient_norm
@@ -528,32 +672,27 @@ class Phase:
                 y_pred = sigmoid(out_logits, out=out_logits)
                 y_pred = np.greater_equal(y_pred, self.OUTPUT_THRESHOLD, out=y_pred)
 
-                elapsed_time_tf_graph_call = time.time() - iteration_start_time_tf_graph_call
+                elapsed_time_tf_graph_call = telemetry.timer() - iteration_start_time_tf_graph_call
 
                 if self.calc_global_gradient_norm:
                     self.global_gradient_norms.append(gradient_norm)
 
-                iteration_start_time_tf_graph_dropout_load_original = time.time()
+                iteration_start_time_tf_graph_dropout_load_original = telemetry.timer()
                 if self.apply_recurrent_dropout and not self.changbin_recurrent_dropout:
                     self._load_original_weights_updated(original_weights_and_masks)
                     del original_weights_and_masks
-                elapsed_time_tf_graph_dropout_load_original = time.time() - \
+                elapsed_time_tf_graph_dropout_load_original = telemetry.timer() - \
                                                               iteration_start_time_tf_graph_dropout_load_original
 
-                tf_graph_time_spent_str = ' (apply drop: {}, train_predict: {}, drop load original: {})' \
-                    .format(
-                    time.strftime("%H:%M:%S", time.gmtime(elapsed_time_tf_graph_apply_dropout)),
-                    time.strftime("%H:%M:%S", time.gmtime(elapsed_time_tf_graph_call)),
-                    time.strftime("%H:%M:%S", time.gmtime(elapsed_time_tf_graph_dropout_load_original))
-                )
+                elapsed_tf_graph_parts = dict(apply_dropout=elapsed_time_tf_graph_apply_dropout,
+                                              train_predict=elapsed_time_tf_graph_call,
+                                              dropout_load_original=elapsed_time_tf_graph_dropout_load_original)
             else:
                 loss, out_logits = m_ext.test_and_predict_on_batch(
                     self.model, b_x, b_y[:, :, :, 0],
                     sample_weight=calculate_sample_weights_batch(
                         b_y[:, :, 0, 1],
-                        self.dloader.length_dict_(),
-                        self.dloader.scene_instance_ids_dict_(),
-                        'val',
+                        self.sample_weights_lookup,
                         no_new_weighting=self.no_new_weighting
                     )
                 )
@@ -565,24 +704,23 @@ class Phase:
                 y_pred = np.greater_equal(y_pred, self.OUTPUT_THRESHOLD, out=y_pred)
 
             self.losses.append(loss)
-            elapsed_time_tf_graph = time.time() - iteration_start_time_tf_graph
+            elapsed_time_tf_graph = telemetry.timer() - iteration_start_time_tf_graph
 
-            iteration_start_time_accuracy_metrics = time.time()
+            iteration_start_time_accuracy_metrics = telemetry.timer()
             acc_u.calculate_class_accuracies_metrics_per_scene_instance_in_batch(scene_instance_id_metrics_dict,
                                                                                  y_pred, b_y, self.MASK_VAL)
-            elapsed_time_accuracy_metrics = time.time() - iteration_start_time_accuracy_metrics
-            elapsed_time = time.time() - iteration_start_time
-            time_spent_str = 'time spent: {} (data loading: {}, tf graph: {}{}, accuracy metrics: {})'.format(
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time)),
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time_data_loading)),
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time_tf_graph)),
-                tf_graph_time_spent_str if tf_graph_verbose else '',
-                time.strftime("%H:%M:%S", time.gmtime(elapsed_time_accuracy_metrics))
-            )
-            loss_str = 'loss: {}'.format(loss)
-            loss_log_str = '{:<20}  {:<20}  {:<20}  {:<26}  {}'.format(self.val_fold_str, self.epoch_str, it_str,
-                                                                       loss_str, time_spent_str)
-            print(loss_log_str)
+            elapsed_time_accuracy_metrics = telemetry.timer() - iteration_start_time_accuracy_metrics
+            elapsed_time = telemetry.timer() - iteration_start_time
+            self.telemetry.record(iteration, np.count_nonzero(b_y[:, :, 0, 0] != self.MASK_VAL), b_x.shape[0],
+                                  total=elapsed_time, data_loading=elapsed_time_data_loading,
+                                  tf_graph=elapsed_time_tf_graph, accuracy_metrics=elapsed_time_accuracy_metrics,
+                                  **elapsed_tf_graph_parts)
+            if iteration % self.print_every == 0 or iteration == self.dloader_len[self.e]:
+                loss_str = 'loss: {}'.format(loss)
+                loss_log_str = '{:<20}  {:<20}  {:<20}  {:<26}  {}'.format(self.val_fold_str, self.epoch_str,
+                                                                           self.it_str(iteration), loss_str,
+                                                                           self.telemetry.last_str())
+                print(loss_log_str)
 
             if not self.train:
                 if not self.dloader.val_stateful:
@@ -590,13 +728,20 @@ class Phase:
                 else:
                     m_ext.reset_with_keep_states(self.model, keep_states)
 
+            if self.mid_epoch_state_every > 0 and iteration % self.mid_epoch_state_every == 0 \
+                    and iteration < self.dloader_len[self.e]:
+                self.save_mid_epoch_state(iteration, scene_instance_id_metrics_dict)
+
+        self.telemetry.end_epoch()
+        print('{:<20}  {:<20}  {:<20}  {}'.format(self.val_fold_str, self.epoch_str, '', self.telemetry.summary_str()))
+
         if self.train:
             final_acc, sens_spec_class_scene = acc_u.train_accuracy(scene_instance_id_metrics_dict, metric=self.metric)
 
             scene_instance_id_metrics_dict_counts = None
         else:
 
-            scene_instance_id_metrics_dict_counts = copy.deepcopy(scene_instance_id_metrics_dict) \
+            scene_instance_id_metrics_dict_counts = scene_instance_id_metrics_dict.copy().to_dict() \
                 if self.code_test_mode else None
 
             # TODO: can get a mismatch here, as number of returned values may change depending on parameter 'ret'
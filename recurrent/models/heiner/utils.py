@@ -1,67 +1,128 @@
+import atexit
+import hashlib
 import pickle
 import platform
 import json
+import threading
 import numpy as np
 
 from os import path
 
 
-class UnbufferedLogAndPrint:
+class BufferedLogAndPrint:
+    '''
+    Writes to the stream (sys.stdout / sys.stderr, flushed at once) and to logfile_path + '.txt'. The log file is
+    opened once, its writes are buffered and flushed every flush_interval seconds by a daemon thread, at close() and
+    at exit of the interpreter. multiprocessing children (e.g. TmuxProcess) end with os._exit without the atexit
+    handlers -> close() it at the end of the child.
+    '''
 
-   def __init__(self, logfile_path, stream):
+    def __init__(self, logfile_path, stream, flush_interval=5., buffer_size=64 * 1024):
+        self.stream = stream
+        self.te = logfile_path + '.txt'  # File where you need to keep the logs
+        self.flush_interval = flush_interval
 
-       self.stream = stream
-       self.te = logfile_path +'.txt'  # File where you need to keep the logs
+        # print from several threads (e.g. the loader threads) -> one write at a time
+        self._lock = threading.Lock()
+        self._file = open(self.te, 'a', buffering=buffer_size)
+        self._closed = threading.Event()
 
-   def write(self, data):
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
 
-       self.stream.write(data)
-       self.stream.flush()
-       with open(self.te, 'a') as handle:
-        handle.write(data)    # Write the data of stdout here to a text file as well
+    def write(self, data):
+        with self._lock:
+            self.stream.write(data)
+            if not self._closed.is_set():
+                self._file.write(data)    # Write the data of stdout here to a text file as well
+        self.stream.flush()
 
-   def flush(self):
-       # this flush method is needed for python 3 compatibility.
-       # this handles the flush command by doing nothing.
-       # you might want to specify some extra behavior here.
-       pass
+    def write_log(self, data):
+        # to the log file only
+        with self._lock:
+            if not self._closed.is_set():
+                self._file.write(data)
 
+    def flush(self):
+        # called by print(flush=True) and tqdm on every update -> the log file is flushed by the flusher thread only
+        self.stream.flush()
 
-def get_buffer_size_wrt_time_steps(time_steps):
-    hostname = platform.node()
-    ref_time_steps = 1000
-    buffer_dict = {'eltanin' : 100, 'sabik' : 60, 'elnath' : 200, 'merope' : 20}
-    return int(buffer_dict[hostname]*ref_time_steps // time_steps)
+    def flush_log(self):
+        with self._lock:
+            if not self._closed.is_set():
+                self._file.flush()
 
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush_log()
 
-def get_hostname_batch_size_wrt_time_steps(time_steps, gpu=None):
-    hostname = platform.node()
-    ref_time_steps = 1000
-    batch_size_dict = {'eltanin': 128, 'sabik': 128, 'elnath': 32, 'merope': 64}
-    bs = batch_size_dict[hostname]
+    def close(self):
+        # the stream stays usable, the log file is flushed and closed
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self._file.close()
+        atexit.unregister(self.close)
 
-    if hostname == 'eltanin' and gpu == '0':
-        bs = int(bs / 2)
 
-    if ref_time_steps < 1000:
-        bs = min(int(bs*2), int(bs*ref_time_steps // time_steps))
-    if time_steps > 1999:
-        bs = 20
+def subsample_time_steps(h):
+    # long sequences are given to the model subsampled by 2 (Phase: mean of two consecutive frames)
+    return h.TIME_STEPS >= 2000
 
-    return hostname, bs
+
+def model_time_steps(h):
+    # time steps of the model (input shape), the dataloaders read h.TIME_STEPS
+    return h.TIME_STEPS // 2 if subsample_time_steps(h) else h.TIME_STEPS
+
+
+def get_buffer_size_wrt_time_steps(h):
+    # calibrated buffer of this machine for h (calibration.py)
+    import calibration
+    return calibration.cached_buffer(h)
+
+
+def get_hostname_batch_size_wrt_time_steps(h):
+    # highest throughput batch size of this machine (and gpu) for h, calibrated once per machine (calibration.py)
+    import calibration
+    return platform.node(), calibration.calibration_for(h)['batch_size']
+
+
+def get_hostname_max_batch_size_wrt_time_steps(h):
+    # largest batch size of the calibration of this machine (and gpu) for h which fits into the memory
+    import calibration
+    return platform.node(), max(candidate['batch_size'] for candidate in calibration.calibration_for(h)['candidates'])
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Not serializable: {}'.format(type(value)))
+
+
+def canonical_json(d, ignore_keys=()):
+    # sorted keys, numpy arrays and scalars as python values -> equal dicts give equal strings
+    if len(ignore_keys) > 0:
+        d = {key: value for key, value in d.items() if key not in ignore_keys}
+    return json.dumps(d, sort_keys=True, default=_to_json)
+
+
+def fingerprint(d, ignore_keys=()):
+    # stable hash of a dict (of json serializable values) -> set / index lookups instead of comparing the dicts
+    return hashlib.sha1(canonical_json(d, ignore_keys).encode('utf-8')).hexdigest()
 
 
 def unique_dict(ds):
+    # first occurrence of every dict, order kept
     ds_unique = []
-    ds_string_unique = []
+    fingerprints = set()
     for d in ds:
-        d_without_numpy = d.copy()
-        for key, value in d_without_numpy.items():
-            if type(value) is np.ndarray:
-                d_without_numpy[key] = value.tolist()
-        ds_string = json.dumps(d_without_numpy, sort_keys=True)
-        if ds_string not in ds_string_unique:
-            ds_string_unique.append(ds_string)
+        d_fingerprint = fingerprint(d)
+        if d_fingerprint not in fingerprints:
+            fingerprints.add(d_fingerprint)
             ds_unique.append(d)
     return ds_unique
 
@@ -72,6 +133,10 @@ def pickle_metrics(metrics_dict, folder_path, name="metrics"):
 
 
 def load_metrics(folder_path, name="metrics"):
+    # the metrics log of a run (metrics_log.py) is up to date after every epoch, the pickle after the run only
+    import metrics_log
+    if metrics_log.exists(folder_path, name):
+        return metrics_log.MetricsLog(folder_path, name).load()
     with open(path.join(folder_path, name+'.pickle'), 'rb') as handle:
         return pickle.load(handle)
 
@@ -0,0 +1,199 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+import time
+from os import path
+
+
+def _limit_resources(cpus, memory_limit_gb):
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    if memory_limit_gb is not None:
+        # address space: with a gpu tensorflow reserves a lot of virtual memory -> for cpu workers
+        limit = int(memory_limit_gb * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _redirect_output(log_path):
+    # file descriptors -> the output of the hcomb processes (forked by run_gpu) goes into the log as well
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(log_fd)
+
+
+def _run_worker(worker_id, device, cpus, memory_limit_gb, log_path, save_path, run_gpu_kwargs):
+    # own process group -> the pool can stop the worker together with its hcomb process
+    os.setpgrp()
+    _redirect_output(log_path)
+    _limit_resources(cpus, memory_limit_gb)
+
+    # '' -> cpu only, the models use LSTM instead of CuDNNLSTM (model_extension.recurrent_layer)
+    os.environ['CUDA_VISIBLE_DEVICES'] = device
+    n_cores = len(cpus)
+    os.environ['OMP_NUM_THREADS'] = str(n_cores)
+
+    # keras and tensorflow are imported after CUDA_VISIBLE_DEVICES is set
+    import keras_model_run as run
+    print('Worker {} (pid {}) on {}.'.format(worker_id, os.getpid(), 'gpu ' + device if device != '' else 'cpu'))
+    run.run_gpu(device, save_path, current_hcomb_path=path.join(path.dirname(log_path),
+                                                                 'worker_{}_current_hcomb.pickle'.format(worker_id)),
+                n_cores_to_use=n_cores, **run_gpu_kwargs)
+
+
+class Worker:
+
+    def __init__(self, worker_id, device, cpus):
+        self.worker_id = worker_id
+        self.device = device
+        self.cpus = cpus
+        self.process = None
+        self.restarts = 0
+        self.done = False
+
+
+class WorkerPool:
+    '''
+    Runs n_workers run_gpu loops on this machine which pull hcombs from the queue of save_path until it is empty.
+
+    devices: gpus (CUDA_VISIBLE_DEVICES) assigned round robin to the workers, None -> cpu only workers. Every worker is
+    pinned to cores_per_worker cores (and tensorflow uses as many threads), memory_limit_gb limits its address space.
+    The output of a worker and its hcomb processes is in log_dir/worker_<id>.log.
+
+    Health check every check_interval seconds: a crashed worker is restarted (at most max_restarts times) and resumes
+    its hcomb, a worker whose log was not written for stall_timeout seconds is killed and restarted as well.
+    '''
+
+    def __init__(self, save_path, n_workers, devices=None, cores_per_worker=3, memory_limit_gb=None, log_dir=None,
+                 max_restarts=3, check_interval=30, stall_timeout=None, **run_gpu_kwargs):
+        if n_workers < 1:
+            raise ValueError('n_workers has to be at least 1. Got: {}'.format(n_workers))
+
+        self.save_path = save_path
+        self.memory_limit_gb = memory_limit_gb
+        self.log_dir = log_dir if log_dir is not None else path.join(save_path, 'worker_logs')
+        self.max_restarts = max_restarts
+        self.check_interval = check_interval
+        self.stall_timeout = stall_timeout
+        self.run_gpu_kwargs = run_gpu_kwargs
+        self.run_gpu_kwargs.setdefault('reset_hcombs', False)
+
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        n_cpus = os.cpu_count()
+        self.workers = []
+        for worker_id in range(n_workers):
+            device = str(devices[worker_id % len(devices)]) if devices else ''
+            first_cpu = (worker_id * cores_per_worker) % n_cpus
+            cpus = {(first_cpu + i) % n_cpus for i in range(min(cores_per_worker, n_cpus))}
+            self.workers.append(Worker(worker_id, device, cpus))
+
+    def log_path(self, worker):
+        return path.join(self.log_dir, 'worker_{}.log'.format(worker.worker_id))
+
+    def _start(self, worker):
+        worker.process = multiprocessing.Process(target=_run_worker,
+                                                 args=(worker.worker_id, worker.device, worker.cpus,
+                                                       self.memory_limit_gb, self.log_path(worker), self.save_path,
+                                                       dict(self.run_gpu_kwargs)),
+                                                 name='worker_{}'.format(worker.worker_id))
+        worker.process.start()
+
+    def _stop(self, worker, sig):
+        try:
+            os.killpg(worker.process.pid, sig)
+        except ProcessLookupError:
+            pass
+        worker.process.join()
+
+    def _is_stalled(self, worker):
+        if self.stall_timeout is None or not path.exists(self.log_path(worker)):
+            return False
+        return time.time() - path.getmtime(self.log_path(worker)) > self.stall_timeout
+
+    def _restart(self, worker, reason):
+        if worker.restarts >= self.max_restarts:
+            print('Worker {} {}, not restarted ({} restarts).'.format(worker.worker_id, reason, worker.restarts))
+            worker.done = True
+            return
+        worker.restarts += 1
+        print('Worker {} {}, restart {} / {}.'.format(worker.worker_id, reason, worker.restarts, self.max_restarts))
+        self._start(worker)
+
+    def check(self):
+        for worker in self.workers:
+            if worker.done:
+                continue
+            if worker.process.is_alive():
+                if self._is_stalled(worker):
+                    self._stop(worker, signal.SIGKILL)
+                    self._restart(worker, 'stalled for more than {} s'.format(self.stall_timeout))
+            elif worker.process.exitcode == 0:
+                # run_gpu returned: no more hcombs to run
+                worker.done = True
+            else:
+                self._restart(worker, 'crashed (exitcode {})'.format(worker.process.exitcode))
+
+    def run(self):
+        for worker in self.workers:
+            self._start(worker)
+        print('{} workers started, logs in {}.'.format(len(self.workers), self.log_dir))
+        try:
+            while not all(worker.done for worker in self.workers):
+                time.sleep(self.check_interval)
+                self.check()
+        finally:
+            for worker in self.workers:
+                if worker.process is not None and worker.process.is_alive():
+                    self._stop(worker, signal.SIGTERM)
+        return [worker.restarts for worker in self.workers]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_path',
+                        type=str,
+                        metavar="<save path>",
+                        help="Model directory with the hcombs to run, e.g. .../model_directories/LDNN_v1.")
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        dest="n_workers",
+                        metavar="<number of workers>")
+    parser.add_argument('-g', '--gpus',
+                        nargs='*',
+                        default=None,
+                        dest="devices",
+                        metavar="<gpus>",
+                        help="GPUs assigned round robin to the workers. Default: cpu only workers.")
+    parser.add_argument('-c', '--cores',
+                        type=int,
+                        default=3,
+                        dest="cores_per_worker",
+                        metavar="<cores per worker>")
+    parser.add_argument('-m', '--memory',
+                        type=float,
+                        default=None,
+                        dest="memory_limit_gb",
+                        metavar="<memory limit per worker in GB>")
+    parser.add_argument('-r', '--restarts',
+                        type=int,
+                        default=3,
+                        dest="max_restarts",
+                        metavar="<maximum restarts per worker>")
+    parser.add_argument('-s', '--stall_timeout',
+                        type=float,
+                        default=None,
+                        dest="stall_timeout",
+                        metavar="<seconds without log output until a worker is restarted>")
+    parser.add_argument('-db', '--sqlite',
+                        action='store_true',
+                        dest="use_sqlite",
+                        help="hcombs in a SQLite database (hcomb_store.py) instead of the pickles.")
+    args = parser.parse_args()
+    WorkerPool(**vars(args)).run()
@@ -4,9 +4,11 @@ import random
 import heapq
 from glob import glob
 import pickle
+import os
 import sys
 import tensorflow as tf
 import pandas as pd
+from bucketing import LengthBucketSampler  # common/bucketing.py, need to have common in PYTHONPATH
 MACRO_PATH = ''
 # get preprocessing mean and std
 def get_scalar(cv_id):
@@ -71,13 +73,55 @@ def _read_py_function1(filename,mean,std,mode):
         l = np.array([x.shape[0]])
         return x.astype(np.float32), y.astype(np.int32), l.astype(np.int32)
 
-def read_validationset(path_set, batchsize,mean,std,mode):
-    # shuffle path_set
+def _read_py_function1_batch(filenames,mean,std,mode):
+    # filenames of one bucket joined by '@', padded like padded_batch (value 0)
+    instances = [_read_py_function1(filename,mean,std,mode) for filename in filenames.split(b'@')]
+    max_length = max(x.shape[0] for x, _, _ in instances)
+    bx = np.zeros((len(instances), max_length, instances[0][0].shape[1]), np.float32)
+    by = np.zeros((len(instances), max_length, instances[0][1].shape[1]), np.int32)
+    for i, (x, y, _) in enumerate(instances):
+        bx[i, :x.shape[0]] = x
+        by[i, :y.shape[0]] = y
+    bl = np.concatenate([l for _, _, l in instances])[:, np.newaxis]
+    return bx, by, bl.astype(np.int32)
+def read_validationset(path_set, batchsize,mean,std,mode,lengths=None,max_padding_ratio=None):
+    '''
+    lengths (frames per path): batches of similarly long scene instances (cf. bucketing.py), the achieved
+    padding ratio is printed. With max_padding_ratio the batches can be smaller than batchsize (dynamic batch size).
+    '''
+    if lengths is not None:
+        sampler = LengthBucketSampler(lengths, batchsize, max_padding_ratio)
+        print('validation set: {} batches, padding ratio {:.3f}'.format(len(sampler), sampler.padding_ratio()))
+        if max_padding_ratio is not None:
+            buckets = ['@'.join(path_set[i] for i in batch) for batch in sampler]
+            dataset = tf.data.Dataset.from_tensor_slices(buckets)
+            return dataset.map(
+                lambda filenames: tuple(tf.py_func(_read_py_function1_batch, [filenames,mean,std,mode], [tf.float32, tf.int32, tf.int32])))
+        path_set = [path_set[i] for i in sampler.order]
     dataset = tf.data.Dataset.from_tensor_slices(path_set)
     dataset = dataset.map(
         lambda filename: tuple(tf.py_func(_read_py_function1, [filename,mean,std,mode], [tf.float32, tf.int32, tf.int32])))
     batch = dataset.padded_batch(batchsize, padded_shapes=([None, None], [None, None], [None]))
     return batch
+def get_lengths(paths, mode):
+    '''
+    Frames per path from the metadata index (metadata_index.npz of heiner/metadata_index.py) of the data location of
+    the paths (.../train or .../test above fold*/scene*/).
+    '''
+    lengths_per_location = dict()
+    lengths = []
+    for p in paths:
+        location_path = p[:p.rindex('/fold')]
+        if location_path not in lengths_per_location:
+            with np.load(os.path.join(location_path, 'metadata_index.npz')) as index:
+                column = index['lengths_blockbased' if mode == 'block' else 'lengths_instant']
+                lengths_per_location[location_path] = dict(zip(index['filenames'].tolist(), column.tolist()))
+        lengths.append(lengths_per_location[location_path][os.path.relpath(p, location_path)])
+    return lengths
+def sort_by_length(paths, lengths):
+    # longest first, the order of the batches of read_validationset with lengths (LengthBucketSampler.order)
+    order = LengthBucketSampler(lengths, 1).order
+    return [paths[i] for i in order], [lengths[i] for i in order]
 # testing loader-------------------------------
 def _read_py_function2(filename,mean,std,mode):
     filename = filename.decode(sys.getdefaultencoding())
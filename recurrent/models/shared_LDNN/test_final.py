@@ -76,6 +76,8 @@ class HyperParameters:
         self.VAL_FOLD = VAL_FOLD
         self.TRAIN_SET, self.PATHS = get_train_data(self.VAL_FOLD, self.SCENES, self.EPOCHS, self.TIMELENGTH)
         self.VALID_SET = get_test_data(folder=self.TEST_FOLD)
+        # longest first like the batches of read_validationset -> batch i holds the paths [i * batch_size, (i + 1) * batch_size)
+        self.VALID_SET, self.VALID_LENGTHS = sort_by_length(self.VALID_SET, get_lengths(self.VALID_SET, self.LABEL_MODE))
         self.TOTAL_SAMPLES = len(self.PATHS)
         self.NUM_TRAIN = len(self.TRAIN_SET)
         self.NUM_TEST = len(self.VALID_SET)
@@ -85,6 +87,8 @@ class HyperParameters:
     def update_attribute(self):
         self.TRAIN_SET, self.PATHS = get_train_data(self.VAL_FOLD, self.SCENES, self.EPOCHS, self.TIMELENGTH)
         self.VALID_SET = get_test_data(folder=self.TEST_FOLD)
+        # longest first like the batches of read_validationset -> batch i holds the paths [i * batch_size, (i + 1) * batch_size)
+        self.VALID_SET, self.VALID_LENGTHS = sort_by_length(self.VALID_SET, get_lengths(self.VALID_SET, self.LABEL_MODE))
         self.TOTAL_SAMPLES = len(self.PATHS)
         self.NUM_TRAIN = len(self.TRAIN_SET)
         self.NUM_TEST = len(self.VALID_SET)
@@ -92,6 +96,8 @@ class HyperParameters:
                     'validation': self.VALID_SET}
     def init_testdata(self):
         self.VALID_SET = get_test_data(folder=self.TEST_FOLD)
+        # longest first like the batches of read_validationset -> batch i holds the paths [i * batch_size, (i + 1) * batch_size)
+        self.VALID_SET, self.VALID_LENGTHS = sort_by_length(self.VALID_SET, get_lengths(self.VALID_SET, self.LABEL_MODE))
         self.NUM_TEST = len(self.VALID_SET)
         self.SET = {'validation': self.VALID_SET}
     def get_scalar(self):
@@ -106,7 +112,8 @@ class HyperParameters:
     def validation(self, batch_size):
         with tf.name_scope('LDNN'):
             with tf.device('/cpu:0'):
-                valid_batch = read_validationset(self.SET['validation'], batch_size,self.MEAN,self.STD,self.LABEL_MODE)
+                valid_batch = read_validationset(self.SET['validation'], batch_size,self.MEAN,self.STD,self.LABEL_MODE,
+                                                 lengths=self.VALID_LENGTHS)
                 handle = tf.placeholder(tf.string, shape=[])
                 iterator = tf.data.Iterator.from_string_handle(handle, valid_batch.output_types,
                                                                valid_batch.output_shapes)